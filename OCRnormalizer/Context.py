@@ -16,7 +16,7 @@ def importrules(rulepath):
     module.
     '''
 
-    global delim, punctuationset, flipslipper, felecterrors, selecttruths, Context, AmbiguousPairs, AmbiguousTriggers, logvals
+    global delim, punctuationset, flipslipper, felecterrors, selecttruths, Context, AmbiguousPairs, AmbiguousTriggers, PairIndex, logvals
     
     delim = '\t'
     punctuationset = {'.', ',', '?', '!', ';', ')'}
@@ -67,6 +67,15 @@ def importrules(rulepath):
     del FileLines
     AmbiguousTriggers.add('fad')
 
+    PairIndex = dict()
+    for Pair in AmbiguousPairs:
+        for word in Pair:
+            if word not in PairIndex:
+                PairIndex[word] = Pair
+    # Maps each word in AmbiguousPairs to the first pair that contains it,
+    # so catch_ambiguities can find a trigger's pair without scanning the
+    # whole list.
+
     # The word 'fad' doesn't exist before 1825, and I'm only running this script on early texts.
 
     with open(os.path.join(rulepath, 'logvalues.tsv'), encoding='utf-8') as file:
@@ -246,7 +255,7 @@ def as_stream(linelist, verbose = False):
     return tokens, LongSproblem
 
 def catch_ambiguities(tokenlist, verbose = False):
-    global AmbiguousPairs, AmbiguousTriggers, punctuationset
+    global PairIndex, AmbiguousTriggers, punctuationset
     
     deletions = {}
     additions = {}
@@ -341,32 +350,28 @@ def catch_ambiguities(tokenlist, verbose = False):
                         followed = tokenlist[indexnum + j].lower()
                         break
                 
-            for Pair in AmbiguousPairs:
-                Tweedledee, Tweedledum = Pair
-                if token == Tweedledee or token == Tweedledum:
-                    RealMcCoy, prob = disambiguate(preceded, token, followed, Pair)
-                    # we get a probability back that we don't use in this context
-
-                    if RealMcCoy != token and RealMcCoy != "":
-                        if verbose:
-                            correctionphrase = " ".join([preceded, token, followed, "=>", preceded, RealMcCoy, followed])
-                            changedphrases.append(correctionphrase)
-                            
-                        additions = add_or_inc(RealMcCoy, additions)
-                        deletions = add_or_inc(token, deletions)
-                        token = RealMcCoy
-                    else:
-                        if verbose:
-                            correctionphrase = " ".join([preceded, token, followed, "<= KEPT"])
-                            changedphrases.append(correctionphrase)
-                        unchanged = add_or_inc(token, unchanged)
-                       
-                    break
-
-                # "Break" because we assume that a token can only match
-                # one ambiguous pair. The only exception I know of is
-                # flip - slip - ship, and that's handled recursively in the
-                # disambiguate function
+            Pair = PairIndex.get(token)
+            if Pair is not None:
+                RealMcCoy, prob = disambiguate(preceded, token, followed, Pair)
+                # we get a probability back that we don't use in this context
+
+                if RealMcCoy != token and RealMcCoy != "":
+                    if verbose:
+                        correctionphrase = " ".join([preceded, token, followed, "=>", preceded, RealMcCoy, followed])
+                        changedphrases.append(correctionphrase)
+                        
+                    additions = add_or_inc(RealMcCoy, additions)
+                    deletions = add_or_inc(token, deletions)
+                    token = RealMcCoy
+                else:
+                    if verbose:
+                        correctionphrase = " ".join([preceded, token, followed, "<= KEPT"])
+                        changedphrases.append(correctionphrase)
+                    unchanged = add_or_inc(token, unchanged)
+
+            # We assume that a token can only match one ambiguous pair. The
+            # only exception I know of is flip - slip - ship, and that's
+            # handled recursively in the disambiguate function.
                 
             if Titlecased:
                 origtoken = token.title()
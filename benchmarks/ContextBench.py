@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+'''Microbenchmark for Context.catch_ambiguities on a long-s volume.
+
+	For each token that might be a long-s error, catch_ambiguities used to
+	find the token's ambiguous pair by walking the whole AmbiguousPairs list
+	(about 400 tuples) in a Python loop. Now it looks the token up in
+	PairIndex, a dictionary compiled with the other rules. This compares the
+	old loop with the new lookup, on a long-s volume generated by
+	SyntheticCorpus.py (most s's read as f's, as in an eighteenth-century
+	book), or on volumes you pass in. It checks that both versions make the
+	same corrections before timing anything.
+
+	Context.disambiguate also caches its results now. Each timed run
+	starts with an empty cache, as a worker's first volume would, and we
+	report how often the cache hit.
+
+	Then it checks that catch_ambiguities_parallel, which splits a volume
+	into chunks of pages and corrects them on a process pool, gives exactly
+	the result catch_ambiguities does, and times it with as many workers as
+	there are CPUs. (Each worker starts with an empty cache, too.)
+
+	Finally it compares bigram lookups in Context's BigramStore with the
+	dictionary of "word1 word2" strings it replaced, for every pair of
+	adjacent words in the volume, and reports the memory each occupies. The
+	store is timed twice: with its cache of rows empty, as in a worker's
+	first volume, and with the rows that volume cached.
+
+	USAGE, from a directory containing PathDictionary.txt:
+
+	python3 ContextBench.py [zipfile or txt file ...]
+'''
+
+import os, sys, random, time, tracemalloc
+from multiprocessing import Pool
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pagefeatures'))
+
+import BigramStore
+import FileCabinet
+import NormalizeVolume
+import Context
+from Context import add_or_inc, disambiguate, punctuationset
+import SyntheticCorpus
+from TokenizerBench import read_volume, best_time
+
+samplepages = 300
+
+# THE OLD CODE, as it was in catch_ambiguities (minus verbose logging,
+# which doesn't change the corrections).
+
+def old_catch_ambiguities(tokenlist):
+	Context.clear_cache()
+	# So that it doesn't get a head start from disambiguate's cache.
+	AmbiguousPairs = Context.AmbiguousPairs
+	AmbiguousTriggers = Context.AmbiguousTriggers
+
+	deletions = {}
+	additions = {}
+	corrected = []
+	unchanged = {}
+
+	separatedlist = list()
+	for token in tokenlist:
+		if len(token) < 1:
+			continue
+		if token[-1] in punctuationset and len(token) > 1:
+			separatedlist.append(token[:-1])
+			separatedlist.append(token[-1])
+			continue
+		else:
+			separatedlist.append(token)
+	tokenlist = separatedlist
+
+	for indexnum, origtoken in enumerate(tokenlist):
+		if origtoken.startswith('<') and origtoken.endswith('>'):
+			corrected.append(origtoken)
+			continue
+		if origtoken in punctuationset and len(corrected) > 1:
+			corrected[-1] = corrected[-1] + origtoken
+			continue
+		if len(origtoken) < 2:
+			corrected.append(origtoken)
+			continue
+
+		token = origtoken.lower()
+		Titlecased = origtoken.istitle()
+		Uppercased = origtoken.isupper()
+
+		if token in AmbiguousTriggers:
+			if token == "fad":
+				additions = add_or_inc('sad', additions)
+				deletions = add_or_inc('fad', deletions)
+				continue
+
+			preceded = '#nought'
+			followed = '#nought'
+			if indexnum > 4:
+				for j in range(1, 3):
+					if (not tokenlist[indexnum - j].startswith('<')) and tokenlist[indexnum - j] !='\n':
+						preceded = tokenlist[indexnum - j].lower()
+						break
+			if indexnum < (len(tokenlist)- 4):
+				for j in range(1, 3):
+					if (not tokenlist[indexnum + j].startswith('<')) and tokenlist[indexnum + j] !='\n':
+						followed = tokenlist[indexnum + j].lower()
+						break
+
+			for Pair in AmbiguousPairs:
+				Tweedledee, Tweedledum = Pair
+				if token == Tweedledee or token == Tweedledum:
+					RealMcCoy, prob = disambiguate(preceded, token, followed, Pair)
+					if RealMcCoy != token and RealMcCoy != "":
+						additions = add_or_inc(RealMcCoy, additions)
+						deletions = add_or_inc(token, deletions)
+						token = RealMcCoy
+					else:
+						unchanged = add_or_inc(token, unchanged)
+					break
+
+			if Titlecased:
+				origtoken = token.title()
+			elif Uppercased:
+				origtoken = token.upper()
+			else:
+				origtoken = token
+
+		corrected.append(origtoken)
+
+	return deletions, additions, corrected, unchanged
+
+def new_catch_ambiguities(tokenlist):
+	Context.clear_cache()
+	deletions, additions, corrected, changedphrases, unchanged = Context.catch_ambiguities(tokenlist)
+	return deletions, additions, corrected, unchanged
+
+def parallel_catch_ambiguities(tokenlist, pool):
+	deletions, additions, corrected, changedphrases, unchanged = Context.catch_ambiguities_parallel(tokenlist, pool)
+	return deletions, additions, corrected, unchanged
+
+def compare_parallel(tokens, serialtime):
+	workers = os.cpu_count()
+	best = None
+
+	for i in range(3):
+		pool = Pool(workers)
+		pool.map(abs, range(workers))
+		# A fresh pool each time, so every worker's cache starts empty, and
+		# started before we time it, so we don't count forking the workers.
+
+		start = time.perf_counter()
+		result = parallel_catch_ambiguities(tokens, pool)
+		elapsed = time.perf_counter() - start
+		pool.close()
+		pool.join()
+
+		if result != new_catch_ambiguities(tokens):
+			print("The parallel version disagrees with the serial one!")
+			sys.exit(1)
+		if best is None or elapsed < best:
+			best = elapsed
+
+	print("parallel, " + str(workers) + " workers:     " + str(round(best, 4)) + " s (" + str(round(serialtime / best, 2)) + "x serial)")
+
+def old_bigrams():
+	'''DisambigTwograms.txt read the old way.'''
+	bigrams = dict()
+	with open(Context.rulepath + 'DisambigTwograms.txt', encoding = 'utf-8') as file:
+		for line in file:
+			line = line.rstrip()
+			fields = line.split('\t')
+			bigrams[fields[0]] = int(fields[1])
+	return bigrams
+
+def dict_lookups(bigrams, pairs):
+	for first, second in pairs:
+		bigrams.get(first + " " + second, 3)
+
+def store_lookups(store, pairs):
+	for first, second in pairs:
+		store.get(first, second, 3)
+
+def cold_store_lookups(store, pairs):
+	store.clear_rows()
+	store_lookups(store, pairs)
+
+def compare_bigrams(tokens):
+	tracemalloc.start()
+	bigrams = old_bigrams()
+	dictKB = tracemalloc.get_traced_memory()[0] // 1024
+	tracemalloc.stop()
+
+	tracemalloc.start()
+	store = BigramStore.load(Context.rulepath, 'DisambigTwograms.txt')
+	storeKB = tracemalloc.get_traced_memory()[0] // 1024
+	tracemalloc.stop()
+
+	words = [x.lower() for x in tokens if x != '\n' and not x.startswith('<')]
+	pairs = list(zip(words[0:-1], words[1:]))
+	for first, second in pairs:
+		if store.get(first, second, 3) != bigrams.get(first + " " + second, 3):
+			print("The bigram tables disagree about " + first + " " + second + "!")
+			sys.exit(1)
+
+	dicttime = best_time(dict_lookups, bigrams, pairs)
+	coldtime = best_time(cold_store_lookups, store, pairs)
+
+	store.clear_rows()
+	tracemalloc.start()
+	store_lookups(store, pairs)
+	rowsKB = tracemalloc.get_traced_memory()[0] // 1024
+	tracemalloc.stop()
+	storetime = best_time(store_lookups, store, pairs)
+
+	print(str(len(pairs)) + " bigram lookups:")
+	print("dictionary of strings:    " + str(round(dicttime, 4)) + " s, " + str(dictKB) + " KB")
+	print("BigramStore, rows cached: " + str(round(storetime, 4)) + " s, " + str(storeKB) + " KB of Python objects and " + str(rowsKB) + " KB of cached rows, plus " + str(len(store.data) // 1024) + " KB mapped from a file")
+	print("BigramStore, first time:  " + str(round(coldtime, 4)) + " s")
+
+def sample_volume():
+	rulepath = FileCabinet.loadpathdictionary()['volumerulepath']
+	vocab = SyntheticCorpus.load_vocabulary(rulepath)
+	return SyntheticCorpus.make_volume(random.Random(1), vocab, samplepages, True)
+
+def main():
+	if len(sys.argv) > 1:
+		pages = list()
+		for path in sys.argv[1:]:
+			pages.extend(read_volume(path))
+	else:
+		pages = sample_volume()
+
+	tokens, pre_matched, pre_english, pagedata, headerlist = NormalizeVolume.as_stream(pages)
+	corrected = NormalizeVolume.default_session.correct_volume(tokens).corrected
+
+	oldresult = old_catch_ambiguities(corrected)
+	newresult = new_catch_ambiguities(corrected)
+	if oldresult != newresult:
+		print("The two versions disagree! Not timing them.")
+		sys.exit(1)
+
+	triggers = len([x for x in corrected if x.lower().rstrip('.,?!;)') in Context.AmbiguousTriggers])
+	print(len(pages), "pages,", len(corrected), "tokens,", triggers, "possible long-s errors.")
+
+	oldtime = best_time(old_catch_ambiguities, corrected)
+	newtime = best_time(new_catch_ambiguities, corrected)
+
+	print("scanning AmbiguousPairs:  " + str(round(oldtime, 4)) + " s")
+	print("PairIndex, cached:        " + str(round(newtime, 4)) + " s")
+	print("speedup: " + str(round(oldtime / newtime, 2)) + "x")
+
+	hits, misses, size, maxsize = Context.cache_info()
+	print("disambiguation cache: " + str(hits) + " hits, " + str(misses) + " misses per volume (" + str(round(100 * hits / max(1, hits + misses), 1)) + "% hit rate)")
+
+	compare_parallel(corrected, newtime)
+
+	compare_bigrams(corrected)
+
+if __name__ == "__main__":
+	main()
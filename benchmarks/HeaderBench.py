@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+'''Microbenchmark for the line comparisons in HeaderFinder.
+
+	find_headers used to build a difflib.SequenceMatcher for every pair of
+	candidate lines within its two-page window and ask for the ratio. Now
+	it asks a LineMatcher, which rejects most pairs on the lengths of the
+	lines or the characters they share, builds one SequenceMatcher per line
+	rather than per pair, and remembers its decisions. This compares the two
+	on sample volumes from SyntheticCorpus.py, or on volumes you pass in.
+
+	Before timing anything it checks that the two reach the same decision
+	for every pair of lines find_headers compares, and for every pair of
+	candidate lines on pages up to ten apart (which are much more varied);
+	and that find_headers, iter_headers, and remove_headers in
+	/runningheaders give the same results with either.
+
+	Finally it measures what it costs to find footers (repeated lines near
+	the bottom of the page, signature marks and catchwords) in the same
+	pass as headers.
+
+	USAGE, from a directory containing PathDictionary.txt:
+
+	python3 HeaderBench.py [zipfile or txt file ...]
+'''
+
+import os, sys, random, copy, importlib.util
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(benchdir, '..', 'pagefeatures'))
+
+import FileCabinet
+import HeaderFinder
+from HeaderFinder import LineMatcher, RatioMatcher, select_lines
+from NormalizeVolume import romannumerals
+import SyntheticCorpus
+from TokenizerBench import read_volume, best_time
+
+samplevolumes = 4
+samplepages = 300
+
+def load_runningheaders():
+	'''The HeaderFinder in /runningheaders has the same name as ours, so we
+	load it from its path.'''
+	path = os.path.join(benchdir, '..', 'runningheaders', 'HeaderFinder.py')
+	spec = importlib.util.spec_from_file_location('RunningHeaderFinder', path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+def sample_volumes():
+	rulepath = FileCabinet.loadpathdictionary()['volumerulepath']
+	vocab = SyntheticCorpus.load_vocabulary(rulepath)
+	rng = random.Random(1)
+	volumes = list()
+	for i in range(samplevolumes):
+		volumes.append(SyntheticCorpus.make_volume(rng, vocab, samplepages, i % 2 == 1))
+	return volumes
+
+def check_pairs(volumes, distance):
+	'''Compares the two matchers on every pair of candidate lines from pages
+	up to distance apart. Returns the number of pairs and the number judged
+	similar.'''
+
+	ratio = RatioMatcher()
+	pairs = 0
+	similar = 0
+	for pages in volumes:
+		lines = [select_lines(page, romannumerals) for page in pages]
+		matcher = LineMatcher()
+		for index in range(len(lines)):
+			for j in range(max(0, index - distance), index):
+				for lineA in lines[index]:
+					for lineB in lines[j]:
+						expected = ratio.similar(lineA, lineB)
+						if matcher.similar(lineA, lineB) != expected:
+							print("The matchers disagree about " + repr(lineA) + " and " + repr(lineB) + "!")
+							sys.exit(1)
+						pairs += 1
+						if expected:
+							similar += 1
+	return pairs, similar
+
+def check_headers(volumes):
+	running = load_runningheaders()
+	for pages in volumes:
+		old = HeaderFinder.find_headers(pages, romannumerals, RatioMatcher())
+		new = HeaderFinder.find_headers(pages, romannumerals)
+		streamed = [headers for page, headers in HeaderFinder.iter_headers(pages, romannumerals)]
+		if len(pages) < 5:
+			streamed = []
+			# find_headers returns one empty list for short documents;
+			# iter_headers yields one for each page.
+		oldremoved = running.remove_headers(copy.deepcopy(pages), romannumerals, RatioMatcher())
+		newremoved = running.remove_headers(copy.deepcopy(pages), romannumerals)
+		if old != new or new != streamed or oldremoved != newremoved:
+			print("The header decisions differ! Not timing them.")
+			sys.exit(1)
+
+def find_all(volumes, matcherclass):
+	for pages in volumes:
+		HeaderFinder.find_headers(pages, romannumerals, matcherclass())
+
+def find_all_margins(volumes):
+	footers = 0
+	for pages in volumes:
+		footermap = HeaderFinder.HeaderMap()
+		HeaderFinder.find_headers(pages, romannumerals, footermap = footermap)
+		footers += sum([len(x) for x in footermap.pages])
+	return footers
+
+def main():
+	if len(sys.argv) > 1:
+		volumes = [read_volume(path) for path in sys.argv[1:]]
+	else:
+		volumes = sample_volumes()
+
+	check_headers(volumes)
+	pairs, similar = check_pairs(volumes, 2)
+	print(str(pairs) + " pairs in the window, " + str(similar) + " similar; both matchers agree on all of them.")
+	pairs, similar = check_pairs(volumes, 10)
+	print(str(pairs) + " pairs up to ten pages apart, " + str(similar) + " similar; both matchers agree on all of them.")
+
+	oldtime = best_time(find_all, volumes, RatioMatcher)
+	newtime = best_time(find_all, volumes, LineMatcher)
+
+	numpages = sum([len(x) for x in volumes])
+	print(str(len(volumes)) + " volumes, " + str(numpages) + " pages.")
+	print("SequenceMatcher per pair:  " + str(round(oldtime, 4)) + " s")
+	print("LineMatcher:               " + str(round(newtime, 4)) + " s")
+	print("speedup: " + str(round(oldtime / newtime, 2)) + "x")
+
+	footers = find_all_margins(volumes)
+	bothtime = best_time(find_all_margins, volumes)
+	print("LineMatcher, with footers: " + str(round(bothtime, 4)) + " s (" + str(footers) + " footer lines; " + str(round(100 * (bothtime - newtime) / newtime)) + "% more than headers alone)")
+
+if __name__ == "__main__":
+	main()
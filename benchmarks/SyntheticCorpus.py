@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+'''Generates a synthetic corpus of HathiTrust-style volumes for benchmarks.
+
+	Each volume is a zipfile of numbered page files (00000001.txt and so on,
+	inside a folder named for the volume, plus a notes.txt that the
+	normalizer skips), stored in a pairtree under the output directory,
+	just as volumes are stored on the cluster. A slice file listing the
+	volume IDs is written next to the pairtree.
+
+	The text is built from the rulesets, so it exercises the same code the
+	real collection does:
+
+	Running headers alternate between a verso header (page number, then the
+	title) and a recto header (the chapter, then the page number), with the
+	OCR occasionally mangling them the way it does in practice.
+
+	Words are drawn from the lexicon with Zipfian frequencies, mixed with
+	OCR errors from CorrectionRules.txt (weighted by how often each error
+	was observed), personal and place names, roman numerals and numbers.
+
+	Lines break with hyphens, both inside ordinary words and at the breaks
+	listed in HyphenRules.txt.
+
+	Some volumes are "long s" volumes, where most medial s's come out as
+	f's, and the f-forms of AmbiguousPairs.txt (fee for see, etc.) turn up.
+	Those are the volumes that the normalizer sends to Context.
+
+	Everything is seeded, so the same arguments always produce byte-for-byte
+	the same corpus, and benchmark results from different commits can be
+	compared.
+
+	USAGE, from a directory containing PathDictionary.txt:
+
+	python3 SyntheticCorpus.py outputdirectory [numberofvolumes] [seed]
+'''
+
+import os, sys, random
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pagefeatures'))
+
+import FileCabinet
+
+delim = '\t'
+defaultvolumes = 20
+defaultseed = 1
+longsfraction = 0.2
+# The fraction of volumes with a long-s problem.
+minpages = 20
+maxpages = 400
+
+commonwords = ['the', 'of', 'and', 'to', 'a', 'in', 'that', 'is', 'was', 'he', 'for', 'it', 'with', 'as', 'his', 'on', 'be', 'at', 'by', 'i', 'this', 'had', 'not', 'are', 'but', 'from', 'or', 'have', 'an', 'they', 'which', 'one', 'you', 'were', 'her', 'all', 'she', 'there', 'would', 'their', 'we', 'him', 'been', 'has', 'when', 'who', 'will', 'more', 'no', 'if', 'out', 'so', 'said', 'what', 'up', 'its', 'about', 'into', 'than', 'them', 'can', 'only', 'other', 'see', 'same', 'say', 'sea', 'sold', 'six', 'lost', 'sat']
+# Real text is dominated by these; the lexicon alone would look like a
+# dictionary read at random.
+
+titles = ['THE HISTORY OF ENGLAND', 'POEMS', 'THE LIFE OF JOHNSON', 'A TREATISE ON ELECTRICITY', 'THE ANTIQUARY', 'SERMONS', 'TRAVELS IN ARABIA', 'THE SPECTATOR']
+chapters = ['INTRODUCTION', 'PREFACE', 'CHAPTER', 'BOOK', 'CANTO', 'NOTES', 'ACT']
+punctuation = [',', ',', ',', '.', '.', ';', ':', '”', '—', '--', ',"', '!', '?', '_']
+
+# READING THE RULESETS.
+
+def read_column(path, column = 0, mincolumns = 1):
+	values = list()
+	with open(path, encoding = 'utf-8') as file:
+		for line in file:
+			fields = line.rstrip('\n').split(delim)
+			if len(fields) >= mincolumns and len(fields[column]) > 0:
+				values.append(fields)
+	return values
+
+def load_vocabulary(rulepath):
+	'''Reads what we need from the rulesets into a dictionary of lists.'''
+
+	vocab = dict()
+
+	rows = read_column(rulepath + 'MainDictionary.txt', mincolumns = 2)
+	words = sorted([x[0] for x in rows if x[0].isalpha() and x[0].islower()])
+	random.Random(0).shuffle(words)
+	vocab['lexicon'] = words
+	# Shuffled once with a fixed seed, so a word's rank doesn't depend on
+	# alphabetical order but is the same in every run.
+
+	errors = list()
+	errorweights = list()
+	for fields in read_column(rulepath + 'CorrectionRules.txt', mincolumns = 3):
+		if fields[0].isalpha() and fields[2].isdigit():
+			errors.append(fields[0])
+			errorweights.append(int(fields[2]))
+	vocab['errors'] = errors
+	vocab['errorweights'] = cumulative(errorweights)
+
+	hyphens = list()
+	for fields in read_column(rulepath + 'HyphenRules.txt', mincolumns = 2):
+		if '-' in fields[0]:
+			hyphens.append(fields[0].split('-', 1))
+	vocab['hyphens'] = hyphens
+
+	longs = list()
+	for fields in read_column(rulepath + 'AmbiguousPairs.txt', mincolumns = 2):
+		for word in fields[0:2]:
+			if word.startswith('f') and word.isalpha():
+				longs.append(word)
+	vocab['longs'] = longs
+	# The f-forms, like fee, that Context has to decide about.
+
+	vocab['names'] = [x[0] for x in read_column(rulepath + 'PersonalNames.txt')]
+	vocab['places'] = [x[0] for x in read_column(rulepath + 'PlaceNames.txt')]
+	vocab['romans'] = [x[0] for x in read_column(rulepath + 'romannumerals.txt')]
+
+	return vocab
+
+def cumulative(weights):
+	total = 0
+	cumulativeweights = list()
+	for weight in weights:
+		total += weight
+		cumulativeweights.append(total)
+	return cumulativeweights
+
+# GENERATING TEXT.
+
+def zipfian(rng, words):
+	'''Picks a word with probability roughly proportional to 1/rank.'''
+	return words[int(len(words) ** rng.random()) - 1]
+
+def long_s(word):
+	'''Turns medial and initial s's into f's, the way OCR reads a long s.
+	A final s was printed as a short s, so it stays.'''
+
+	if 's' not in word[0:-1]:
+		return word
+	return word[0:-1].replace('s', 'f') + word[-1]
+
+def make_word(rng, vocab, longsvolume):
+	r = rng.random()
+	if r < 0.45:
+		word = rng.choice(commonwords)
+	elif r < 0.85:
+		word = zipfian(rng, vocab['lexicon'])
+	elif r < 0.91:
+		word = rng.choices(vocab['errors'], cum_weights = vocab['errorweights'])[0]
+	elif r < 0.94:
+		word = rng.choice(vocab['names'])
+	elif r < 0.95:
+		word = rng.choice(vocab['places'])
+	elif r < 0.96:
+		word = rng.choice(vocab['romans'])
+	elif r < 0.97:
+		word = str(rng.randint(1, 1900))
+	elif longsvolume and len(vocab['longs']) > 0:
+		word = rng.choice(vocab['longs'])
+	else:
+		word = rng.choice(commonwords)
+
+	if longsvolume and rng.random() < 0.85:
+		word = long_s(word)
+
+	c = rng.random()
+	if c < 0.08:
+		word = word.title()
+	elif c < 0.1:
+		word = word.upper()
+
+	if rng.random() < 0.12:
+		word = word + rng.choice(punctuation)
+
+	return word
+
+def running_header(rng, pagenum, title, chapter):
+	if pagenum % 2 == 0:
+		header = str(pagenum) + '   ' + title + '.'
+	else:
+		header = chapter + '.   ' + str(pagenum)
+
+	if rng.random() < 0.05:
+		header = header.replace('I', 'l').replace('E', 'F')
+		# OCR noise, which is why HeaderFinder has to use fuzzy matching.
+
+	return header + '\n'
+
+def make_page(rng, vocab, pagenum, title, chapter, longsvolume):
+	lines = [running_header(rng, pagenum, title, chapter), '\n']
+
+	carry = ''
+	# The end of a word hyphenated on the line before.
+	for linenum in range(rng.randint(25, 40)):
+		line = list()
+		length = 0
+		if len(carry) > 0:
+			line.append(carry)
+			length = len(carry)
+			carry = ''
+		while length < 60:
+			word = make_word(rng, vocab, longsvolume)
+			line.append(word)
+			length += len(word) + 1
+
+		r = rng.random()
+		if r < 0.05 and len(vocab['hyphens']) > 0:
+			first, second = rng.choice(vocab['hyphens'])
+			line.append(first + '-')
+			carry = second
+		elif r < 0.15:
+			word = zipfian(rng, vocab['lexicon'])
+			if len(word) > 5:
+				line.append(word[0:len(word) // 2] + '-')
+				carry = word[len(word) // 2:]
+
+		lines.append(' '.join(line) + '\n')
+
+	if len(carry) > 0:
+		lines.append(carry + '\n')
+
+	if rng.random() < 0.3:
+		lines.append('\n')
+		lines.append(rng.choice(['B', 'C', 'D']) + ' ' + str(rng.randint(1, 9)) + '\n')
+		# A signature mark at the foot of the page.
+
+	return lines
+
+def make_volume(rng, vocab, numpages, longsvolume):
+	'''Returns a list of pages, each a list of lines.'''
+
+	title = rng.choice(titles)
+	chapter = rng.choice(chapters) + ' ' + rng.choice(vocab['romans']).upper()
+
+	pages = list()
+	for pagenum in range(1, numpages + 1):
+		if pagenum % 25 == 0:
+			chapter = rng.choice(chapters) + ' ' + rng.choice(vocab['romans']).upper()
+		pages.append(make_page(rng, vocab, pagenum, title, chapter, longsvolume))
+
+	return pages
+
+def volume_plan(rng, index):
+	'''The htid, length and kind of one volume.'''
+
+	htid = 'bench.' + str(100000 + index)
+	pages = int(minpages * (maxpages / minpages) ** rng.random())
+	# Log-uniform, because real volume lengths have a long tail.
+	longsvolume = rng.random() < longsfraction
+	return htid, pages, longsvolume
+
+def write_volume(path, postfix, pages):
+	with ZipFile(path, mode = 'w', compression = ZIP_DEFLATED) as zf:
+		for index, page in enumerate(pages):
+			member = postfix + '/' + str(index + 1).zfill(8) + '.txt'
+			zf.writestr(zip_member(member), ''.join(page).encode('utf-8'))
+		zf.writestr(zip_member(postfix + '/notes.txt'), b'Synthetic volume for benchmarks.\n')
+
+def zip_member(name):
+	'''A ZipInfo with a fixed timestamp; otherwise every zipfile we write
+	would differ from the last one.'''
+
+	info = ZipInfo(name, date_time = (2014, 1, 1, 0, 0, 0))
+	info.compress_type = ZIP_DEFLATED
+	return info
+
+def generate(outputdir, numvolumes = defaultvolumes, seed = defaultseed, rulepath = None):
+	'''Writes numvolumes volumes to a pairtree under outputdir, and returns
+	a list of (htid, zippath, numberofpages, longsvolume) tuples, which is
+	also written to outputdir/slice.txt (the htids) and
+	outputdir/volumes.tsv (everything).'''
+
+	if rulepath is None:
+		rulepath = FileCabinet.loadpathdictionary()['volumerulepath']
+
+	vocab = load_vocabulary(rulepath)
+	if not outputdir.endswith('/'):
+		outputdir = outputdir + '/'
+	datapath = outputdir + 'pairtree/'
+
+	volumes = list()
+	for index in range(numvolumes):
+		rng = random.Random(seed * 1000003 + index)
+		# Each volume has its own generator, so volume 5 is the same
+		# whether we generate 10 volumes or 100.
+		htid, numpages, longsvolume = volume_plan(rng, index)
+		pages = make_volume(rng, vocab, numpages, longsvolume)
+
+		path, postfix = FileCabinet.pairtreepath(htid, datapath)
+		os.makedirs(path + postfix, exist_ok = True)
+		zippath = path + postfix + '/' + postfix + '.zip'
+		write_volume(zippath, postfix, pages)
+		volumes.append((htid, zippath, numpages, longsvolume))
+
+	with open(outputdir + 'slice.txt', mode = 'w', encoding = 'utf-8') as file:
+		for htid, zippath, numpages, longsvolume in volumes:
+			file.write(htid + '\n')
+
+	with open(outputdir + 'volumes.tsv', mode = 'w', encoding = 'utf-8') as file:
+		file.write('htid\tpath\tpages\tlongs\n')
+		for htid, zippath, numpages, longsvolume in volumes:
+			file.write(htid + delim + zippath + delim + str(numpages) + delim + str(longsvolume) + '\n')
+
+	return volumes
+
+def main():
+	if len(sys.argv) < 2:
+		print("Usage: python3 SyntheticCorpus.py outputdirectory [numberofvolumes] [seed]")
+		sys.exit(1)
+
+	outputdir = sys.argv[1]
+	numvolumes = defaultvolumes
+	seed = defaultseed
+	if len(sys.argv) > 2:
+		numvolumes = int(sys.argv[2])
+	if len(sys.argv) > 3:
+		seed = int(sys.argv[3])
+
+	volumes = generate(outputdir, numvolumes, seed)
+	totalpages = sum([x[2] for x in volumes])
+	longscount = len([x for x in volumes if x[3]])
+	print("Wrote " + str(len(volumes)) + " volumes (" + str(totalpages) + " pages, " + str(longscount) + " long s) to " + outputdir)
+
+if __name__ == "__main__":
+	main()
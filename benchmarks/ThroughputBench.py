@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+'''Throughput benchmarks for the normalizing workflow.
+
+	Generates a synthetic corpus with SyntheticCorpus.py, then measures
+	volumes per second, tokens per second and peak memory for each stage of
+	the workflow, and for the workflow as a whole:
+
+	HeaderFinder.find_headers
+	NormalizeVolume.as_stream
+	NormalizeVolume.correct_stream
+	Context.catch_ambiguities
+	TokenGen.keep_hyphens + TypeIndex (the path typeindexer/SliceIndexer uses)
+	StreamingNormalizer.normalize_zip (reading, correcting and writing a volume)
+	MultiNormalizeOCR.process_a_file (only if the driver can be imported;
+		it reads its own paths when it's imported)
+
+	Each stage gets the output of the stage before as its input, prepared in
+	advance, so only that stage is timed. Tokens per second always counts the
+	raw tokens that as_stream produces for the volumes, so rates can be
+	compared across stages. Time is the best of several repeats; caches the
+	normalizer keeps between volumes are emptied before each repeat. Peak
+	memory is measured in a separate pass under tracemalloc (which slows
+	things down too much to time them at the same time), and is the most
+	memory that Python objects allocated by the stage occupied at any moment.
+
+	Results are appended to a tab-separated file, one row per stage, tagged
+	with the date, the git commit and the Python version. Running
+
+	python3 ThroughputBench.py compare [resultsfile]
+
+	prints the change in each stage between the last two runs recorded there,
+	so results from different commits can be compared.
+
+	USAGE, from a directory containing PathDictionary.txt:
+
+	python3 ThroughputBench.py [numberofvolumes] [resultsfile]
+
+	The corpus is written to a temporary directory and deleted afterward. The
+	default is 12 volumes, and results go to throughput.tsv in the current
+	directory.
+'''
+
+import os, sys, time, shutil, subprocess, tempfile, tracemalloc
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(benchdir, '..', 'pagefeatures'))
+sys.path.append(os.path.join(benchdir, '..', 'typeindexer'))
+
+import NormalizeVolume
+import Context
+import HeaderFinder
+import StreamingNormalizer
+import TokenGen
+import TypeIndex
+import SyntheticCorpus
+from VolumeReader import VolumeReader
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+delim = '\t'
+repeats = 3
+defaultvolumes = 12
+defaultresults = 'throughput.tsv'
+seed = SyntheticCorpus.defaultseed
+
+felecterrors = ['fee', 'fea', 'fay', 'fays', 'fame', 'fell', 'funk', 'fold', 'haft', 'fat', 'fix', 'chafe', 'loft']
+selecttruths = ['see', 'sea', 'say', 'says', 'same', 'sell', 'sunk', 'sold', 'hast', 'sat', 'six', 'chase', 'lost']
+# The same lists MultiNormalizeOCR uses to detect long s.
+meaningfulheaders = {"index", "introduction", "introductory", "preface", "contents", "glossary", "notes", "poems", "ode", "stanzas", "catalog", "books", "volumes", "tale", "chapter", "canto", "advertisement", "argument", "book", "scene", "act", "comedy", "tragedy", "plays"}
+metadata_evidence = {"drama": False, "poetry": False, "biography": False, "fiction": False}
+
+columns = ['date', 'commit', 'python', 'benchmark', 'volumes', 'pages', 'tokens', 'seconds', 'volumes/s', 'tokens/s', 'peakallocKB', 'maxrssKB']
+
+# PREPARING INPUTS.
+
+class Volume(object):
+	'''One synthetic volume, with the input each stage needs.'''
+
+	def __init__(self, htid, zippath, longsvolume):
+		self.htid = htid
+		self.zippath = zippath
+		self.longsvolume = longsvolume
+
+		with VolumeReader(zippath) as volume:
+			self.pagelist = list(volume)
+			# The same pages, in the same order, that MultiNormalizeOCR.read_zip
+			# would produce.
+
+		self.lines = list()
+		for page in self.pagelist:
+			self.lines.extend(page)
+
+		self.tokens, pre_matched, pre_english, pagedata, headerlist = NormalizeVolume.as_stream(self.pagelist)
+		self.corrected = NormalizeVolume.default_session.correct_volume(self.tokens).corrected
+
+def prepare(corpusdir, numvolumes):
+	volumes = list()
+	for htid, zippath, numpages, longsvolume in SyntheticCorpus.generate(corpusdir, numvolumes, seed):
+		volumes.append(Volume(htid, zippath, longsvolume))
+	return volumes
+
+# THE STAGES. Each one processes every volume once.
+
+def bench_find_headers(volumes, scratch):
+	for volume in volumes:
+		HeaderFinder.find_headers(volume.pagelist, NormalizeVolume.romannumerals)
+
+def bench_as_stream(volumes, scratch):
+	for volume in volumes:
+		NormalizeVolume.as_stream(volume.pagelist)
+
+def bench_correct_stream(volumes, scratch):
+	for volume in volumes:
+		NormalizeVolume.correct_stream(volume.tokens)
+
+def bench_catch_ambiguities(volumes, scratch):
+	for volume in volumes:
+		Context.catch_ambiguities(volume.corrected)
+
+def bench_typeindex(volumes, scratch):
+	bigindex = dict()
+	lexicon = NormalizeVolume.lexicon
+	for volume in volumes:
+		tokens = TokenGen.keep_hyphens(volume.lines, lexicon)
+		volacc = TypeIndex.GetAcc(tokens, lexicon)
+		types = TypeIndex.GetTypes(tokens)
+		TypeIndex.UpdateIndex(bigindex, types, volacc)
+	TypeIndex.SortIndex(bigindex)
+
+def bench_normalize_zip(volumes, scratch):
+	for volume in volumes:
+		normpath = os.path.join(scratch, volume.htid + '.norm.txt')
+		pgpath = os.path.join(scratch, volume.htid + '.pg.tsv')
+		StreamingNormalizer.normalize_zip(volume.zippath, normpath, pgpath, volume.htid, metadata_evidence, set(), meaningfulheaders, felecterrors, selecttruths)
+
+def load_driver(corpusdir):
+	'''Imports MultiNormalizeOCR and points it at the synthetic corpus, or
+	returns None if it can't be imported here. The driver reads paths from
+	its PathDictionary, and a vocabulary, as soon as it's imported.'''
+
+	savedargv = sys.argv
+	sys.argv = ['MultiNormalizeOCR.py', 'benchslice']
+	try:
+		import MultiNormalizeOCR
+	except (IOError, OSError, KeyError) as e:
+		print("Skipping MultiNormalizeOCR: can't import it here (" + str(e) + ")")
+		return None
+	finally:
+		sys.argv = savedargv
+
+	MultiNormalizeOCR.datapath = os.path.join(corpusdir, 'pairtree') + '/'
+	MultiNormalizeOCR.debug = False
+	return MultiNormalizeOCR
+
+def driver_bench(driver):
+	def bench_process_a_file(volumes, scratch):
+		for volume in volumes:
+			driver.process_a_file((volume.htid, metadata_evidence))
+	return bench_process_a_file
+
+# MEASURING.
+
+def reset_caches():
+	'''Empties caches the normalizer keeps from one volume to the next, so
+	each repeat starts cold.'''
+	NormalizeVolume.default_session.decision_cache().clear()
+	Context.clear_cache()
+
+def max_rss():
+	if resource is None:
+		return 0
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin':
+		peak = peak // 1024
+		# bytes on Mac OS, kilobytes on Linux
+	return peak
+
+def measure(function, volumes, scratch):
+	'''Returns the best time of several repeats, and the peak memory
+	allocated during one more.'''
+
+	best = None
+	for i in range(repeats):
+		reset_caches()
+		start = time.perf_counter()
+		function(volumes, scratch)
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+
+	reset_caches()
+	tracemalloc.start()
+	baseline = tracemalloc.get_traced_memory()[0]
+	function(volumes, scratch)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+
+	return best, (peak - baseline) // 1024
+
+def git_commit():
+	try:
+		output = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = benchdir, stderr = subprocess.DEVNULL)
+		commit = output.decode('utf-8').strip()
+		status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd = benchdir, stderr = subprocess.DEVNULL)
+		if len(status.strip()) > 0:
+			commit = commit + '+'
+			# Uncommitted changes.
+		return commit
+	except (OSError, subprocess.CalledProcessError):
+		return 'unknown'
+
+def write_results(path, rows):
+	newfile = not os.path.isfile(path)
+	with open(path, mode = 'a', encoding = 'utf-8') as file:
+		if newfile:
+			file.write(delim.join(columns) + '\n')
+		for row in rows:
+			file.write(delim.join(row) + '\n')
+
+def run(numvolumes, resultspath):
+	corpusdir = tempfile.mkdtemp(prefix = 'benchcorpus')
+	try:
+		print("Generating " + str(numvolumes) + " volumes ...")
+		volumes = prepare(corpusdir, numvolumes)
+		numpages = sum([len(x.pagelist) for x in volumes])
+		numtokens = sum([len(x.tokens) for x in volumes])
+		print(str(len(volumes)) + " volumes, " + str(numpages) + " pages, " + str(numtokens) + " tokens.")
+
+		benchmarks = [('HeaderFinder.find_headers', bench_find_headers), ('NormalizeVolume.as_stream', bench_as_stream), ('NormalizeVolume.correct_stream', bench_correct_stream), ('Context.catch_ambiguities', bench_catch_ambiguities), ('TokenGen/TypeIndex', bench_typeindex), ('StreamingNormalizer.normalize_zip', bench_normalize_zip)]
+
+		driver = load_driver(corpusdir)
+		if driver is not None:
+			benchmarks.append(('MultiNormalizeOCR.process_a_file', driver_bench(driver)))
+
+		date = time.strftime('%Y-%m-%d %H:%M:%S')
+		commit = git_commit()
+		python = '.'.join([str(x) for x in sys.version_info[0:3]])
+
+		rows = list()
+		scratch = os.path.join(corpusdir, 'output')
+		os.makedirs(scratch)
+
+		for name, function in benchmarks:
+			seconds, peakKB = measure(function, volumes, scratch)
+			row = [date, commit, python, name, str(len(volumes)), str(numpages), str(numtokens), str(round(seconds, 4)), str(round(len(volumes) / seconds, 3)), str(round(numtokens / seconds, 1)), str(peakKB), str(max_rss())]
+			rows.append(row)
+			print(name.ljust(36) + str(round(seconds, 3)).rjust(9) + ' s' + str(round(numtokens / seconds)).rjust(10) + ' tokens/s' + str(peakKB).rjust(9) + ' KB')
+
+		write_results(resultspath, rows)
+		print("Results appended to " + resultspath)
+
+	finally:
+		shutil.rmtree(corpusdir, ignore_errors = True)
+
+# COMPARING RUNS.
+
+def compare(resultspath):
+	'''Prints the change in tokens per second and peak memory for each
+	stage between the last two runs in resultspath.'''
+
+	runs = list()
+	byrun = dict()
+	with open(resultspath, encoding = 'utf-8') as file:
+		header = file.readline().rstrip('\n').split(delim)
+		for line in file:
+			fields = dict(zip(header, line.rstrip('\n').split(delim)))
+			run = (fields['date'], fields['commit'])
+			if run not in byrun:
+				byrun[run] = dict()
+				runs.append(run)
+			byrun[run][fields['benchmark']] = fields
+
+	if len(runs) < 2:
+		print("Need at least two runs in " + resultspath + " to compare.")
+		return
+
+	before, after = runs[-2], runs[-1]
+	print("Comparing " + before[1] + " (" + before[0] + ") to " + after[1] + " (" + after[0] + ")")
+	for name, new in byrun[after].items():
+		if name not in byrun[before]:
+			print(name.ljust(36) + "  (new)")
+			continue
+		old = byrun[before][name]
+		speed = float(new['tokens/s']) / float(old['tokens/s']) - 1
+		memory = int(new['peakallocKB']) - int(old['peakallocKB'])
+		print(name.ljust(36) + ' tokens/s ' + str(round(speed * 100, 1)).rjust(7) + '%   peak alloc ' + str(memory).rjust(8) + ' KB')
+
+def main():
+	if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+		if len(sys.argv) > 2:
+			compare(sys.argv[2])
+		else:
+			compare(defaultresults)
+		return
+
+	numvolumes = defaultvolumes
+	resultspath = defaultresults
+	if len(sys.argv) > 1:
+		numvolumes = int(sys.argv[1])
+	if len(sys.argv) > 2:
+		resultspath = sys.argv[2]
+
+	run(numvolumes, resultspath)
+
+if __name__ == "__main__":
+	main()
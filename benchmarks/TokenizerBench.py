@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+'''Microbenchmark for the tokenizer in NormalizeVolume.
+
+	Compares the old tokenizer in as_stream (which split every line, then
+	made a second pass over all the tokens to count pre-correction matches)
+	with Tokenizer, which counts matches as it splits each batch of lines
+	and remembers how it classified tokens it has seen before. It checks that
+	both produce the same tokens and the same statistics before timing
+	anything.
+
+	We also tried doing all the splitting with a single compiled regex
+	(',,|,(?=\D)|--|[”:;—_]' with a replacement function). It's correct,
+	but on CPython 3.11 it is slower than the chain of str.replace calls,
+	which run in C; the Python-level callback for each match costs more than
+	the extra passes over the line save. So the replace chain stays, with
+	the comma regex compiled once.
+
+	USAGE, from a directory containing PathDictionary.txt:
+
+	python3 TokenizerBench.py [zipfile or txt file ...]
+
+	With no arguments it builds sample pages of HathiTrust-style text from
+	the lexicon. Otherwise it reads pages from the volumes given; a .txt file
+	is split on <pb> lines, as in MultiNormalizeOCR.read_txt.
+'''
+
+import os, sys, time, random, re
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pagefeatures'))
+
+import NormalizeVolume
+from VolumeReader import VolumeReader
+from NormalizeVolume import commasplit, mosteraser, mostly_numeric
+
+repeats = 15
+samplepages = 400
+
+# THE OLD CODE, as it was in as_stream.
+
+def old_tokenize(linelist):
+	tokens = list()
+	for line in linelist:
+		if len(line) < 1:
+			continue
+		if line == "\n":
+			tokens.append(line)
+			continue
+		line = line.rstrip()
+		if line == "<pb>":
+			tokens.append(line)
+			tokens.append('\n')
+			continue
+
+		line = line.replace('”', '” ')
+		line = line.replace(':', ': ')
+		line = line.replace(';', '; ')
+		line = re.sub(',\D', commasplit, line)
+		line = line.replace('—', ' — ')
+		line = line.replace('--', ' -- ')
+		line = line.replace('_', ' ')
+
+		lineparts = line.split()
+		tokens.extend(lineparts)
+		tokens.append('\n')
+
+	return tokens
+
+def old_count(tokens, lexicon):
+	counter = 0
+	englishcounter = 0
+	allcounter = 0
+	tokencount = len(tokens)
+
+	for i in range(0, tokencount):
+		token = tokens[i].lower()
+		if token in lexicon:
+			counter += 1
+			allcounter += 1
+			if lexicon[token] > 0:
+				englishcounter += 1
+		elif token == '\n' or token.startswith('<') or mostly_numeric(token):
+			pass
+		elif i < (tokencount-1):
+			token = token.translate(mosteraser)
+			if token in lexicon:
+				counter += 1
+				allcounter += 1
+				if lexicon[token] > 0:
+					englishcounter += 1
+			else:
+				nexttoken = tokens[i+1].lower()
+				fused = token + nexttoken.translate(mosteraser)
+				if fused in lexicon:
+					counter += 1
+					allcounter += 1
+					if lexicon[fused] > 0:
+						englishcounter += 1
+				else:
+					allcounter += 1
+		else:
+			allcounter += 1
+
+	return counter, englishcounter, allcounter
+
+def new_tokenize(linelist, lexicon):
+	tokens = list()
+	tokenizer = NormalizeVolume.Tokenizer(lexicon)
+	tokenizer.add_lines(linelist, tokens)
+	tokenizer.finish()
+
+	return tokens, (tokenizer.counter, tokenizer.englishcounter, tokenizer.allcounter)
+
+# SAMPLE PAGES.
+
+def sample_pages(lexicon, numpages):
+	'''Makes pages that look roughly like HathiTrust OCR: a running header,
+	lines of about sixty characters with scattered punctuation, hyphens at
+	line ends, numbers, and some OCR junk.'''
+
+	random.seed(1)
+	words = sorted([x for x in lexicon if x.isalpha()])
+	if len(words) < 1:
+		words = ['the', 'of', 'and', 'to', 'same', 'said']
+	random.shuffle(words)
+	# Word frequencies in real text are Zipfian, which matters a great deal
+	# to anything that caches. Picking rank log-uniformly gives each word a
+	# probability proportional to 1/rank.
+	punctuation = [',', ',', ',', '.', ';', ':', '”', '—', '--', ',"', '!', '?', '_']
+
+	pages = list()
+	for pagenum in range(numpages):
+		page = ['THE HISTORY OF ENGLAND. ' + str(pagenum + 1) + '\n', '\n']
+		for linenum in range(35):
+			line = list()
+			length = 0
+			while length < 60:
+				word = words[int(len(words) ** random.random()) - 1]
+				if random.random() < 0.08:
+					word = word.title()
+				if random.random() < 0.02:
+					word = str(random.randint(1, 2000)) + random.choice([',000', ',', ''])
+				if random.random() < 0.01:
+					word = word[0:2] + '^' + word[2:]
+				if random.random() < 0.12:
+					word = word + random.choice(punctuation)
+				line.append(word)
+				length += len(word) + 1
+			if random.random() < 0.15:
+				line[-1] = line[-1][0:len(line[-1]) // 2] + '-'
+			page.append(' '.join(line) + '\n')
+		pages.append(page)
+
+	return pages
+
+def read_volume(path):
+	pages = list()
+	if path.endswith('.zip'):
+		with VolumeReader(path) as volume:
+			pages = list(volume)
+	else:
+		with open(path, encoding = 'utf-8') as f:
+			page = list()
+			for line in f:
+				if line.startswith('<pb>'):
+					pages.append(page)
+					page = list()
+				else:
+					page.append(line)
+			pages.append(page)
+	return pages
+
+def best_time(function, *args):
+	best = None
+	for i in range(repeats):
+		start = time.perf_counter()
+		function(*args)
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+def main():
+	lexicon = NormalizeVolume.lexicon
+
+	if len(sys.argv) > 1:
+		pages = list()
+		for path in sys.argv[1:]:
+			pages.extend(read_volume(path))
+	else:
+		pages = sample_pages(lexicon, samplepages)
+
+	linelist = list()
+	for index, page in enumerate(pages):
+		if index > 0:
+			linelist.append('<pb>')
+		linelist.extend(page)
+
+	oldtokens = old_tokenize(linelist)
+	oldstats = old_count(oldtokens, lexicon)
+	newtokens, newstats = new_tokenize(linelist, lexicon)
+
+	if oldtokens != newtokens or oldstats != newstats:
+		print("The tokenizers disagree! Not timing them.")
+		print("old:", len(oldtokens), oldstats)
+		print("new:", len(newtokens), newstats)
+		sys.exit(1)
+
+	print(len(pages), "pages,", len(linelist), "lines,", len(oldtokens), "tokens.")
+
+	oldsplit = best_time(old_tokenize, linelist)
+	oldboth = best_time(lambda: old_count(old_tokenize(linelist), lexicon))
+	newboth = best_time(new_tokenize, linelist, lexicon)
+
+	print("old tokenizer alone:     " + str(round(oldsplit, 4)) + " s")
+	print("old tokenizer + count:   " + str(round(oldboth, 4)) + " s")
+	print("Tokenizer (one pass):    " + str(round(newboth, 4)) + " s")
+	print("speedup: " + str(round(oldboth / newboth, 2)) + "x")
+
+if __name__ == "__main__":
+	main()
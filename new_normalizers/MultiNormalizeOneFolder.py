@@ -11,6 +11,7 @@ def main():
     import sys, os
     from multiprocessing import Pool
     import MultiNormalizeProcess
+    import RuleSnapshot
     args = sys.argv
 
     inputfolder = args[1]
@@ -46,7 +47,8 @@ def main():
 
     pathpairs = list(zip(inpaths, outpaths, list(range(len(inpaths)))))
 
-    pool = Pool(processes = 12)
+    pool = RuleSnapshot.shared_pool(12)
+    # NormalizeVolume is already loaded, so workers inherit its rules.
     res = pool.map_async(MultiNormalizeProcess.processvolume, pathpairs)
     res.wait()
     resultlist = res.get()
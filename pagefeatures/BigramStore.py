@@ -0,0 +1,275 @@
+# BigramStore.py
+#
+# A compact, read-only table of bigram counts, like the one Context uses to
+# decide between long-s readings. Context used to keep DisambigTwograms.txt
+# in a dictionary with keys like "the same", which is one of the largest
+# structures in every worker: a string object, an int object and a dict slot
+# for every bigram. And every lookup had to build a new key string.
+#
+# Here each distinct word gets an integer id (its position in a sorted
+# vocabulary). The bigrams are sorted by (first id, second id) and stored
+# as three flat arrays:
+#
+# starts  -- for each first word, where its bigrams begin in the arrays
+#            below (one extra entry marks the end of the last word's)
+# seconds -- the id of the second word of each bigram
+# counts  -- the count for each bigram
+#
+# so a lookup finds the row for the first word and does a binary search
+# among that word's second words. Only the vocabulary becomes Python
+# objects; the arrays are read straight from a binary file that's mapped
+# into memory, so every worker on a node shares one copy in the page cache,
+# whether or not it was forked from a parent that loaded the rules.
+#
+# A binary search through a memoryview costs more than the dictionary lookup
+# it replaced, though. Context keeps asking about the same few first words
+# (the ambiguous words themselves, and common words like "the" before them),
+# so each store also keeps a dictionary of second words and counts for the
+# rows it has read, up to ROWCACHE bigrams in all. Lookups in those rows are
+# two dictionary probes and no string building, which is faster than the old
+# dictionary; rows that don't fit fall back to the binary search.
+#
+# The binary file is compiled from the text file the first time it's needed,
+# and lives next to it. Like the snapshots in RuleSnapshot, it records a hash
+# of its source, and is rebuilt whenever the source changes.
+#
+# USAGE:
+# bigrams = BigramStore.load(rulepath, 'DisambigTwograms.txt')
+# count = bigrams.get('the', 'same', 3)
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+
+import RuleSnapshot
+
+STOREFORMAT = 1
+MAGIC = b'BIGRAMS\0'
+HEADER = struct.Struct('<8sII40s8sQQQ')
+# magic, format, header size, sha1 of the source file, byte order,
+# number of words, bytes of vocabulary, number of bigrams
+
+delim = '\t'
+
+ROWCACHE = 100000
+# The most bigrams a store will copy into dictionaries of cached rows. Rows
+# are cached the first time they're read, as long as they fit, so the budget
+# goes to the words Context asks about first, which are mostly the common
+# ones.
+
+def store_path(rulepath, filename):
+    return rulepath + filename.rsplit('.', 1)[0] + '.bigrams'
+
+def padding(length):
+    '''Bytes needed to bring length to a multiple of eight, so the arrays
+    that follow are aligned.'''
+    return (8 - length % 8) % 8
+
+def parse_bigrams(path):
+    '''Reads a tab-separated file of "word1 word2" and a count, and returns
+    a dictionary mapping (word1, word2) to the count. If a pair occurs twice,
+    the later count wins, as it did when this was a dictionary of strings.'''
+
+    bigrams = dict()
+    with open(path, encoding = 'utf-8') as file:
+        for line in file:
+            line = line.rstrip()
+            fields = line.split(delim)
+            words = fields[0].split(' ', 1)
+            if len(words) < 2:
+                continue
+                # No lookup of two words could ever match this key.
+            bigrams[(words[0], words[1])] = int(fields[1])
+
+    return bigrams
+
+def compile_store(bigrams, sourcehash):
+    '''Returns the bytes of a store holding bigrams, a dictionary mapping
+    (word1, word2) to a count.'''
+
+    vocabulary = set()
+    for first, second in bigrams:
+        vocabulary.add(first)
+        vocabulary.add(second)
+    vocabulary = sorted(vocabulary)
+    wordids = dict()
+    for index, word in enumerate(vocabulary):
+        wordids[word] = index
+
+    rows = sorted([(wordids[first], wordids[second], count) for (first, second), count in bigrams.items()])
+
+    starts = array('Q', [0] * (len(vocabulary) + 1))
+    seconds = array('I')
+    counts = array('q')
+    for firstid, secondid, count in rows:
+        starts[firstid + 1] += 1
+        seconds.append(secondid)
+        counts.append(count)
+    for index in range(len(vocabulary)):
+        starts[index + 1] += starts[index]
+
+    vocabbytes = '\n'.join(vocabulary).encode('utf-8')
+    header = HEADER.pack(MAGIC, STOREFORMAT, HEADER.size, sourcehash.encode('ascii'), sys.byteorder.encode('ascii').ljust(8, b'\0'), len(vocabulary), len(vocabbytes), len(rows))
+
+    parts = [header, vocabbytes, b'\0' * padding(HEADER.size + len(vocabbytes))]
+    for table in [starts, seconds]:
+        tablebytes = table.tobytes()
+        parts.append(tablebytes)
+        parts.append(b'\0' * padding(len(tablebytes)))
+    parts.append(counts.tobytes())
+
+    return b''.join(parts)
+
+def write_store(path, data):
+    '''Writes to a temporary file and renames it into place, as
+    RuleSnapshot.write_snapshot does. Failure isn't fatal; the caller can
+    still use the bytes it compiled.'''
+
+    temppath = path + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(temppath, mode = 'wb') as f:
+            f.write(data)
+        os.replace(temppath, path)
+    except (IOError, OSError) as e:
+        print("Could not write bigram store " + path + ": " + str(e))
+        if os.path.exists(temppath):
+            os.remove(temppath)
+        return False
+
+    return True
+
+def map_store(path):
+    '''Returns the contents of the store at path, mapped into memory, or
+    None if there's no file there.'''
+
+    try:
+        with open(path, mode = 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+        # ValueError is what mmap raises for an empty file.
+
+class BigramStore(object):
+    '''Read-only access to a compiled store, which may be an mmap or a bytes
+    object.'''
+
+    def __init__(self, data):
+        self.data = data
+        view = memoryview(data)
+
+        magic, storeformat, headersize, sourcehash, byteorder, numwords, vocablength, numbigrams = HEADER.unpack_from(view, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a bigram store.')
+        self.sourcehash = sourcehash.decode('ascii')
+        self.byteorder = byteorder.rstrip(b'\0').decode('ascii')
+        self.storeformat = storeformat
+
+        offset = headersize
+        vocabbytes = bytes(view[offset: offset + vocablength])
+        offset += vocablength + padding(offset + vocablength)
+
+        if numwords > 0:
+            vocabulary = vocabbytes.decode('utf-8').split('\n')
+        else:
+            vocabulary = []
+        self.vocabulary = vocabulary
+        self.wordids = dict()
+        for index, word in enumerate(vocabulary):
+            self.wordids[word] = index
+
+        length = (numwords + 1) * 8
+        self.starts = view[offset: offset + length].cast('Q')
+        offset += length + padding(length)
+
+        length = numbigrams * 4
+        self.seconds = view[offset: offset + length].cast('I')
+        offset += length + padding(length)
+
+        self.counts = view[offset: offset + numbigrams * 8].cast('q')
+
+        self.clear_rows()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def get(self, first, second, default = None):
+        '''The count for the bigram "first second", or default.'''
+
+        row = self.rows.get(first)
+        if row is not None:
+            return row.get(second, default)
+
+        if ' ' in first:
+            first, second = (first + ' ' + second).split(' ', 1)
+            # The store splits keys at their first space, so a lookup has to
+            # do the same to find what the old string key would have found.
+
+        firstid = self.wordids.get(first)
+        if firstid is None:
+            return default
+
+        lo = self.starts[firstid]
+        hi = self.starts[firstid + 1]
+        if lo == hi:
+            return default
+            # A word that only ever comes second.
+        if hi - lo <= self.rowbudget:
+            row = self.cache_row(first, lo, hi)
+            return row.get(second, default)
+
+        secondid = self.wordids.get(second)
+        if secondid is None:
+            return default
+
+        index = bisect_left(self.seconds, secondid, lo, hi)
+        if index < hi and self.seconds[index] == secondid:
+            return self.counts[index]
+        return default
+
+    def clear_rows(self):
+        self.rows = dict()
+        self.rowbudget = ROWCACHE
+
+    def cache_row(self, first, lo, hi):
+        '''Copies the bigrams starting with first (rows lo to hi of the
+        arrays) into a dictionary of second words and counts, and keeps it.'''
+
+        vocabulary = self.vocabulary
+        row = dict(zip([vocabulary[x] for x in self.seconds[lo: hi]], self.counts[lo: hi]))
+        self.rows[first] = row
+        self.rowbudget -= hi - lo
+        return row
+
+def is_current(store, sourcehash):
+    return store.storeformat == STOREFORMAT and store.sourcehash == sourcehash and store.byteorder == sys.byteorder
+
+def load(rulepath, filename):
+    '''Returns a BigramStore for the bigram file rulepath + filename, mapping
+    the compiled store if it's current, and otherwise compiling it (and
+    trying to save it for next time).'''
+
+    sourcehash = RuleSnapshot.hash_sources(rulepath, [filename])[filename]
+    path = store_path(rulepath, filename)
+
+    if not RuleSnapshot.rebuild:
+        data = map_store(path)
+        if data is not None:
+            try:
+                store = BigramStore(data)
+                if is_current(store, sourcehash):
+                    return store
+            except (struct.error, ValueError, TypeError, UnicodeDecodeError):
+                pass
+                # A damaged or foreign file; we just rebuild it.
+
+    data = compile_store(parse_bigrams(rulepath + filename), sourcehash)
+    if write_store(path, data):
+        mapped = map_store(path)
+        if mapped is not None:
+            data = mapped
+            # Prefer the mapped file, which other processes share.
+
+    return BigramStore(data)
@@ -10,7 +10,12 @@
 
 # IMPORTS.
 
+from functools import lru_cache
+
+import BigramStore
 import FileCabinet
+import RuleSnapshot
+from LongSEvidence import LongSCounter
 
 pathdictionary = FileCabinet.loadpathdictionary()
 rulepath = pathdictionary['contextrulepath']
@@ -24,61 +29,92 @@ punctuationset = {'.', ',', '?', '!', ';', ')'}
 flipslipper = ['flip', 'flips', 'flipped', 'flipping', 'flay', 'flays', 'flayed', "flay'd"]
 # The triadic problems flip - slip - ship and flay - slay - stay require special treatment.                                          ')
 
-felecterrors = ['fee', 'fea', 'fay', 'fays', 'fame', 'fell', 'funk', 'fold', 'haft', 'fat', 'fix', 'chafe', 'loft']
-selecttruths = ['see', 'sea', 'say', 'says', 'same', 'sell', 'sunk', 'sold', 'hast', 'sat', 'six', 'chase', 'lost']
-# Of course, either set could be valid. But I expect the second to be more common.
-# The comparison is used as a test.
+DISAMBIGUATIONCACHESIZE = 100000
+# The number of disambiguation results each worker remembers, across all the
+# volumes it handles. Long-s volumes repeat the same phrases ("the fame
+# time") over and over, so most lookups hit.
+
+PAGESPERCHUNK = 50
+# How many pages split_chunks puts in each chunk.
+
+# The words that test for long s are LongSCounter's defaults, from
+# LongSEvidence.
 
 # RULESETS.
-            
-Context = {}
-FileString = rulepath + 'DisambigTwograms.txt'
-with open(FileString, encoding='utf=8') as file:
-    filelines = file.readlines()
-
-for line in filelines:
-    line = line.rstrip()
-    LineParts = line.split(delim)
-    Context[LineParts[0]] = int(LineParts[1])
-
-del filelines
-
-AmbiguousPairs = []
-AmbiguousTriggers = set()
-FileString = rulepath + 'AmbiguousPairs.txt'
-
-with open(FileString, mode='r', encoding='utf-8') as file:
-    FileLines = file.readlines()
-
-for Line in FileLines:
-    Line = Line.rstrip()
-    LineParts = Line.split(delim)
-    LineTuple = (LineParts[0], LineParts[1])
-    AmbiguousPairs.append(LineTuple)
-    for i in range(0,2):
-        if "f" in LineParts[i]:
-            AmbiguousTriggers.add(LineParts[i])
-        # We only add the words that contain "f" to the set that triggers
-        # an investigation. Their "s" equivalents will be in AmbiguousPairs
-        # but not the AmbiguousTriggers set. After all, we never correct
-        # from the "s" version to the "f" version.
-
-del FileLines
-AmbiguousTriggers.add('fad')
-
-# The word 'fad' doesn't exist before 1825, and I'm only running this script on early texts.
-
-with open(rulepath + 'logvalues.tsv', encoding='utf-8') as file:
-    filelines = file.readlines()
-
-logvals = dict()
-for line in filelines:
-    line = line.rstrip()
-    parts = line.split(delim)
-    logvals[parts[0]] = float(parts[1])
-
-# The purpose of the logvalues file is to give me some Bayesian guidance on the frequency of
-# words.
+
+contextrulefiles = ['AmbiguousPairs.txt', 'logvalues.tsv']
+# DisambigTwograms.txt isn't in the snapshot; it's compiled into a
+# BigramStore, which has its own binary file.
+
+def parse_rulesets(rulepath):
+    '''Reads the contextual rulesets in rulepath and returns them as a
+    dictionary of tables. Normally the tables come from a snapshot compiled
+    by RuleSnapshot instead.'''
+
+    AmbiguousPairs = []
+    AmbiguousTriggers = set()
+    FileString = rulepath + 'AmbiguousPairs.txt'
+
+    with open(FileString, mode='r', encoding='utf-8') as file:
+        FileLines = file.readlines()
+
+    for Line in FileLines:
+        Line = Line.rstrip()
+        LineParts = Line.split(delim)
+        LineTuple = (LineParts[0], LineParts[1])
+        AmbiguousPairs.append(LineTuple)
+        for i in range(0,2):
+            if "f" in LineParts[i]:
+                AmbiguousTriggers.add(LineParts[i])
+            # We only add the words that contain "f" to the set that triggers
+            # an investigation. Their "s" equivalents will be in AmbiguousPairs
+            # but not the AmbiguousTriggers set. After all, we never correct
+            # from the "s" version to the "f" version.
+
+    del FileLines
+    AmbiguousTriggers.add('fad')
+
+    PairIndex = dict()
+    for Pair in AmbiguousPairs:
+        for word in Pair:
+            if word not in PairIndex:
+                PairIndex[word] = Pair
+    # Maps each word in AmbiguousPairs to the first pair that contains it,
+    # so catch_ambiguities can find a trigger's pair without scanning the
+    # whole list. (A few words, like 'stayed', occur in two pairs; the
+    # scan always stopped at the first one.)
+
+    # The word 'fad' doesn't exist before 1825, and I'm only running this script on early texts.
+
+    with open(rulepath + 'logvalues.tsv', encoding='utf-8') as file:
+        filelines = file.readlines()
+
+    logvals = dict()
+    for line in filelines:
+        line = line.rstrip()
+        parts = line.split(delim)
+        logvals[parts[0]] = float(parts[1])
+
+    # The purpose of the logvalues file is to give me some Bayesian guidance on the frequency of
+    # words.
+
+    tables = dict()
+    tables['AmbiguousPairs'] = AmbiguousPairs
+    tables['AmbiguousTriggers'] = AmbiguousTriggers
+    tables['PairIndex'] = PairIndex
+    tables['logvals'] = logvals
+    return tables
+
+rules = RuleSnapshot.load_rules('Context', rulepath, contextrulefiles, parse_rulesets, version = 3)
+# Version 2 added PairIndex. Version 3 moved the bigrams to a BigramStore.
+
+Context = BigramStore.load(rulepath, 'DisambigTwograms.txt')
+# Counts of bigrams, looked up with Context.get(word1, word2, default).
+AmbiguousPairs = rules['AmbiguousPairs']
+AmbiguousTriggers = rules['AmbiguousTriggers']
+PairIndex = rules['PairIndex']
+logvals = rules['logvals']
+del rules
 
 # Functions
 
@@ -89,8 +125,12 @@ def add_or_inc (token, adict):
         adict[token] = 1
     return adict
 
+@lru_cache(maxsize = DISAMBIGUATIONCACHESIZE)
 def disambiguate(preceded, token, followed, pair):
-    """Determine which of two candidates better fits context."""
+    """Determine which of two candidates better fits context.
+    Results are cached, keyed by all four arguments; the rules never change
+    after import, so the same words in the same context always get the same
+    answer. The recursive call for flipslipper words is cached too."""
     global Context, flipslipper, logvals
     
     Jekyll, Hyde = pair
@@ -142,18 +182,18 @@ def disambiguate(preceded, token, followed, pair):
         BeforeJ = DefaultJekyll
         BeforeH = DefaultHyde
     else:
-        BeforeJ = Context.get(preceded + " " + Jekyll, DefaultJekyll)
-        BeforeH = Context.get(preceded + " " + Hyde, DefaultHyde)
+        BeforeJ = Context.get(preceded, Jekyll, DefaultJekyll)
+        BeforeH = Context.get(preceded, Hyde, DefaultHyde)
 
-    # Context.get is a nice Pythonic trick that gets the value if
-    # there is one, but otherwise returns the default arg of 3.
+    # Context.get gets the count of the bigram if there is one, but
+    # otherwise returns the default arg of 3.
 
     if followed == "#nought":
         AfterJ = DefaultJekyll
         AfterH = DefaultHyde
     else:
-        AfterJ = Context.get(Jekyll + " " + followed, DefaultJekyll)
-        AfterH = Context.get(Hyde + " " + followed, DefaultHyde)
+        AfterJ = Context.get(Jekyll, followed, DefaultJekyll)
+        AfterH = Context.get(Hyde, followed, DefaultHyde)
 
     # Here's the magnificently complex algorithm for evaluating the probability of
     # two different three-word sequences.
@@ -174,15 +214,28 @@ def disambiguate(preceded, token, followed, pair):
         return "", HProb
 
 
+def cache_info():
+    '''Hits, misses, current size and maximum size of the disambiguation
+    cache.'''
+    info = disambiguate.cache_info()
+    return info.hits, info.misses, info.currsize, info.maxsize
+
+def clear_cache():
+    disambiguate.cache_clear()
+
 def as_stream(linelist, verbose = False):
     '''converts a list of lines to a list of tokens
     this is considerably simpler than the version of this function
     in Volume.py. It also tests to see whether this file needs long-s correction.
     '''
     
-    global breakselected, felecterrors, selecttruths
+    global breakselected
     
     tokens = list()
+    longs = LongSCounter()
+    # Counts the words that test for long s as we go, rather than scanning
+    # the whole list again for each of them afterward.
+
     for line in linelist:
         line = line.rstrip()
         if len(line) < 1:
@@ -225,37 +278,37 @@ def as_stream(linelist, verbose = False):
         lineparts = line.split()
         tokens.extend(lineparts)
         tokens.append('\n')
+        longs.add_tokens(lineparts)
 
     # Now we have a list of tokens. Let's see if it needs long-s correction.
-    errors = 1
-    truths = 1
-    # 1 = Laplacian correction.
-    for word in felecterrors:
-        errors = errors + tokens.count(word)
-    for word in selecttruths:
-        truths = truths + tokens.count(word)
-
-    print(truths/errors)
-
-    if truths > errors:
-        LongSproblem = False
-    else:
-        LongSproblem = True
+
+    print(longs.ratio())
+
+    LongSproblem = longs.long_s_problem()
 
     return tokens, LongSproblem
 
 def catch_ambiguities(tokenlist, verbose = False):
-    global AmbiguousPairs, AmbiguousTriggers, punctuationset
-    
-    deletions = {}
-    additions = {}
-    corrected = []
-    changedphrases = []
-    unchanged = {}
+    '''Corrects ambiguous long-s words in tokenlist, using the words on either
+    side. Returns dictionaries of deletions and additions for the volume as a
+    whole, the corrected tokens, a list of changed phrases (if verbose), and
+    a dictionary of words that were considered but left alone.'''
+
+    tokenlist = separate_punctuation(tokenlist)
+    deletions, additions, corrected, changedphrases, unchanged = correct_window(tokenlist, 0, len(tokenlist), 0, len(tokenlist), 0, verbose)
+
+    if verbose:
+        hits, misses, size, maxsize = cache_info()
+        print('Disambiguation cache:', hits, 'hits,', misses, 'misses,', size, 'of', maxsize, 'entries.')
+                
+    return deletions, additions, corrected, changedphrases, unchanged
 
-    # pre-processing is necessary in this version of Context, because the incoming
-    # tokenstream still fuses punctuation marks with words, but the body of
-    # catch_ambiguities assumes they are separate list elements
+def separate_punctuation(tokenlist):
+    '''pre-processing is necessary in this version of Context, because the incoming
+    tokenstream still fuses punctuation marks with words, but the body of
+    catch_ambiguities assumes they are separate list elements'''
+
+    global punctuationset
 
     separatedlist = list()
 
@@ -271,10 +324,32 @@ def catch_ambiguities(tokenlist, verbose = False):
         else:
             separatedlist.append(token)
 
-    del tokenlist
-    tokenlist = separatedlist
+    return separatedlist
+
+def correct_window(tokenlist, start, end, offset, total, emitted, verbose = False):
+    '''The body of catch_ambiguities. Corrects tokenlist[start:end], where
+    tokenlist is a window that begins at position offset in a volume of
+    total (separated) tokens; the window has to reach two tokens beyond
+    start and end on either side, where the volume has them, because that's
+    how far we look for context. Emitted is 1 if any corrected token has
+    been produced before start, 0 if not.
 
-    for indexnum, origtoken in enumerate(tokenlist):
+    catch_ambiguities passes the whole volume as one window. In the chunks
+    from split_chunks, every window after the first starts with a
+    <pb>, which is always kept, so nothing in it can attach to a token from
+    the window before.'''
+
+    global PairIndex, AmbiguousTriggers, punctuationset
+
+    deletions = {}
+    additions = {}
+    corrected = []
+    changedphrases = []
+    unchanged = {}
+
+    for indexnum in range(start - offset, end - offset):
+        origtoken = tokenlist[indexnum]
+        position = indexnum + offset
         # TEI markup and single characters, including newline characters, should
         # pass through unchanged, except for punctuation characters, which get magnetically
         # attracted to the previous word.
@@ -283,7 +358,7 @@ def catch_ambiguities(tokenlist, verbose = False):
             corrected.append(origtoken)
             continue
 
-        if origtoken in punctuationset and len(corrected) > 1:
+        if origtoken in punctuationset and len(corrected) + emitted > 1:
             corrected[-1] = corrected[-1] + origtoken
             continue
         
@@ -328,44 +403,40 @@ def catch_ambiguities(tokenlist, verbose = False):
             preceded = '#nought'
             followed = '#nought'
 
-            if indexnum > 4:
+            if position > 4:
                 for j in range(1, 3):
                     if (not tokenlist[indexnum - j].startswith('<')) and tokenlist[indexnum - j] !='\n':
                         preceded = tokenlist[indexnum - j].lower()
                         break
                 
-            if indexnum < (len(tokenlist)- 4):
+            if position < (total - 4):
                 for j in range(1, 3):
                     if (not tokenlist[indexnum + j].startswith('<')) and tokenlist[indexnum + j] !='\n':
                         followed = tokenlist[indexnum + j].lower()
                         break
                 
-            for Pair in AmbiguousPairs:
-                Tweedledee, Tweedledum = Pair
-                if token == Tweedledee or token == Tweedledum:
-                    RealMcCoy, prob = disambiguate(preceded, token, followed, Pair)
-                    # we get a probability back that we don't use in this context
-
-                    if RealMcCoy != token and RealMcCoy != "":
-                        if verbose:
-                            correctionphrase = " ".join([preceded, token, followed, "=>", preceded, RealMcCoy, followed])
-                            changedphrases.append(correctionphrase)
-                            
-                        additions = add_or_inc(RealMcCoy, additions)
-                        deletions = add_or_inc(token, deletions)
-                        token = RealMcCoy
-                    else:
-                        if verbose:
-                            correctionphrase = " ".join([preceded, token, followed, "<= KEPT"])
-                            changedphrases.append(correctionphrase)
-                        unchanged = add_or_inc(token, unchanged)
-                       
-                    break
-
-                # "Break" because we assume that a token can only match
-                # one ambiguous pair. The only exception I know of is
-                # flip - slip - ship, and that's handled recursively in the
-                # disambiguate function
+            Pair = PairIndex.get(token)
+            if Pair is not None:
+                RealMcCoy, prob = disambiguate(preceded, token, followed, Pair)
+                # we get a probability back that we don't use in this context
+
+                if RealMcCoy != token and RealMcCoy != "":
+                    if verbose:
+                        correctionphrase = " ".join([preceded, token, followed, "=>", preceded, RealMcCoy, followed])
+                        changedphrases.append(correctionphrase)
+                        
+                    additions = add_or_inc(RealMcCoy, additions)
+                    deletions = add_or_inc(token, deletions)
+                    token = RealMcCoy
+                else:
+                    if verbose:
+                        correctionphrase = " ".join([preceded, token, followed, "<= KEPT"])
+                        changedphrases.append(correctionphrase)
+                    unchanged = add_or_inc(token, unchanged)
+
+            # We assume that a token can only match one ambiguous pair. The
+            # only exception I know of is flip - slip - ship, and that's
+            # handled recursively in the disambiguate function.
                 
             if Titlecased:
                 origtoken = token.title()
@@ -378,5 +449,90 @@ def catch_ambiguities(tokenlist, verbose = False):
             # token back to "origtoken," while restoring the original case of the token.
             
         corrected.append(origtoken)
-                
+
+    return deletions, additions, corrected, changedphrases, unchanged
+
+def correct_chunk(chunk):
+    '''Runs correct_window in a pool worker. Chunk is a tuple of its
+    arguments.'''
+
+    return correct_window(*chunk)
+
+def merge_counts(target, counts):
+    for token, count in counts.items():
+        if token in target:
+            target[token] += count
+        else:
+            target[token] = count
+
+def catch_ambiguities_parallel(tokenlist, pool, verbose = False, pagesperchunk = PAGESPERCHUNK):
+    '''Does the same as catch_ambiguities, with the same result, but splits
+    the volume at page breaks into chunks of pagesperchunk pages and corrects
+    them on pool (a multiprocessing Pool, or anything with a map method that
+    keeps order). Worth it only for very large volumes.'''
+
+    return merge_chunks(pool.map(correct_chunk, split_chunks(tokenlist, verbose, pagesperchunk)))
+
+def split_chunks(tokenlist, verbose = False, pagesperchunk = PAGESPERCHUNK):
+    '''Separates punctuation in tokenlist and splits it at page breaks into
+    chunks of pagesperchunk pages. Returns a list of arguments for
+    correct_chunk, one per chunk, in order.'''
+
+    tokenlist = separate_punctuation(tokenlist)
+    total = len(tokenlist)
+
+    # Find where chunks begin. Each chunk after the first begins with a
+    # <pb>, and we note whether any token has been kept before it. Every
+    # token is kept except "fad", which catch_ambiguities drops.
+
+    chunks = list()
+    start = 0
+    emitted = 0
+    chunkemitted = 0
+    pagesinchunk = 0
+
+    for index, token in enumerate(tokenlist):
+        if token == '<pb>':
+            if pagesinchunk >= pagesperchunk:
+                chunks.append((start, index, chunkemitted))
+                start = index
+                chunkemitted = emitted
+                pagesinchunk = 0
+            pagesinchunk += 1
+
+        if emitted == 0 and not (token.lower() == 'fad' and 'fad' in AmbiguousTriggers):
+            emitted = 1
+
+    chunks.append((start, total, chunkemitted))
+
+    # Each chunk travels with two tokens of context on either side.
+
+    arguments = list()
+    for start, end, chunkemitted in chunks:
+        offset = max(0, start - 2)
+        window = tokenlist[offset: min(total, end + 2)]
+        arguments.append((window, start, end, offset, total, chunkemitted, verbose))
+
+    return arguments
+
+def merge_chunks(results):
+    '''Combines the results of correct_chunk for every chunk of a volume,
+    in order, into what catch_ambiguities would have returned.'''
+
+    deletions = {}
+    additions = {}
+    corrected = []
+    changedphrases = []
+    unchanged = {}
+
+    # Merging in order keeps the dictionaries' keys in the order the serial
+    # version would have added them.
+
+    for chunkdeletions, chunkadditions, chunkcorrected, chunkphrases, chunkunchanged in results:
+        merge_counts(deletions, chunkdeletions)
+        merge_counts(additions, chunkadditions)
+        corrected.extend(chunkcorrected)
+        changedphrases.extend(chunkphrases)
+        merge_counts(unchanged, chunkunchanged)
+
     return deletions, additions, corrected, changedphrases, unchanged
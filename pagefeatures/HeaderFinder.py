@@ -11,67 +11,427 @@
 # Once headers are identified, they can be treated in a range of different
 # ways. Here we are not concerned to *separate* the header from the original
 # text but only to identify it so that it can be given extra weight in
-# page classification.
+# page classification. But we do record where the headers were, in a
+# HeaderMap, which can be saved next to the .norm.txt; the copy of this
+# module in /runningheaders can use it to remove them later. The same pass
+# can find footers too (see analyze_headers), which go in a map of their own.
 
+import re
 from difflib import SequenceMatcher
+from collections import Counter, deque
+
+# SIMILARITY.
+
+# A line counts as a repeat of another if difflib rates them more than .8
+# similar. Building a SequenceMatcher for every pair of lines in the window
+# is the slowest part of finding headers, and most pairs aren't close. So a
+# LineMatcher tries cheap upper bounds on the ratio first, and only builds
+# a matcher for pairs that survive them. It reaches exactly the decisions
+# SequenceMatcher(None, lineA, lineB).ratio() > .8 would.
+
+MATCHERCACHESIZE = 5000
+# Lines (and pairs of lines) a LineMatcher remembers before it starts over.
+# Headers repeat within a window of three pages, so little is lost.
+
+class RatioMatcher(object):
+	'''The plain way: a new SequenceMatcher for every pair. Kept so that
+	the two can be compared.'''
+
+	def __init__(self, threshold = .8):
+		self.threshold = threshold
+
+	def similar(self, lineA, lineB):
+		return SequenceMatcher(None, lineA, lineB).ratio() > self.threshold
+
+class LineMatcher(object):
+	'''Decides whether SequenceMatcher(None, lineA, lineB).ratio() is more
+	than threshold, in tiers:
+
+	1. the lengths of the lines (SequenceMatcher.real_quick_ratio)
+	2. the characters they share, ignoring order (quick_ratio), counted
+	   once for each line
+	3. the ratio itself, using one SequenceMatcher per lineB, which keeps
+	   its index of lineB between comparisons.
+
+	Each tier is an upper bound on the next, so a pair rejected early
+	would have been rejected anyway. Decisions are remembered for each
+	pair, since running headers make the same comparisons over and over.'''
+
+	def __init__(self, threshold = .8):
+		self.threshold = threshold
+		self.charcounts = dict()
+		self.matchers = dict()
+		self.decisions = dict()
+
+	def char_counts(self, line):
+		counts = self.charcounts.get(line)
+		if counts is None:
+			counts = Counter(line)
+			self.charcounts[line] = counts
+		return counts
+
+	def similar(self, lineA, lineB):
+		key = (lineA, lineB)
+		decision = self.decisions.get(key)
+		if decision is not None:
+			return decision
+
+		if len(self.decisions) > MATCHERCACHESIZE:
+			self.charcounts.clear()
+			self.matchers.clear()
+			self.decisions.clear()
+
+		decision = self.compare(lineA, lineB)
+		self.decisions[key] = decision
+		return decision
+
+	def compare(self, lineA, lineB):
+		threshold = self.threshold
+		total = len(lineA) + len(lineB)
+		# The ratio is 2.0 * matches / total; we compute the bounds the same
+		# way so that rounding can't separate them from it.
+
+		if 2.0 * min(len(lineA), len(lineB)) / total <= threshold:
+			return False
+
+		countsA = self.char_counts(lineA)
+		countsB = self.char_counts(lineB)
+		shared = 0
+		for char, count in countsA.items():
+			other = countsB.get(char)
+			if other is not None:
+				shared += min(count, other)
+		if 2.0 * shared / total <= threshold:
+			return False
+
+		matcher = self.matchers.get(lineB)
+		if matcher is None:
+			matcher = SequenceMatcher(None, '', lineB)
+			self.matchers[lineB] = matcher
+		matcher.set_seq1(lineA)
+		return matcher.ratio() > threshold
+
+def comparable_line(line, romannumerals):
+	'''Transforms a line for comparison as described in find_headers, or
+	returns None if it isn't substantial enough to compare.'''
+
+	line = line.strip()
+	if line.startswith('<') and line.endswith('>'):
+		return None
+
+	line = "".join([x for x in line if not x.isdigit()])
+	# We strip all numeric chars before the length check.
+
+	if line in romannumerals:
+		return None
+
+	# That may not get all roman numerals, because of OCR junk, so let's
+	# attempt to get them by shrinking them below the length limit. This
+	# will also have the collateral benefit of reducing the edit distance
+	# for headers that contain roman numerals.
+	line = line.replace("iii", "")
+	line = line.replace("ii", "")
+	line = line.replace("xx", "")
+
+	if len(line) < 5:
+		return None
+
+	return line
+
+def select_lines(page, romannumerals):
+	'''Returns the first two substantial lines on a page, transformed
+	for comparison as described in find_headers.'''
+
+	return [line for line, lineindex in candidate_lines(page, romannumerals)]
+
+def candidate_lines(page, romannumerals):
+	'''Like select_lines, but returns (line, lineindex) pairs, so we know
+	where each line came from.'''
+
+	thesetwo = list()
+
+	for idx, line in enumerate(page):
+		if idx > 4:
+			break
+
+		line = comparable_line(line, romannumerals)
+		if line is None:
+			continue
+
+		thesetwo.append((line, idx))
+
+		if len(thesetwo) >= 2:
+			break
+
+	return thesetwo
+
+def footer_candidates(page, romannumerals, headerlines):
+	'''The last substantial line among the last five on a page, as a list
+	holding one (line, lineindex) pair, or none. Signature marks are too
+	short to count, so this is the line above them, where running footers
+	are. One line rather than two, because footer candidates are mostly
+	body text, which doesn't repeat and so costs us a full comparison each
+	time. We stop at the header candidates (headerlines), so that on a short
+	page a line is never both, and footers always come after headers.'''
+
+	top = max(len(page) - 5, bottom_limit(headerlines))
+
+	for idx in range(len(page) - 1, top - 1, -1):
+		line = comparable_line(page[idx], romannumerals)
+		if line is not None:
+			return [(line, idx)]
+
+	return []
+
+signaturemark = re.compile(r'^([A-Z])([A-Za-z]?)(\s?[0-9]{1,2}|\s[ivxlIVXL]{1,4})?$')
+# A printer's signature mark, like "B2", "Aa 3" or "C iv": a letter, or the
+# same letter twice, usually followed by a number.
+
+edgepunctuation = '.,;:!?"\'()[]-'
+
+def first_word(line):
+	words = line.split()
+	if len(words) < 1:
+		return ''
+	return words[0].strip(edgepunctuation).lower()
+
+def is_signature(text, setapart):
+	'''Whether text is a signature mark. Without a number, a letter on its
+	own only counts if it's set apart from the text above it by a blank
+	line; otherwise it's as likely to be "I" or "A" ending a sentence.'''
+
+	match = signaturemark.match(text)
+	if match is None:
+		return False
+
+	letter, second, number = match.groups()
+	if len(second) > 0 and second.lower() != letter.lower():
+		return False
+		# "It" or "On", not "Aa".
+
+	return number is not None or setapart
+
+def catchword_in(words, setapart):
+	'''The catchword on a line split into words, or None. A catchword stands
+	alone on its line, or beside a signature mark.'''
+
+	if len(words) == 1:
+		candidate = words[0]
+	elif is_signature(' '.join(words[0:-1]), setapart):
+		candidate = words[-1]
+	elif is_signature(' '.join(words[1:]), setapart):
+		candidate = words[0]
+	else:
+		return None
+
+	candidate = candidate.strip(edgepunctuation).lower()
+	if len(candidate) < 2 or not candidate.replace("'", "").isalpha():
+		return None
+	return candidate
+
+def first_text_line(page):
+	for line in page:
+		line = line.strip()
+		if len(line) > 0 and not line.startswith('<'):
+			return line
+	return ''
+
+def marginal_line(page, nextpage, top):
+	'''Signature marks and catchwords (the first word of the next page,
+	printed at the foot of this one) don't repeat from page to page, so the
+	window can't find them. Returns (line, lineindex) if the last line of
+	page is one of them, or None. Nextpage is None at the end of a volume.
+	Lines before top are left alone.
+
+	These lines get removed from the text, so we only take ones we can be
+	sure of: a signature mark with a number, or set apart by a blank line,
+	and a catchword alone on its line (or beside a signature mark) that
+	is the first word of the first line on the next page.'''
+
+	for idx in range(len(page) - 1, top - 1, -1):
+		line = page[idx].strip()
+		if len(line) > 0:
+			break
+	else:
+		return None
+
+	if line.startswith('<') and line.endswith('>'):
+		return None
+
+	words = line.split()
+	if len(words) > 4:
+		return None
+
+	setapart = idx > top and len(page[idx - 1].strip()) < 1
+
+	if is_signature(line, setapart):
+		return (line, idx)
+
+	if nextpage is not None:
+		catchword = catchword_in(words, setapart)
+		if catchword is not None and first_word(first_text_line(nextpage)) == catchword:
+			return (line, idx)
+
+	return None
+
+def add_marginal(footers, bottomlines, marginal):
+	'''Adds a marginal line to a page's footers, returning the page's
+	candidate lines with the marginal line among them.'''
+
+	line, lineindex = marginal
+	for candidate, candidateindex in bottomlines:
+		if candidateindex == lineindex:
+			footers.add(candidate)
+			return bottomlines
+
+	footers.add(line)
+	return bottomlines + [marginal]
+
+def bottom_limit(headerlines):
+	'''The first line index below a page's header candidates.'''
+	top = 0
+	for line, lineindex in headerlines:
+		top = max(top, lineindex + 1)
+	return top
+
+def compare_lines(linesA, linesB, foundA, foundB, matcher):
+	'''Adds to foundA and foundB any lines in linesA and linesB (lists of
+	(line, lineindex) pairs) that are similar to a line in the other.'''
+
+	for lineA, indexA in linesA:
+		for lineB, indexB in linesB:
+			if matcher.similar(lineA, lineB):
+				foundA.add(lineA)
+				foundB.add(lineB)
+
+# HEADER MAPS.
+
+class HeaderMap(object):
+	'''The running headers (or footers) found in a volume. For each page, in
+	order, a list of (lineindex, text) pairs: lineindex is the position of a
+	header line on the page as it was passed in, and text is the line as it
+	was compared (digits stripped, and so on). Most pages have none.
+
+	A HeaderMap can be written to a .hdr.tsv file next to the .norm.txt and
+	read back with read_headermap, so that headers found when a volume is
+	normalized can be removed when it's aggregated, without finding them
+	all over again.'''
+
+	def __init__(self):
+		self.pages = list()
+
+	def __len__(self):
+		return len(self.pages)
+
+	def add_page(self, headers, candidates):
+		'''Adds the next page, given the set of header lines found on it and
+		its candidate lines, as (line, lineindex) pairs.'''
+
+		entries = list()
+		for header in headers:
+			for line, lineindex in candidates:
+				if line == header:
+					entries.append((lineindex, header))
+		self.pages.append(entries)
+
+	def page_tokens(self, index):
+		'''The tokens in the headers of one page. A line repeated on the
+		same page only counts once.'''
 
-def find_headers(pagelist, romannumerals):
-	'''Identifies repeated page headers and returns them as a list keyed to
-	original page locations.'''
-
-	# For very short documents, this is not a meaningful task.
-
-	if len(pagelist) < 5:
-		return []
-
-	firsttwos = list()
-	# We construct a list of the first two substantial lines on
-	# each page. We ignore short lines and lines that are just numbers,
-	# and don't go deeper than five lines in any event.
-
-	# We transform lines in this process -- e.g, by removing digits.
-	# If we were attempting to *remove* lines from the original text,
-	# we would probably need to construct objects that package the transformed
-	# line with information about its original location, so we could also
-	# remove the original.
-
-	for page in pagelist:
-		thesetwo = list()
-		linesaccepted = 0
-
-		for idx, line in enumerate(page):
-			if idx > 4:
-				break
-
-			line = line.strip()
-			if line.startswith('<') and line.endswith('>'):
+		thisstream = []
+		seen = set()
+		for lineindex, header in self.pages[index]:
+			if header not in seen:
+				seen.add(header)
+				thisstream.extend(header.split())
+		return thisstream
+
+	def tokens(self, first = 0):
+		'''A list of header tokens for each page, starting at first.'''
+		return [self.page_tokens(x) for x in range(first, len(self.pages))]
+
+	def remove(self, pagelist):
+		'''Removes the header lines from pagelist, which has to be the list
+		of pages the map was made from. Returns the edited pagelist and a
+		list of the lines removed. To remove both footers and headers,
+		remove the footers first; they always come after the headers on a
+		page, so that leaves the headers' line indexes alone.'''
+
+		assert len(pagelist) == len(self.pages)
+		removed = list()
+		for page, entries in zip(pagelist, self.pages):
+			lineindexes = sorted(set([x[0] for x in entries]), reverse = True)
+			# Popping from the bottom of the page up, so that each pop
+			# leaves the indexes of the lines above it alone.
+			for lineindex in lineindexes:
+				removed.append(page.pop(lineindex))
+
+		return pagelist, removed
+
+	def write(self, path):
+		'''Writes the map as tab-separated rows of page index, line index and
+		header text, after a row giving the number of pages.'''
+
+		with open(path, mode = 'w', encoding = 'utf-8') as file:
+			file.write('#pages\t' + str(len(self.pages)) + '\n')
+			for index, entries in enumerate(self.pages):
+				for lineindex, header in entries:
+					file.write(str(index) + '\t' + str(lineindex) + '\t' + header + '\n')
+
+def read_headermap(path):
+	'''Reads a HeaderMap written by HeaderMap.write.'''
+
+	headermap = HeaderMap()
+	pages = headermap.pages
+
+	with open(path, encoding = 'utf-8') as file:
+		for line in file:
+			fields = line.rstrip('\n').split('\t', 2)
+			if fields[0] == '#pages':
+				while len(pages) < int(fields[1]):
+					pages.append(list())
 				continue
 
-			line = "".join([x for x in line if not x.isdigit()])
-			# We strip all numeric chars before the length check.
+			index = int(fields[0])
+			while len(pages) <= index:
+				pages.append(list())
+			pages[index].append((int(fields[1]), fields[2]))
 
-			if line in romannumerals:
-				continue
+	return headermap
 
-			# That may not get all roman numerals, because of OCR junk, so let's
-			# attempt to get them by shrinking them below the length limit. This
-			# will also have the collateral benefit of reducing the edit distance
-			# for headers that contain roman numerals.
-			line = line.replace("iii", "")
-			line = line.replace("ii", "")
-			line = line.replace("xx", "")
+def analyze_headers(pagelist, romannumerals, matcher = None, headermap = None, footermap = None):
+	'''Identifies repeated page headers and adds the pages of pagelist to
+	headermap (a new HeaderMap, if you don't pass one), which it returns.
+	Matcher decides which lines are similar; by default, a new LineMatcher.
+	Documents shorter than five pages get no headers.
 
-			if len(line) < 5:
-				continue
+	If you pass a footermap too, the same pass finds footers: lines near
+	the bottom of a page that repeat within the same window, plus signature
+	marks and catchwords (see marginal_line). Their lines are added to
+	footermap.'''
+
+	if matcher is None:
+		matcher = LineMatcher()
+	if headermap is None:
+		headermap = HeaderMap()
 
-			linesaccepted += 1
-			thesetwo.append(line)
+	firsttwos = list()
+	# We construct a list of the first two substantial lines on
+	# each page, with their positions. We ignore short lines and lines that
+	# are just numbers, and don't go deeper than five lines in any event.
 
-			if linesaccepted >= 2:
-				break
+	# We transform lines in this process -- e.g, by removing digits. The
+	# positions let us (or whoever reads the HeaderMap) remove the original.
 
+	for page in pagelist:
+		thesetwo = candidate_lines(page, romannumerals)
 		firsttwos.append(thesetwo)
 
+	lasttwos = list()
+	if footermap is not None:
+		for page, thesetwo in zip(pagelist, firsttwos):
+			lasttwos.append(footer_candidates(page, romannumerals, thesetwo))
+
 	# Now our task is to iterate through the firsttwos, identifying lines that
 	# repeat within a window, which we define as "this page and the two previous
 	# pages."
@@ -81,46 +441,150 @@ def find_headers(pagelist, romannumerals):
 	# pages, we're always going to be checking whether they were already added.
 
 	repeated = list()
+	footers = list()
 	for i in range(len(firsttwos)):
-		newset = set()
-		repeated.append(newset)
-
-	for index in range(2, len(firsttwos)):
-		# We can be sure the 2 index is legal because we have previously filtered
-		# short documents.
-
-		indexedlines = firsttwos[index]
+		repeated.append(set())
+		footers.append(set())
 
-		for j in range (index - 2, index):
-
-			previouslines = firsttwos[j]
+	# For very short documents, this is not a meaningful task.
 
-			for lineA in indexedlines:
-				for lineB in previouslines:
-					s = SequenceMatcher(None, lineA, lineB)
-					similarity = s.ratio()
-					if similarity > .8:
-						repeated[index].add(lineA)
-						repeated[j].add(lineB)
+	if len(pagelist) >= 5:
+		for index in range(2, len(firsttwos)):
+			for j in range (index - 2, index):
+				compare_lines(firsttwos[index], firsttwos[j], repeated[index], repeated[j], matcher)
+				if footermap is not None:
+					compare_lines(lasttwos[index], lasttwos[j], footers[index], footers[j], matcher)
 
 	# Now we have a list of sets that contain digit-stripped strings
 	# representing headers, in original page order, with empty sets where no headers
-	# were found. We want to convert this to a list of lists of individual tokens.
-
-	listoftokenstreams = list()
-
-	for thispageheaders in repeated:
-		thisstream = []
-		for header in thispageheaders:
-			thisstream.extend(header.split())
-		listoftokenstreams.append(thisstream)
-
-	return listoftokenstreams
-
-
-
-
+	# were found.
+
+	for thispageheaders, thesetwo in zip(repeated, firsttwos):
+		headermap.add_page(thispageheaders, thesetwo)
+
+	if footermap is not None:
+		for index, page in enumerate(pagelist):
+			bottomlines = lasttwos[index]
+			if len(pagelist) >= 5:
+				if index + 1 < len(pagelist):
+					nextpage = pagelist[index + 1]
+				else:
+					nextpage = None
+				marginal = marginal_line(page, nextpage, bottom_limit(firsttwos[index]))
+				if marginal is not None:
+					bottomlines = add_marginal(footers[index], bottomlines, marginal)
+			footermap.add_page(footers[index], bottomlines)
+
+	return headermap
+
+def find_headers(pagelist, romannumerals, matcher = None, headermap = None, footermap = None):
+	'''Identifies repeated page headers and returns them as a list keyed to
+	original page locations: for each page, a list of the tokens in its
+	headers. If you pass a HeaderMap, the headers are added to it too, and
+	if you pass a footermap, footers are found and added to it.'''
 
+	if headermap is None:
+		headermap = HeaderMap()
+	first = len(headermap)
 
+	analyze_headers(pagelist, romannumerals, matcher, headermap, footermap)
 
+	if len(pagelist) < 5:
+		return []
 
+	return headermap.tokens(first)
+
+def iter_headers(pages, romannumerals, matcher = None, headermap = None, footermap = None):
+	'''Streaming version of find_headers. Pages can be any iterable; this
+	yields (page, headertokens) for each page in order, holding no more than
+	a few pages in memory. A page's headers can only be settled once we've
+	seen the two pages after it, so each page is yielded two pages late.
+
+	The results are the same as find_headers, except that for documents
+	shorter than five pages we yield an empty list for every page, rather
+	than returning an empty list for the whole document. If you pass a
+	HeaderMap, each page is added to it as it's yielded, and likewise its
+	footers, if you pass a footermap.'''
+
+	if matcher is None:
+		matcher = LineMatcher()
+
+	pages = iter(pages)
+
+	# We need to know whether the document has at least five pages before
+	# we can yield anything.
+	firstfive = list()
+	for page in pages:
+		firstfive.append(page)
+		if len(firstfive) >= 5:
+			break
+
+	if len(firstfive) < 5:
+		for page in firstfive:
+			if headermap is not None:
+				headermap.add_page(set(), [])
+			if footermap is not None:
+				footermap.add_page(set(), [])
+			yield page, []
+		return
+
+	def allpages():
+		for page in firstfive:
+			yield page
+		for page in pages:
+			yield page
+
+	# Each entry in the window is a list: a page, its first two lines (with
+	# their positions), the set of header lines found on it so far, and the
+	# same for footers, if we're looking for them, plus its marginal line.
+	window = deque()
+
+	for page in allpages():
+		indexedlines = candidate_lines(page, romannumerals)
+		newset = set()
+		if footermap is not None:
+			bottomlines = footer_candidates(page, romannumerals, indexedlines)
+		else:
+			bottomlines = []
+		window.append([page, indexedlines, newset, bottomlines, set(), None])
+
+		if footermap is not None and len(window) >= 2:
+			previous = window[-2]
+			previous[5] = marginal_line(previous[0], page, bottom_limit(previous[1]))
+
+		if len(window) >= 3:
+			for j in (-3, -2):
+				compare_lines(indexedlines, window[j][1], newset, window[j][2], matcher)
+				if footermap is not None:
+					compare_lines(bottomlines, window[j][3], window[-1][4], window[j][4], matcher)
+
+			# Nothing later can add to the oldest page in the window.
+			yield release(window.popleft(), headermap, footermap)
+
+	if footermap is not None:
+		last = window[-1]
+		last[5] = marginal_line(last[0], None, bottom_limit(last[1]))
+
+	while len(window) > 0:
+		yield release(window.popleft(), headermap, footermap)
+
+def release(entry, headermap, footermap):
+	'''Records a page leaving iter_headers' window in the maps, and returns
+	the page and its header tokens.'''
+
+	page, firsttwo, headers, lasttwo, footers, marginal = entry
+	if headermap is not None:
+		headermap.add_page(headers, firsttwo)
+	if footermap is not None:
+		if marginal is not None:
+			lasttwo = add_marginal(footers, lasttwo, marginal)
+			# Only now, so that it's added after everything the window found,
+			# as it is in analyze_headers.
+		footermap.add_page(footers, lasttwo)
+	return page, header_tokens(headers)
+
+def header_tokens(headers):
+	thisstream = []
+	for header in headers:
+		thisstream.extend(header.split())
+	return thisstream
@@ -0,0 +1,93 @@
+# LongSEvidence.py
+#
+# Decides whether a volume has a long-s problem, i.e. whether the OCR has
+# read most of its long s's as f's. The test is simple: we count a handful
+# of words that are usually long-s errors (fee, fame, fold ...) and their
+# correct forms (see, same, sold ...). If the errors are at least as common
+# as the truths, the volume needs contextual correction.
+#
+# This used to be done after the fact, by counting words in the finished
+# page dictionaries (or, in Context.as_stream, by scanning the token list
+# once for each word). A LongSCounter counts as the words go by instead, so
+# the decision is ready as soon as the first pass over a volume is finished.
+#
+# It can also decide early. If decideafter is more than zero, then once that
+# many pages have been counted the counter checks after each page whether the
+# evidence for long s is overwhelming, and if it is, settles the question and
+# stops counting. The streaming normalizer uses this to give up on long-s
+# volumes after a few pages, rather than normalizing the whole volume before
+# finding out it has to start again. It only ever decides early that a volume
+# *has* a problem: that verdict just sends the volume to the batch path, which
+# counts the whole volume again with a counter of its own. An early verdict
+# that a volume is clean would be final, and the rest of the volume could
+# disagree.
+
+felecterrors = ['fee', 'fea', 'fay', 'fays', 'fame', 'fell', 'funk', 'fold', 'haft', 'fat', 'fix', 'chafe', 'loft']
+selecttruths = ['see', 'sea', 'say', 'says', 'same', 'sell', 'sunk', 'sold', 'hast', 'sat', 'six', 'chase', 'lost']
+# Of course, either set could be valid. But I expect the second to be more common.
+# The comparison is used as a test.
+
+OVERWHELMING = 5
+MINIMUMEVIDENCE = 30
+# An early decision needs the errors to outnumber the truths by this factor,
+# and at least this many of them.
+
+class LongSCounter(object):
+
+    __slots__ = ('words', 'errors', 'truths', 'pages', 'decideafter', 'decision')
+
+    def __init__(self, errorwords = felecterrors, truthwords = selecttruths, decideafter = 0):
+        self.words = dict()
+        for word in errorwords:
+            self.words[word] = False
+        for word in truthwords:
+            self.words[word] = True
+        # Callers can check membership in words before calling add; that's
+        # the cheapest way to count, and once we've decided early, words is
+        # emptied so nothing gets counted.
+
+        self.errors = 1
+        self.truths = 1
+        # Initialized to 1 as a Laplacian correction.
+        self.pages = 0
+        self.decideafter = decideafter
+        self.decision = None
+
+    def add(self, word, count = 1):
+        if word in self.words:
+            if self.words[word]:
+                self.truths += count
+            else:
+                self.errors += count
+
+    def add_tokens(self, tokens):
+        words = self.words
+        for token in tokens:
+            if token in words:
+                self.add(token)
+
+    def end_page(self):
+        '''Marks the end of a page, which is when we consider an early
+        decision.'''
+
+        self.pages += 1
+        if self.decideafter > 0 and self.decision is None and self.pages >= self.decideafter:
+            if self.errors >= MINIMUMEVIDENCE and self.errors >= self.truths * OVERWHELMING:
+                self.decide(True)
+
+    def decide(self, decision):
+        self.decision = decision
+        self.words = dict()
+
+    def decided(self):
+        '''True if we've decided early that the volume has a long-s
+        problem.'''
+        return self.decision is not None
+
+    def long_s_problem(self):
+        if self.decision is not None:
+            return self.decision
+        return self.truths <= self.errors
+
+    def ratio(self):
+        return self.truths / self.errors
@@ -33,12 +33,26 @@
 
 import FileCabinet
 import NormalizeVolume
+import HeaderFinder
 import Context
 import json
 import os, sys, time
-from zipfile import ZipFile
+import pickle, queue, shutil
+from collections import deque
 from multiprocessing import Pool
 import SonicScrewdriver as utils
+import RuleSnapshot
+import StreamingNormalizer
+from VolumeReader import read_zip
+import StageTimer
+import Prefetcher
+import SliceJournal
+import VolumeScheduler
+import WorkQueue
+import PairtreeManifest
+import SegmentStore
+import tempfile
+from LongSEvidence import LongSCounter
 
 testrun = False
 # Setting this flag to "true" allows me to run the script on a local machine instead of
@@ -51,12 +65,91 @@ felecterrors = ['fee', 'fea', 'fay', 'fays', 'fame', 'fell', 'funk', 'fold', 'ha
 selecttruths = ['see', 'sea', 'say', 'says', 'same', 'sell', 'sunk', 'sold', 'hast', 'sat', 'six', 'chase', 'lost']
 # Of course, either set could be valid. But I expect the second to be more common.
 # The comparison is used as a test.
+workers = 12
+sharedrules = True
+# When sharedrules is True, the rules are loaded once in this process and
+# inherited by the workers, which lets us run more workers per node.
+streaming = True
+# When streaming is True, zipped volumes are normalized a page at a time
+# by StreamingNormalizer, which keeps much less of each volume in memory.
+# Volumes it can't handle fall back to the batch path below.
+earlylongs = 10
+# If earlylongs is more than zero, streaming may decide that a volume has a
+# long-s problem once it has seen that many pages, if the evidence is
+# overwhelming, and hand it to the batch path without finishing it. That's
+# safe, because the batch path counts the whole volume again; a volume is
+# never decided clean early. Set it to 0 to stream every volume to the end.
+writeheaders = True
+# When writeheaders is True, the running headers found in each volume are
+# written to a .hdr.tsv file next to the .norm.txt (see HeaderFinder.HeaderMap),
+# so that aggregation can remove them without finding them all over again.
+# Footers, signature marks and catchwords are found in the same pass and
+# written to a .ftr.tsv file.
+bigvolume = 1000000
+# Long-s volumes with more tokens than this would hold up the end of a slice
+# while the other workers sit idle. So the worker that finds one spills what
+# it had already done (the first pass of correct_stream) to a scratch
+# directory, along with the volume split into chunks of pages for contextual
+# correction (Context.split_chunks), and sends back only the directory. main()
+# hands the chunks to the pool straight away, ahead of the batches it hasn't
+# handed out yet, and once they're all done a worker merges them and finishes
+# the volume (finish_deferred). The result is the same. Set bigvolume to 0 to
+# correct every volume in its own worker.
+deferdir = None
+# Where those scratch directories go; None means the system's temporary
+# directory. Workers and main() must all be able to see it.
+batchsize = 16
+# Volumes are handed to the workers in batches of at most this many.
+schedule = True
+# When schedule is True, the largest volumes go to the pool first, one to a
+# batch, and smaller ones follow in batches of similar size, so that no
+# worker is left with a huge volume after the others have finished
+# (VolumeScheduler.py). Zipfile sizes are cached in slicenamesizes.tsv.
+# When it's False, volumes go out in batches in hash order.
+prefetch = 4
+# When prefetch is more than zero, each worker reads up to this many of the
+# next volumes in its batch into memory on a background thread while it
+# normalizes the current one (Prefetcher.py), so it isn't sitting idle while
+# the shared filesystem finds and reads each zipfile. After that, the thread
+# reads the first zipfile of a batch further down the line into the page
+# cache, which is all the read-ahead a batch of one big volume gets.
+prefetchbudget = 256 * 1024 * 1024
+# The most bytes of prefetched zipfiles a worker will hold at once.
+usemanifest = True
+# When usemanifest is True and the pairtree has a manifest.tsv (see
+# PairtreeManifest.py), we find zipfiles and their sizes in the manifest, and
+# log volumes it doesn't list as missing before they reach the pool.
+resume = True
+# Each volume's metadata and errors are written as soon as its batch comes
+# back, and its HTID is added to a journal of finished volumes. When resume
+# is True, a slice that's started again skips the volumes in its journal.
+# When it's False, we start the slice (and its journal) over.
+syncevery = 60
+# Seconds between fsyncs of the metadata, errorlog and journal.
+outputmode = "pairtree"
+# "pairtree" writes each volume's .norm.txt and .pg.tsv (and .hdr.tsv and
+# .ftr.tsv) into its directory in the pairtree. "segments" appends them to a
+# few large segment files in segmentdir instead, one per worker, and keeps an
+# index for each slice of where every volume's files went (SegmentStore.py).
+# The files are written to local scratch space first and packed once the
+# volume is done; read them back with SegmentStore.SegmentReader.
+segmentcompression = None
+# In segment mode, None, "gzip" or "lzma".
+instrument = True
+# When instrument is True, each volume records wall time, CPU time and peak
+# memory for every stage of normalization, and we write them to a stats file
+# next to the errorlog. When it's False the timers do nothing.
 meaningfulheaders = {"index", "introduction", "introductory", "preface", "contents", "glossary", "notes", "poems", "ode", "stanzas", "catalog", "books", "volumes", "tale", "chapter", "canto", "advertisement", "argument", "book", "scene", "act", "comedy", "tragedy", "plays"}
 
 # LOAD PATHS.
 
-## We assume the slice name has been passed in as an argument.
-slicename = sys.argv[1]
+## We assume the slice name has been passed in as an argument. Or, if the
+## arguments are "queue" and a directory, we pull chunks of HTIDs from the
+## WorkQueue in that directory until it's empty, and each chunk gets treated
+## as a slice. See WorkQueue.py.
+queuedir = None
+if sys.argv[1] == "queue":
+	queuedir = sys.argv[2]
 current_working = os.getcwd()
 
 # This is most important when running on the cluster, where files are stored in a pairtree
@@ -78,11 +171,31 @@ metadatapath = pathdictionary['metadatapath']
 metaoutpath = pathdictionary['metaoutpath']
 outpath = pathdictionary['outpath']
 # only relevant if testrun == True
+segmentdir = datapath + "segments/"
 
-slicepath = pathdictionary['slicepath'] + slicename + '.txt'
-errorpath = pathdictionary['slicepath'] + slicename + 'errorlog.txt'
-longSpath = pathdictionary['slicepath'] + slicename + 'longS.txt'
-headeroutpath = pathdictionary['slicepath'] + slicename + "headers.txt"
+def set_slice(name):
+	'''Points the paths that are named after the slice at slice name.'''
+
+	global slicename, slicepath, errorpath, longSpath, headeroutpath, statspath, journalpath, sizepath, indexpath, slicemetapath
+
+	slicename = name
+	slicepath = pathdictionary['slicepath'] + slicename + '.txt'
+	errorpath = pathdictionary['slicepath'] + slicename + 'errorlog.txt'
+	longSpath = pathdictionary['slicepath'] + slicename + 'longS.txt'
+	headeroutpath = pathdictionary['slicepath'] + slicename + "headers.txt"
+	statspath = pathdictionary['slicepath'] + slicename + 'stats.tsv'
+	journalpath = pathdictionary['slicepath'] + slicename + 'journal.txt'
+	slicemetapath = pathdictionary['slicepath'] + slicename + 'metadata.txt'
+	# This slice's rows for NormalizingMetadata.txt (metaoutpath), merged
+	# into it afterwards with "python3 SliceJournal.py merge".
+	sizepath = pathdictionary['slicepath'] + slicename + 'sizes.tsv'
+	indexpath = segmentdir + slicename + '.idx'
+
+set_slice(sys.argv[1])
+
+manifest = None
+if usemanifest and not testrun:
+	manifest = PairtreeManifest.open_manifest(datapath)
 
 # read in special-purpose london phrase list
 
@@ -109,22 +222,81 @@ pagevocabset = set([x.strip() for x in filelines])
 ## MAIN FUNCTION:
 ##
 
+def make_pool():
+	'''A pool of workers, which share this process's rules if sharedrules
+	is True.'''
+
+	global workers, sharedrules
+
+	if sharedrules:
+		return RuleSnapshot.shared_pool(workers)
+	else:
+		return Pool(processes = workers)
+
 def main():
-	global testrun, datapath, slicepath, metadatapath, current_working,  metaoutpath, errorpath, pagevocabset
+	global testrun, datapath, slicepath, metadatapath, workers, sharedrules, queuedir
+
+	# Let's get some metadata to create metadata features.
 
 	if testrun:
-		filelist = os.listdir(datapath)
-		HTIDs = set()
-		for afilename in filelist:
-			if not (afilename.startswith(".") or afilename.startswith("_")):
-				HTIDs.add(afilename)
+		rowindices, columns, metadata = utils.readtsv("/Users/tunder/Dropbox/PythonScripts/hathimeta/ExtractedMetadata.tsv")
+	else:
+		rowindices, columns, metadata = utils.readtsv("/projects/ichass/usesofscale/hathimeta/ExtractedMetadata.tsv")
+
+	pool = make_pool()
+
+	if queuedir is None:
+		if testrun:
+			filelist = os.listdir(datapath)
+			HTIDs = set()
+			for afilename in filelist:
+				if not (afilename.startswith(".") or afilename.startswith("_")):
+					HTIDs.add(afilename)
+
+		else:
+			with open(slicepath, encoding="utf-8") as file:
+				HTIDlist = file.readlines()
+
+			HTIDs = set([x.rstrip() for x in HTIDlist])
+			del HTIDlist
+
+		normalize_slice(HTIDs, pool, rowindices, columns, metadata)
 
 	else:
-		with open(slicepath, encoding="utf-8") as file:
-			HTIDlist = file.readlines()
+		queue = WorkQueue.WorkQueue(queuedir)
+		queuename = os.path.basename(os.path.normpath(queuedir))
+		lease = queue.claim()
+		while lease is not None:
+			set_slice(queuename + lease.name)
+			print("Claimed " + lease.name + " from the queue, with " + str(len(lease.htids)) + " volumes.")
+			try:
+				finished = normalize_slice(set(lease.htids), pool, rowindices, columns, metadata, lease)
+			except:
+				lease.release()
+				raise
+			if finished:
+				lease.finish()
+			else:
+				lease.stop()
+				pool.terminate()
+				pool.join()
+				pool = make_pool()
+				# The old pool still had batches of the lost chunk queued.
+			lease = queue.claim()
+
+	print("Done.")
+	pool.close()
+	pool.join()
+
+	# Done.
+
+def normalize_slice(HTIDs, pool, rowindices, columns, metadata, lease = None):
+	'''Normalizes the volumes in HTIDs, recording results under the current
+	slice name. If the volumes are a chunk from a WorkQueue, lease is our
+	Lease on it, and we renew it after each batch. Returns False if we found
+	that another job had reclaimed the chunk, and stopped; otherwise True.'''
 
-		HTIDs = set([x.rstrip() for x in HTIDlist])
-		del HTIDlist
+	global testrun, datapath, slicepath, metadatapath, current_working,  metaoutpath, errorpath, pagevocabset, workers, sharedrules, instrument, statspath, journalpath, slicemetapath, resume, syncevery, schedule, sizepath, manifest, indexpath, segmentwriter
 
 	## discard bad volume IDs
 
@@ -137,18 +309,31 @@ def main():
 		if line[0] in HTIDs:
 			HTIDs.discard(line[0])
 
-	if not os.path.isfile(metaoutpath):
-		with open(metaoutpath, 'w', encoding = 'utf-8') as f:
+	## skip volumes finished by an earlier run of this slice
+
+	done = set()
+	if resume:
+		done = SliceJournal.read_journal(journalpath)
+		if len(done) > 0:
+			skipped = len(HTIDs & done)
+			HTIDs = HTIDs - done
+			print("Resuming: " + str(skipped) + " volumes were finished already.")
+
+	if len(done) < 1 or not os.path.isfile(slicemetapath):
+		with open(slicemetapath, 'w', encoding = 'utf-8') as f:
 			f.write("volID\ttotalwords\tprematched\tpreenglish\tpostmatched\tpostenglish\n")
 
 	print(len(HTIDs))
 
-	# Let's get some metadata to create metadata features.
+	## volumes the manifest doesn't list are missing, unless they've
+	## appeared since it was made
 
-	if testrun:
-		rowindices, columns, metadata = utils.readtsv("/Users/tunder/Dropbox/PythonScripts/hathimeta/ExtractedMetadata.tsv")
-	else:
-		rowindices, columns, metadata = utils.readtsv("/projects/ichass/usesofscale/hathimeta/ExtractedMetadata.tsv")
+	missing = list()
+	if manifest is not None:
+		for aHTID in HTIDs:
+			if aHTID not in manifest and not os.path.isfile(volume_filename(aHTID)):
+				missing.append(aHTID)
+		HTIDs = HTIDs - set(missing)
 
 	metadata_clues = list()
 	for aHTID in HTIDs:
@@ -156,53 +341,171 @@ def main():
 		metadata_clues.append(evidence)
 
 	assert len(HTIDs) == len(metadata_clues)
-	file_tuples = zip(HTIDs, metadata_clues)
-
-	pool = Pool(processes = 12)
-	res = pool.map_async(process_a_file, file_tuples)
-
-	# After all files are processed, write metadata, errorlog, and counts of phrases.
-	res.wait()
-	resultlist = res.get()
-
-	processedmeta = list()
-	errorlog = list()
-	phrasecount = dict()
-
-	for file_dict in resultlist:
-		processedmeta.append(file_dict["metadata"])
-		errorlog.extend(file_dict["errors"])
-		htid = file_dict["htid"]
+	file_tuples = list(zip(HTIDs, metadata_clues))
+	if schedule:
+		if manifest is not None:
+			unlisted = [x[0] for x in file_tuples if x[0] not in manifest]
+			sizes = VolumeScheduler.volume_sizes(unlisted, volume_filename, sizepath)
+			# Volumes that arrived after the manifest was made; we found
+			# them on disk above, so we stat them like everything else.
+			for aHTID, evidence in file_tuples:
+				if aHTID not in sizes:
+					sizes[aHTID] = manifest.size(aHTID, 0)
+		else:
+			sizes = VolumeScheduler.volume_sizes([x[0] for x in file_tuples], volume_filename, sizepath)
+		batches = VolumeScheduler.largest_first(file_tuples, sizes, workers, batchsize)
+	else:
+		batches = [file_tuples[i: i + batchsize] for i in range(0, len(file_tuples), batchsize)]
 
-	# Metadata.
+	if outputmode == "segments" and not testrun:
+		os.makedirs(segmentdir, exist_ok = True)
+		writer = SliceJournal.SliceWriter(slicemetapath, errorpath, journalpath, len(done) > 0, syncevery, delim, indexpath)
+	else:
+		writer = SliceJournal.SliceWriter(slicemetapath, errorpath, journalpath, len(done) > 0, syncevery, delim)
+	statsrows = list()
+	prefetchstats = dict()
+	timings = list()
+	deferrals = dict()
+	# scratch directory -> [HTID, number of chunks, chunks still out,
+	# name of the first exception a chunk raised or None]
 
-	with open(metaoutpath, mode = 'a', encoding = 'utf-8') as file:
-		for metatuple in processedmeta:
-			outlist = [x for x in metatuple]
-			outline = delim.join(outlist) + '\n'
-			file.write(outline)
+	try:
+		for aHTID in missing:
+			print(aHTID + " is missing.")
+			return_dict = new_result(aHTID)
+			return_dict["errors"] = [aHTID + '\t' + "missing"]
+			record_result(writer, return_dict, statsrows)
+			# Just what process_a_file would have reported.
+
+		# Record each batch as it comes back, in whatever order the workers
+		# finish them. We keep only as many batches out as there are
+		# workers, so that the chunks of a deferred volume (see bigvolume)
+		# go to the next free worker rather than behind the whole slice.
+
+		nextpaths = [volume_filename(x[0][0]) for x in batches[workers:]] + [None] * min(workers, len(batches))
+		# For each batch, the first volume of the batch that goes out
+		# workers batches after it: roughly the one its worker will get
+		# next. (The batches just after it go to the other workers, which
+		# usually start them before this one is done.)
+
+		work = deque(zip(batches, nextpaths))
+		events = queue.Queue()
+		batchesout = 0
+		tasksout = 0
+
+		while True:
+			while batchesout < workers and len(work) > 0:
+				submit(pool, events, process_a_batch, work.popleft())
+				batchesout += 1
+				tasksout += 1
+			if tasksout < 1:
+				break
+
+			function, task, result, error = events.get()
+			tasksout -= 1
+
+			if function == process_a_batch:
+				batchesout -= 1
+				if error is not None:
+					raise error
+					# process_a_batch catches each volume's exceptions, so
+					# this is something wrong with the pool itself.
+				if result["prefetch"] is not None:
+					Prefetcher.add_stats(prefetchstats, result["prefetch"])
+				timings.append(result["timing"])
+				for file_dict in result["results"]:
+					if file_dict["deferred"] is None:
+						record_result(writer, file_dict, statsrows)
+						continue
+					thisID, scratch, chunkcount = file_dict["deferred"]
+					print(thisID + " is a large long-s volume; correcting it across the pool.")
+					deferrals[scratch] = [thisID, chunkcount, chunkcount, None]
+					for index in range(chunkcount):
+						submit(pool, events, correct_deferred_chunk, (scratch, index))
+						tasksout += 1
+				if lease is not None and not lease.renew():
+					print("Lost the lease on " + lease.name + "; leaving the rest of it to the job that reclaimed it.")
+					return False
+
+			elif function == correct_deferred_chunk:
+				scratch = task[0]
+				deferral = deferrals[scratch]
+				deferral[2] -= 1
+				if error is not None and deferral[3] is None:
+					deferral[3] = type(error).__name__
+					print(deferral[0] + " failed: " + deferral[3] + ": " + str(error))
+				if deferral[2] > 0:
+					continue
+				if deferral[3] is None:
+					submit(pool, events, finish_deferred, (scratch, deferral[1]))
+					tasksout += 1
+				else:
+					record_failure(writer, deferral[0], deferral[3], statsrows)
+					shutil.rmtree(scratch, ignore_errors = True)
+					del deferrals[scratch]
 
-	# Write the errorlog.
+			else:
+				scratch = task[0]
+				thisID = deferrals.pop(scratch)[0]
+				if error is not None:
+					print(thisID + " failed: " + type(error).__name__ + ": " + str(error))
+					record_failure(writer, thisID, type(error).__name__, statsrows)
+					shutil.rmtree(scratch, ignore_errors = True)
+				else:
+					record_result(writer, result, statsrows)
 
-	if len(errorlog) > 0:
-		with open(errorpath, mode = 'w', encoding = 'utf-8') as file:
-			for line in errorlog:
-				file.write(line + '\n')
+	finally:
+		writer.close()
+		for scratch in deferrals:
+			shutil.rmtree(scratch, ignore_errors = True)
 
-	# Write phrase counts.
+	# Write the phrase counts.
 
 	# with open(phrasecountpath, mode="w", encoding = "utf-8") as file:
 	#     j = json.dumps(phrasecount)
 	#     file.write(j)
 
-	print("Done.")
-	pool.close()
-	pool.join()
+	# Write timing and memory for each volume.
 
-	# Done.
+	if instrument:
+		StageTimer.write_stats(statspath, statsrows)
+
+	if len(prefetchstats) > 0:
+		print(Prefetcher.describe(prefetchstats))
+
+	print(VolumeScheduler.describe(timings, workers, VolumeScheduler.old_batches(file_tuples, workers)))
+	# The old batches are file_tuples in hash order, chunked as map_async
+	# used to chunk them.
+
+	return True
 
 # FUNCTIONS.
 
+def submit(pool, events, function, task):
+	'''Hands task to function on pool. When it's done, events gets
+	(function, task, result, None), or (function, task, None, exception)
+	if it raised one.'''
+
+	pool.apply_async(function, (task,), callback = lambda result: events.put((function, task, result, None)), error_callback = lambda error: events.put((function, task, None, error)))
+
+def record_failure(writer, thisID, errorname, statsrows):
+	'''Records a deferred volume that failed after its worker sent it back,
+	just as process_safely would have.'''
+
+	file_dict = new_result(thisID)
+	file_dict["errors"] = [thisID + '\t' + errorname]
+	record_result(writer, file_dict, statsrows)
+
+def record_result(writer, file_dict, statsrows):
+	'''Writes one volume's metadata and errors; the writer journals it as
+	done at its next sync. Its timings wait in statsrows until the end of
+	the run.'''
+
+	writer.record(file_dict["htid"], file_dict["metadata"], file_dict["errors"], file_dict["segments"])
+	if file_dict["stats"] is not None:
+		volpath, stats = file_dict["stats"]
+		statsrows.append((file_dict["htid"], volpath, stats))
+
 def subtract_counts (token, adict, tosubtract):
 	if token in adict:
 		adict[token] = adict[token] - tosubtract
@@ -242,45 +545,8 @@ def dirty_pairtree(htid):
 # We define two different IO functions, for zip files and regular text files.
 # The decision between them is defined by the extension on the filename;
 # each function encapulates error-handling and returns a successflag that
-# reports error status.
-
-def read_zip(filepath):
-	pagelist = list()
-	try:
-		with ZipFile(file = filepath, mode='r') as zf:
-			for member in zf.infolist():
-				pathparts = member.filename.split("/")
-				suffix = pathparts[1]
-				if "_" in suffix:
-					segments = suffix.split("_")
-					page = segments[-1][0:-4]
-				else:
-					page = suffix[0:-4]
-
-				if len(page) > 0 and page[0].isdigit():
-					numericpage = True
-				else:
-					if len(page) > 0 and page!="notes" and page!="pagedata":
-						print("Non-numeric pagecode: " + page)
-					numericpage = False
-
-				if not member.filename.endswith('/') and not member.filename.endswith("_Store") and not member.filename.startswith("_") and numericpage:
-					datafile = zf.open(member, mode='r')
-					linelist = [x.decode(encoding="UTF-8") for x in datafile.readlines()]
-					pagelist.append((page, linelist))
-
-		pagelist.sort()
-		pagecount = len(pagelist)
-		if pagecount > 0:
-			successflag = "success"
-			pagelist = [x[1] for x in pagelist]
-		else:
-			successflag = "missing file"
-
-	except IOError as e:
-		successflag = "missing file"
-
-	return pagelist, successflag
+# reports error status. read_zip is shared with the streaming path, and lives
+# in VolumeReader.
 
 def read_txt(filepath):
 	pagelist = list()
@@ -391,57 +657,240 @@ def get_metadata_evidence(htid, rowindices, columns, metadata):
 
 	return metadata_evidence
 
-# Workhorse function.
+def volume_filename(thisID):
+	if manifest is not None:
+		path = manifest.path(thisID)
+		if path is not None:
+			return path
 
-def process_a_file(file_tuple):
-	global testrun, pairtreepath, datapath, genremapdir, felecterrors, selecttruths, debug, phraseset, pagevocabset, meaningfulheaders
+	if not testrun:
+		filepath, postfix = FileCabinet.pairtreepath(thisID, datapath)
+		return filepath + postfix + '/' + postfix + ".zip"
+	else:
+		return datapath + thisID
 
-	thisID, metadata_evidence = file_tuple
+def output_dir(filepath, postfix):
+	'''The directory process_a_file writes a volume's files to: its own in the
+	pairtree, or in segment mode a scratch directory for this process, from
+	which pack_outputs moves them into a segment.'''
 
-	perfileerrorlog = list()
+	if outputmode == "segments":
+		scratch = os.path.join(tempfile.gettempdir(), 'normalize.' + str(os.getpid())) + '/'
+		os.makedirs(scratch, exist_ok = True)
+		return scratch
+	else:
+		return filepath + postfix + '/'
+
+segmentwriter = None
+# This process's SegmentWriter, made when it first has something to write.
+
+def pack_outputs(return_dict):
+	'''In segment mode, appends the files process_a_file left in scratch for
+	this volume to our segment, deletes them, and lists their index entries
+	in return_dict["segments"].'''
+
+	global segmentwriter
+
+	if outputmode != "segments" or testrun:
+		return
+
+	if segmentwriter is None or segmentwriter.pid != os.getpid():
+		segmentwriter = SegmentStore.SegmentWriter(segmentdir, segmentcompression)
+		# A worker forked after the parent made its own writer has to make
+		# a new one, so that no two processes append to the same segment.
+
+	thisID = return_dict["htid"]
+	filepath, postfix = FileCabinet.pairtreepath(thisID, datapath)
+	scratch = output_dir(filepath, postfix)
+	for kind in ["norm.txt", "pg.tsv", "hdr.tsv", "ftr.tsv"]:
+		path = scratch + postfix + '.' + kind
+		if not os.path.exists(path):
+			continue
+		with open(path, mode = 'rb') as f:
+			data = f.read()
+		return_dict["segments"].append(segmentwriter.add(thisID, kind, data))
+		os.remove(path)
+
+def process_a_batch(work):
+	'''Runs process_a_file on a batch (a list of file_tuples) in one worker,
+	reading ahead with a Prefetcher if prefetch is on. work is the batch and
+	the path of a zipfile to warm the cache with afterwards, or None.
+	Returns a dictionary with the list of results, the prefetcher's stats
+	(or None), and a timing for the scheduler's report.'''
+
+	global prefetch, prefetchbudget, testrun
+
+	batch, nextpath = work
+	paths = list()
+	if len(batch) > 1:
+		paths = [volume_filename(x[0]) for x in batch]
+		# A volume on its own has nothing to be read ahead of, so the worker
+		# reads it itself.
+
+	prefetcher = None
+	if prefetch > 0 and not testrun and (len(paths) > 0 or nextpath is not None):
+		prefetcher = Prefetcher.Prefetcher(paths, prefetch, prefetchbudget, nextpath)
+	reader = None
+	if len(paths) > 0:
+		reader = prefetcher
+
+	batch_dict = dict()
+	batch_dict["results"] = list()
+	batch_dict["prefetch"] = None
+	start = time.time()
+	seconds = dict()
+
+	try:
+		for file_tuple in batch:
+			volstart = time.time()
+			file_dict = process_safely(file_tuple, reader)
+			batch_dict["results"].append(file_dict)
+			seconds[file_tuple[0]] = time.time() - volstart
+	finally:
+		if prefetcher is not None:
+			prefetcher.close()
+
+	if segmentwriter is not None:
+		segmentwriter.sync()
+		# The parent indexes these volumes as soon as the batch comes back.
+
+	if prefetcher is not None:
+		batch_dict["prefetch"] = prefetcher.stats()
+	batch_dict["timing"] = VolumeScheduler.batch_timing(start, seconds)
+
+	return batch_dict
+
+def process_safely(file_tuple, prefetcher = None, deferred = None):
+	'''Runs process_a_file and packs its outputs. If anything goes wrong
+	that process_a_file doesn't handle itself (a damaged zipfile, running
+	out of memory), the volume gets a result with the name of the exception
+	as its error, so it's journaled like any other failure and the rest of
+	the batch carries on.'''
+
+	try:
+		file_dict = process_a_file(file_tuple, prefetcher, deferred)
+		pack_outputs(file_dict)
+	except Exception as e:
+		thisID = file_tuple[0]
+		print(thisID + " failed: " + type(e).__name__ + ": " + str(e))
+		file_dict = new_result(thisID)
+		file_dict["errors"] = [thisID + '\t' + type(e).__name__]
+
+	return file_dict
+
+def spill_deferred(file_tuple, firstpass, perfileerrorlog, timer):
+	'''Writes a deferred volume's first pass, and the chunks its contextual
+	correction will be split into, to a new scratch directory under
+	deferdir. Returns the directory and the number of chunks.'''
+
+	scratch = tempfile.mkdtemp(prefix = 'deferred', dir = deferdir)
+	try:
+		chunks = Context.split_chunks(firstpass[7].corrected, debug)
+		for index, chunk in enumerate(chunks):
+			write_scratch(os.path.join(scratch, 'chunk' + str(index)), chunk)
+		write_scratch(os.path.join(scratch, 'firstpass'), (file_tuple, firstpass, perfileerrorlog, timer))
+	except:
+		shutil.rmtree(scratch, ignore_errors = True)
+		raise
+
+	return scratch, len(chunks)
+
+def correct_deferred_chunk(task):
+	'''Runs Context.correct_chunk on one chunk of a deferred volume. task is
+	its scratch directory and the chunk's number; the result is left in the
+	directory for finish_deferred.'''
+
+	scratch, index = task
+	chunkpath = os.path.join(scratch, 'chunk' + str(index))
+	result = Context.correct_chunk(read_scratch(chunkpath))
+	write_scratch(os.path.join(scratch, 'result' + str(index)), result)
+	os.remove(chunkpath)
+
+def finish_deferred(task):
+	'''Merges the corrected chunks of a deferred volume and finishes it
+	from the first pass its worker spilled. task is the scratch directory
+	and the number of chunks; the directory is removed afterwards. Returns
+	the volume's result, as process_safely does.'''
+
+	scratch, chunkcount = task
+	try:
+		file_tuple, firstpass, perfileerrorlog, timer = read_scratch(os.path.join(scratch, 'firstpass'))
+		results = list()
+		for index in range(chunkcount):
+			results.append(read_scratch(os.path.join(scratch, 'result' + str(index))))
+		contextresult = Context.merge_chunks(results)
+		del results
+		file_dict = process_safely(file_tuple, deferred = (firstpass, perfileerrorlog, timer, contextresult))
+	finally:
+		shutil.rmtree(scratch, ignore_errors = True)
+
+	if segmentwriter is not None:
+		segmentwriter.sync()
+
+	return file_dict
+
+def write_scratch(path, thing):
+	with open(path, mode = 'wb') as f:
+		pickle.dump(thing, f, protocol = pickle.HIGHEST_PROTOCOL)
+
+def read_scratch(path):
+	with open(path, mode = 'rb') as f:
+		return pickle.load(f)
+
+def new_result(thisID):
 	return_dict = dict()
 	return_dict["htid"] = thisID
 	return_dict["metadata"] = (thisID, "0", "0", "0", "0", "0")
 	return_dict["errors"] = []
 	return_dict["phrasecounts"] = dict()
+	return_dict["stats"] = None
+	return_dict["deferred"] = None
+	return_dict["segments"] = list()
+	# If we defer a large volume (see bigvolume), this is its HTID, the
+	# scratch directory we spilled it to, and its number of chunks.
+	# In segment mode, segments lists the index entries of its files.
+	# On success stats becomes (path, timings), where path says whether the
+	# volume was streamed, went through the batch path, or tried both.
+	return return_dict
 
-	if testrun:
-		cleanID = clean_pairtree(thisID.replace("norm.txt", ""))
-	else:
-		cleanID = clean_pairtree(thisID)
+# Workhorse function.
 
-	if not testrun:
-		filepath, postfix = FileCabinet.pairtreepath(thisID, datapath)
-		filename = filepath + postfix + '/' + postfix + ".zip"
-	else:
-		filename = datapath + thisID
+def read_and_correct(thisID, filename, data, timer, perfileerrorlog):
+	'''Reads a volume and runs it through as_stream and the first pass of
+	correct_stream. Returns None if the file couldn't be read, having logged
+	why in perfileerrorlog; otherwise a tuple of what the rest of
+	process_a_file needs.'''
 
-	# ACTUALLY READ THE FILE.
+	global debug, writeheaders, felecterrors, selecttruths
 
+	timer.start('zip read')
 	if filename.endswith('.zip'):
-		pagelist, successflag = read_zip(filename)
+		pagelist, successflag = read_zip(filename, data)
 	else:
 		pagelist, successflag = read_txt(filename)
+	timer.stop()
 
 	if successflag == "missing file":
 		print(thisID + " is missing.")
 		perfileerrorlog.append(thisID + '\t' + "missing")
-		return_dict["errors"] = perfileerrorlog
-		return return_dict
+		return None
 
 	elif successflag == "pagination error":
 		print(thisID + " has a pagination problem.")
 		perfileerrorlog.append(thisID + '\t' + "paginationerror")
-		return_dict["errors"] = perfileerrorlog
-		return return_dict
+		return None
 
 	elif successflag == "unicode error":
 		print(thisID + " can not be decoded by unicode.")
 		perfileerrorlog.append(thisID + '\t' + "unicode error")
-		return_dict["errors"] = perfileerrorlog
-		return return_dict
+		return None
 
-	tokens, pre_matched, pre_english, pagedata, headerlist = NormalizeVolume.as_stream(pagelist, verbose=debug)
+	headermap = None
+	footermap = None
+	if writeheaders:
+		headermap = HeaderFinder.HeaderMap()
+		footermap = HeaderFinder.HeaderMap()
+	tokens, pre_matched, pre_english, pagedata, headerlist = NormalizeVolume.as_stream(pagelist, verbose=debug, timer=timer, headermap=headermap, footermap=footermap)
 
 	if pre_english < 0.6:
 		perfileerrorlog.append(thisID + '\t' + "not english")
@@ -452,44 +901,106 @@ def process_a_file(file_tuple):
 		print(thisID, "has only tokencount", len(tokens))
 		perfileerrorlog.append(thisID + '\t' + 'short')
 
-	correct_tokens, pages, post_matched, post_english = NormalizeVolume.correct_stream(tokens, verbose = debug)
+	timer.start('correct_stream')
+	state = NormalizeVolume.default_session.correct_volume(tokens, verbose = debug, longs = LongSCounter(felecterrors, selecttruths))
 
-	# Combine page dictionaries into a master dictionary.
-	# If you ask, why didn't you just produce one in the first place? ...
-	# answer has to do with flexibility of the Volume module for other purposes.
-
-	pagecounter = 0
-	masterdict = dict()
-	for page in pages:
-		for item in page:
-			if item in masterdict:
-				masterdict[item] += page[item]
-			else:
-				masterdict[item] = page[item]
+	return pre_matched, pre_english, pagedata, headerlist, headermap, footermap, tokencount, state
 
-	# Now that we have a master dictionary, consider whether there are long-s problems.
-	# This algorithm works adequately.
+def process_a_file(file_tuple, prefetcher = None, deferred = None):
+	global testrun, pairtreepath, datapath, genremapdir, felecterrors, selecttruths, debug, phraseset, pagevocabset, meaningfulheaders, streaming, instrument, earlylongs, bigvolume, writeheaders
 
-	errors = 1
-	truths = 1
-	# Initialized to 1 as a Laplacian correction.
+	thisID, metadata_evidence = file_tuple
 
-	for word in felecterrors:
-		errors = errors + masterdict.get(word, 0)
-	for word in selecttruths:
-		truths = truths + masterdict.get(word, 0)
+	perfileerrorlog = list()
+	return_dict = new_result(thisID)
+
+	timer = StageTimer.new_timer(instrument)
+	volpath = "batch"
+	contextresult = None
+	if deferred is not None:
+		volpath = "deferred"
+		firstpass, perfileerrorlog, timer, contextresult = deferred
+		# What the worker that deferred this volume had already done, and
+		# its contextual correction, done in chunks across the pool. The
+		# timer carries on from the first worker's stages.
 
-	if truths > errors:
-		LongSproblem = False
+	if testrun:
+		cleanID = clean_pairtree(thisID.replace("norm.txt", ""))
 	else:
-		LongSproblem = True
+		cleanID = clean_pairtree(thisID)
+
+	if not testrun:
+		filepath, postfix = FileCabinet.pairtreepath(thisID, datapath)
+		outdir = output_dir(filepath, postfix)
+	filename = volume_filename(thisID)
+
+	data = None
+	if prefetcher is not None:
+		timer.start('prefetch wait')
+		data = prefetcher.take(filename)
+		timer.stop()
+		# The bytes of the zipfile, if the prefetcher has them; otherwise we
+		# read it ourselves below.
+
+	# STREAM THE FILE, if we can.
+
+	if streaming and deferred is None and not testrun and filename.endswith('.zip'):
+		normpath = outdir + postfix + ".norm.txt"
+		pgpath = outdir + postfix + ".pg.tsv"
+		hdrpath = None
+		ftrpath = None
+		if writeheaders:
+			hdrpath = outdir + postfix + ".hdr.tsv"
+			ftrpath = outdir + postfix + ".ftr.tsv"
+		successflag, stats = StreamingNormalizer.normalize_zip(filename, normpath, pgpath, thisID, metadata_evidence, pagevocabset, meaningfulheaders, felecterrors, selecttruths, verbose = debug, timer = timer, decideafter = earlylongs, hdrpath = hdrpath, ftrpath = ftrpath, data = data)
+
+		if successflag == "success":
+			return_dict["stats"] = ("stream", timer.stats())
+			return report_streamed(thisID, stats, return_dict)
+
+		volpath = "stream+batch"
+
+		# Anything else (long s, misaligned pages, or a file we couldn't read)
+		# goes through the batch path, which knows how to log those problems.
+
+	# ACTUALLY READ THE FILE.
+
+	if deferred is None:
+		firstpass = read_and_correct(thisID, filename, data, timer, perfileerrorlog)
+		if firstpass is None:
+			return_dict["errors"] = perfileerrorlog
+			return return_dict
+
+	pre_matched, pre_english, pagedata, headerlist, headermap, footermap, tokencount, state = firstpass
+	correct_tokens = state.corrected
+	pages = state.pages
+	post_matched, post_english = state.match_rates()
+
+	# Consider whether there are long-s problems. We used to combine the page
+	# dictionaries into a master dictionary to find out; now the counter we
+	# passed to correct_volume counted the test words as it went. It has no
+	# early decision, so it sees the whole volume.
+
+	LongSproblem = state.longs.long_s_problem()
+
+	if LongSproblem and bigvolume > 0 and tokencount > bigvolume and deferred is None:
+		timer.stop()
+		scratch, chunkcount = spill_deferred(file_tuple, firstpass, perfileerrorlog, timer)
+		return_dict["deferred"] = (thisID, scratch, chunkcount)
+		return return_dict
+		# finish_deferred picks up from here, so the volume isn't read and
+		# corrected a second time.
+
+	timer.start('Context')
 
 	if LongSproblem == False:
 		corrected = correct_tokens
 		deleted = dict()
 		added = dict()
 	else:
-		deleted, added, corrected, changedphrases, unchanged = Context.catch_ambiguities(correct_tokens, debug)
+		if contextresult is None:
+			contextresult = Context.catch_ambiguities(correct_tokens, debug)
+		deleted, added, corrected, changedphrases, unchanged = contextresult
 		# okay, this is crazy and not efficient to run, but it's easy to write and there are a small number
 		# of these files -- so I'm going to count the new contextually-corrected tokens by re-running them
 		# through Volume.
@@ -499,22 +1010,14 @@ def process_a_file(file_tuple):
 
 	# If we are upvoting tokens in the header, they need to be added here.
 
+	timer.start('header boost')
+
 	if len(pages) != len(headerlist):
 		print(thisID + " fails a routine check of alignment between pages and headers.")
 	else:
+		headerdicts = NormalizeVolume.default_session.correct_headers(headerlist)
 		for index, page in enumerate(pages):
-			thispageheader = headerlist[index]
-			header_tokens, header_pages, dummy1, dummy2 = NormalizeVolume.correct_stream(thispageheader, verbose = debug)
-			headerdict = header_pages[0]
-			for key, value in headerdict.items():
-				if key in meaningfulheaders:
-					if key in page:
-						page[key] += 2
-						# a fixed increment no matter how many times the word occurs in the
-						# header
-					else:
-						page[key] = 2
-						print("Word " + key + " in headerdict for " + thisID + " at " + str(index) + " but not main page.")
+			StreamingNormalizer.boost_headers(page, headerdicts[index], meaningfulheaders, thisID, index)
 
 	# Write corrected file.
 	cleanHTID = clean_pairtree(thisID)
@@ -531,13 +1034,15 @@ def process_a_file(file_tuple):
 
 		outfilename = outpath + "texts/" + outHTID
 	else:
-		outfilename = filepath + postfix + '/' + postfix + ".norm.txt"
+		outfilename = outdir + postfix + ".norm.txt"
 
+	timer.start('.norm.txt write')
 	with open(outfilename, mode = 'w', encoding = 'utf-8') as file:
-		for token in corrected:
-			if token != '\n' and token != "“" and not (token.startswith('<') and token.endswith('>')):
-				token = token + " "
-			file.write(token)
+		StreamingNormalizer.write_tokens(file, corrected)
+	if headermap is not None:
+		headermap.write(outfilename.replace(".norm.txt", "") + ".hdr.tsv")
+		footermap.write(outfilename.replace(".norm.txt", "") + ".ftr.tsv")
+	timer.stop()
 
 	if len(pages) != len(pagedata):
 		perfileerrorlog.append("Discrepancy between page data and page metadata in \t" + thisID)
@@ -556,21 +1061,12 @@ def process_a_file(file_tuple):
 
 		outfilename = outpath + "pagefeatures/" + outHTID
 	else:
-		outfilename = filepath + postfix + '/' + postfix + ".pg.tsv"
+		outfilename = outdir + postfix + ".pg.tsv"
 
+	timer.start('.pg.tsv write')
 	with open(outfilename, mode = 'w', encoding = 'utf-8') as file:
 
-		if metadata_evidence["biography"]:
-			file.write("-1\t#metaBiography\t0\n")
-
-		if metadata_evidence["drama"]:
-			file.write("-1\t#metaDrama\t0\n")
-
-		if metadata_evidence["fiction"]:
-			file.write("-1\t#metaFiction\t0\n")
-
-		if metadata_evidence["poetry"]:
-			file.write("-1\t#metaPoetry\t0\n")
+		StreamingNormalizer.write_metadata_features(file, metadata_evidence)
 
 		numberofpages = len(pages)
 		for index, page in enumerate(pages):
@@ -581,32 +1077,33 @@ def process_a_file(file_tuple):
 			if testrun and "untypical" in page and (index +2) > numberofpages:
 				continue
 
-			otherfeatures = 0
+			totalwordsinvol += StreamingNormalizer.write_page(file, index, page, pagedata[index], pagevocabset)
 
-			for feature, count in page.items():
-				if feature in pagevocabset or feature.startswith("#"):
-					outline = str(index) + '\t' + feature + '\t' + str(count) + '\n'
-					# pagenumber, featurename, featurecount
-					file.write(outline)
-				else:
-					otherfeatures += count
+	timer.stop()
+	timer.count(len(pages), tokencount)
 
-				if not feature.startswith("#"):
-					totalwordsinvol += count
-				# This is because there are structural features like #allcapswords
-				# that should not be counted toward total token count.
+	metatuple = (thisID, str(totalwordsinvol), str(pre_matched), str(pre_english), str(post_matched), str(post_english))
 
-			structural_features = pagedata[index]
-			for feature, count in structural_features.items():
-				if count > 0 or feature == "#textlines":
-					outline = str(index) + '\t' + feature + '\t' + str(count) + '\n'
-					file.write(outline)
+	return_dict["metadata"] = metatuple
+	return_dict["errors"] = perfileerrorlog
+	return_dict["stats"] = (volpath, timer.stats())
 
-			if otherfeatures > 0:
-				outline = str(index) + '\t' + "wordNotInVocab" + '\t' + str(otherfeatures) + '\n'
-				file.write(outline)
+	return return_dict
 
-	metatuple = (thisID, str(totalwordsinvol), str(pre_matched), str(pre_english), str(post_matched), str(post_english))
+def report_streamed(thisID, stats, return_dict):
+	'''Fills in return_dict for a volume that StreamingNormalizer has already
+	written, logging the same problems the batch path would.'''
+
+	perfileerrorlog = list()
+
+	if stats["pre_english"] < 0.6:
+		perfileerrorlog.append(thisID + '\t' + "not english")
+
+	if stats["tokencount"] < 10:
+		print(thisID, "has only tokencount", stats["tokencount"])
+		perfileerrorlog.append(thisID + '\t' + 'short')
+
+	metatuple = (thisID, str(stats["totalwordsinvol"]), str(stats["pre_matched"]), str(stats["pre_english"]), str(stats["post_matched"]), str(stats["post_english"]))
 
 	return_dict["metadata"] = metatuple
 	return_dict["errors"] = perfileerrorlog
@@ -33,9 +33,10 @@ import FileCabinet
 import NormalizeVolume
 import Context
 import PhraseCounter
+from VolumeReader import read_zip
+import PairtreeManifest
 import json
 import os, sys, time
-from zipfile import ZipFile
 
 testrun = True
 # Setting this flag to "true" allows me to run the script on a local machine instead of
@@ -120,6 +121,11 @@ longSpath = pathdictionary['slicepath'] + slicename + 'longS.txt'
 phrasecountpath = longSpath = pathdictionary['slicepath'] + slicename + 'phrasecount.json'
 headeroutpath = pathdictionary['slicepath'] + slicename + "headers.txt"
 
+manifest = None
+if not testrun:
+    manifest = PairtreeManifest.open_manifest(datapath)
+    # If the pairtree has a manifest, we find zipfiles there.
+
 if testrun:
     genremapdir = "/Volumes/TARDIS/output/newlog1/"
 else:
@@ -178,45 +184,8 @@ pagevocabset = set([x.strip() for x in filelines])
 # We define two different IO functions, for zip files and regular text files.
 # The decision between them is defined by the extension on the filename;
 # each function encapulates error-handling and returns a successflag that
-# reports error status.
-
-def read_zip(filepath):
-    pagelist = list()
-    try:
-        with ZipFile(file = filepath, mode='r') as zf:
-            for member in zf.infolist():
-                pathparts = member.filename.split("/")
-                suffix = pathparts[1]
-                if "_" in suffix:
-                    segments = suffix.split("_")
-                    page = segments[-1][0:-4]
-                else:
-                    page = suffix[0:-4]
-
-                if len(page) > 0 and page[0].isdigit():
-                    numericpage = True
-                else:
-                    if len(page) > 0 and page!="notes" and page!="pagedata":
-                        print("Non-numeric pagecode: " + page)
-                    numericpage = False
-
-                if not member.filename.endswith('/') and not member.filename.endswith("_Store") and not member.filename.startswith("_") and numericpage:
-                    datafile = zf.open(member, mode='r')
-                    linelist = [x.decode(encoding="UTF-8") for x in datafile.readlines()]
-                    pagelist.append((page, linelist))
-
-        pagelist.sort()
-        pagecount = len(pagelist)
-        if pagecount > 0:
-            successflag = "success"
-            pagelist = [x[1] for x in pagelist]
-        else:
-            successflag = "missing file"
-
-    except IOError as e:
-        successflag = "missing file"
-
-    return pagelist, successflag
+# reports error status. read_zip is shared with the streaming path, and lives
+# in VolumeReader.
 
 def read_txt(filepath):
     pagelist = list()
@@ -302,6 +271,8 @@ for thisID in HTIDs:
     if not testrun:
         filepath, postfix = FileCabinet.pairtreepath(thisID, datapath)
         filename = filepath + postfix + '/' + postfix + ".zip"
+        if manifest is not None and manifest.path(thisID) is not None:
+            filename = manifest.path(thisID)
     else:
         filename = datapath + thisID
 
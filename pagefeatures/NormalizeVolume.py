@@ -1,6 +1,10 @@
 import re
 import math
+import threading
+from collections import OrderedDict
 import HeaderFinder
+from StageTimer import NULLTIMER
+from LongSEvidence import LongSCounter
 
 ## The following lines generate a translation map that zaps all
 ## non-alphanumeric characters in a token.
@@ -22,121 +26,151 @@ alphabet = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k', 'l', 'm', 'n'
 honorifics = ["sir", "mr", "m", "miss", "mrs", "lord", "lady", "prince", "king", "queen"]
 
 delim = '\t'
-foundcounter = 0
-englishcounter = 0
-pagedict = dict()
 
 import FileCabinet
+import RuleSnapshot
 
 pathdictionary = FileCabinet.loadpathdictionary()
 
 rulepath = pathdictionary['volumerulepath']
 
-romannumerals = set()
-with open(rulepath + 'romannumerals.txt', encoding = 'utf-8') as file:
-    filelines = file.readlines()
+volumerulefiles = ['romannumerals.txt', 'MainDictionary.txt', 'PersonalNames.txt', 'PlaceNames.txt', 'CorrectionRules.txt', 'HyphenRules.txt', 'FusingRules.txt', 'SyncopeRules.txt', 'VariantSpellings.txt']
 
-for line in filelines:
-    line = line.rstrip()
-    romannumerals.add(line)
+def parse_rulesets(rulepath):
+    '''Reads the plain-text rulesets in rulepath and returns them as a
+    dictionary of tables. This is the slow path; normally the tables come
+    from a snapshot compiled by RuleSnapshot.'''
 
-lexicon = dict()
+    romannumerals = set()
+    with open(rulepath + 'romannumerals.txt', encoding = 'utf-8') as file:
+        filelines = file.readlines()
 
-with open(rulepath + 'MainDictionary.txt', encoding = 'utf-8') as file:
-    filelines = file.readlines()
+    for line in filelines:
+        line = line.rstrip()
+        romannumerals.add(line)
 
-for line in filelines:
-    line = line.rstrip()
-    fields = line.split(delim)
-    englflag = int(fields[1])
-    lexicon[fields[0]] = englflag
+    lexicon = dict()
 
-personalnames = set()
-with open(rulepath + 'PersonalNames.txt', encoding = 'utf-8') as file:
-    filelines = file.readlines()
+    with open(rulepath + 'MainDictionary.txt', encoding = 'utf-8') as file:
+        filelines = file.readlines()
 
-for line in filelines:
-    line = line.rstrip()
-    line = line.lower()
-    personalnames.add(line)
+    for line in filelines:
+        line = line.rstrip()
+        fields = line.split(delim)
+        englflag = int(fields[1])
+        lexicon[fields[0]] = englflag
 
-placenames = set()
-with open(rulepath + 'PlaceNames.txt', encoding = 'utf-8') as file:
-    filelines = file.readlines()
+    personalnames = set()
+    with open(rulepath + 'PersonalNames.txt', encoding = 'utf-8') as file:
+        filelines = file.readlines()
 
-for line in filelines:
-    line = line.rstrip()
-    line = line.lower()
-    placenames.add(line)
+    for line in filelines:
+        line = line.rstrip()
+        line = line.lower()
+        personalnames.add(line)
 
-correctionrules = dict()
+    placenames = set()
+    with open(rulepath + 'PlaceNames.txt', encoding = 'utf-8') as file:
+        filelines = file.readlines()
 
-with open(rulepath + 'CorrectionRules.txt', encoding = 'utf-8') as file:
-    filelines = file.readlines()
+    for line in filelines:
+        line = line.rstrip()
+        line = line.lower()
+        placenames.add(line)
 
-for line in filelines:
-    line = line.rstrip()
-    fields = line.split(delim)
-    correctionrules[fields[0]] = fields[1]
+    correctionrules = dict()
+
+    with open(rulepath + 'CorrectionRules.txt', encoding = 'utf-8') as file:
+        filelines = file.readlines()
 
-hyphenrules = dict()
+    for line in filelines:
+        line = line.rstrip()
+        fields = line.split(delim)
+        correctionrules[fields[0]] = fields[1]
 
-with open(rulepath + 'HyphenRules.txt', encoding = 'utf-8') as file:
-    filelines = file.readlines()
-filelines.reverse()
-# Doing this so that unhyphenated forms get read before hyphenated ones.
+    hyphenrules = dict()
 
-for line in filelines:
-    line = line.rstrip()
-    fields = line.split(delim)
-    Word = fields[0].rstrip()
-    Corr = fields[1].rstrip()
-    hyphenrules[Word] = Corr
-    if " " not in Corr:
-        lexicon[Corr] = 1
-    else:
-        StripWord = Word.replace("-", "")
-        hyphenrules[StripWord] = Corr
-        ## That's so that we split "tigermoth" as well as "tiger-moth" into "tiger moth."
-
-    if "-" in Word:
-        StripWord = Word.replace("-", "")
-        StripCorr = Corr.replace(" ", "")
-        StripCorr = StripCorr.replace("-", "")
-        if StripWord != StripCorr and StripWord not in hyphenrules:
+    with open(rulepath + 'HyphenRules.txt', encoding = 'utf-8') as file:
+        filelines = file.readlines()
+    filelines.reverse()
+    # Doing this so that unhyphenated forms get read before hyphenated ones.
+
+    for line in filelines:
+        line = line.rstrip()
+        fields = line.split(delim)
+        Word = fields[0].rstrip()
+        Corr = fields[1].rstrip()
+        hyphenrules[Word] = Corr
+        if " " not in Corr:
+            lexicon[Corr] = 1
+        else:
+            StripWord = Word.replace("-", "")
             hyphenrules[StripWord] = Corr
-            print(Word, 'produced two corrections.')
-    ## The purpose of this is a bit obscure to me. It may be deletable.
-
-fuserules = dict()
-with open(rulepath + 'FusingRules.txt', encoding = 'utf-8') as file:
-    filelines = file.readlines()
-
-for Line in filelines:
-    Line = Line.rstrip()
-    LineParts = Line.split(delim)
-    Word = LineParts[0].rstrip()
-    Word = tuple(Word.split(' '))
-    Corr = LineParts[1].rstrip()
-    fuserules[Word] = Corr
-
-syncoperules = dict()
-with open(rulepath + 'SyncopeRules.txt', encoding = 'utf-8') as file:
-    filelines = file.readlines()
-
-for line in filelines:
-    line = line.rstrip()
-    fields = line.split(delim)
-    syncoperules[fields[0]] = fields[1]
+            ## That's so that we split "tigermoth" as well as "tiger-moth" into "tiger moth."
+
+        if "-" in Word:
+            StripWord = Word.replace("-", "")
+            StripCorr = Corr.replace(" ", "")
+            StripCorr = StripCorr.replace("-", "")
+            if StripWord != StripCorr and StripWord not in hyphenrules:
+                hyphenrules[StripWord] = Corr
+                print(Word, 'produced two corrections.')
+        ## The purpose of this is a bit obscure to me. It may be deletable.
+
+    fuserules = dict()
+    with open(rulepath + 'FusingRules.txt', encoding = 'utf-8') as file:
+        filelines = file.readlines()
+
+    for Line in filelines:
+        Line = Line.rstrip()
+        LineParts = Line.split(delim)
+        Word = LineParts[0].rstrip()
+        Word = tuple(Word.split(' '))
+        Corr = LineParts[1].rstrip()
+        fuserules[Word] = Corr
+
+    syncoperules = dict()
+    with open(rulepath + 'SyncopeRules.txt', encoding = 'utf-8') as file:
+        filelines = file.readlines()
+
+    for line in filelines:
+        line = line.rstrip()
+        fields = line.split(delim)
+        syncoperules[fields[0]] = fields[1]
 
-variants = dict()
-with open(rulepath + 'VariantSpellings.txt', encoding = 'utf-8') as file:
-    filelines = file.readlines()
+    variants = dict()
+    with open(rulepath + 'VariantSpellings.txt', encoding = 'utf-8') as file:
+        filelines = file.readlines()
 
-for line in filelines:
-    line = line.rstrip()
-    fields = line.split(delim)
-    variants[fields[0]] = fields[1]
+    for line in filelines:
+        line = line.rstrip()
+        fields = line.split(delim)
+        variants[fields[0]] = fields[1]
+
+    tables = dict()
+    tables['romannumerals'] = romannumerals
+    tables['lexicon'] = lexicon
+    tables['personalnames'] = personalnames
+    tables['placenames'] = placenames
+    tables['correctionrules'] = correctionrules
+    tables['hyphenrules'] = hyphenrules
+    tables['fuserules'] = fuserules
+    tables['syncoperules'] = syncoperules
+    tables['variants'] = variants
+    return tables
+
+rules = RuleSnapshot.load_rules('NormalizeVolume', rulepath, volumerulefiles, parse_rulesets)
+
+romannumerals = rules['romannumerals']
+lexicon = rules['lexicon']
+personalnames = rules['personalnames']
+placenames = rules['placenames']
+correctionrules = rules['correctionrules']
+hyphenrules = rules['hyphenrules']
+fuserules = rules['fuserules']
+syncoperules = rules['syncoperules']
+variants = rules['variants']
+del rules
 
 ## End loading of rulesets.
 
@@ -166,37 +200,530 @@ def standarddev(alist):
     stdev = math.sqrt(variance)
     return stdev
 
-def as_stream(pagelist, verbose = False):
-    '''Converts a list of pages to a list of tokens
-    Linebreaks are represented as separate tokens.
-    In the process we also collect data about each page,
-    including the number of lines, the number of lines with
-    text, the number that begin with a capital letter, the
-    max number of repeats for a single letter (not case-sensitive),
-    and the max number of repeats for an alphabetically-adjacent
-    pair of letters (not case-sensitive).'''
-
-    global lexicon, mosteraser, alphabet, punctnohyphen, personalnames, honorifics, romannumerals
-
-    headerlist = HeaderFinder.find_headers(pagelist, romannumerals)
-
-    if len(headerlist) != len(pagelist):
-        print("Headerlist: " + str(len(headerlist)))
-        print("Pagelist: " + str(len(pagelist)))
-        headerlist = [[]] * len(pagelist)
-    # These lengths ought to match up; if they don't, skip the whole header
-    # process while flagging the problem.
-
-    linelist = list()
-    firstpage = True
-    pagedata = list()
-
-    for page in pagelist:
-        if firstpage:
-            firstpage = False
+def strip_punctuation(astring):
+    global punctuple
+    keepclipping = True
+    suffix = ""
+    while keepclipping == True and len(astring) > 1:
+        keepclipping = False
+        if astring.endswith(punctuple):
+            suffix = astring[-1:] + suffix
+            astring = astring[:-1]
+            keepclipping = True
+    keepclipping = True
+    prefix = ""
+    while keepclipping == True and len(astring) > 1:
+        keepclipping = False
+        if astring.startswith(punctuple):
+            prefix = prefix + astring[:1]
+            astring = astring[1:]
+            keepclipping = True
+    return(prefix, astring, suffix)
+
+def normalize_case(astring):
+    if astring.islower():
+        case = 'lower'
+    elif astring.replace("'", "").isupper():
+        case = 'upper'
+    elif astring.istitle():
+        case = 'title'
+    elif astring.replace("'", "").istitle():
+        case = "title"
+    # The replace part is important lest all possessive words get interpreted
+    # as heterogenous-case.
+    else:
+        case = 'heterogenous'
+
+    if case != "heterogenous":
+        normalizedstring = astring.lower()
+    else:
+        normalizedstring = astring
+
+    return normalizedstring, case
+
+def mostly_numeric(astring):
+    counter = 0
+    for c in astring:
+        if c.isdigit():
+            counter += 1
+    if len(astring) < 1:
+        return False
+    elif counter/len(astring) > .35:
+        return True
+    else:
+        return False
+
+def arabic_digits(astring):
+    pricecodes = ["$", "£", "¢"]
+    counter = 0
+    for c in astring:
+        if c.isdigit():
+            counter += 1
+
+    priceflag = False
+    for code in pricecodes:
+        if astring.count(code) > 0:
+            priceflag = True
+    if astring.endswith("s") or astring.endswith("d"):
+        priceflag = True
+
+    if len(astring) < 1 or counter/len(astring) < .4:
+        return "none"
+    elif priceflag == True:
+        return "arabicprice"
+    elif counter < 2:
+        return "arabic1digit"
+    elif counter < 3:
+        return "arabic2digit"
+    elif counter < 4:
+        return "arabic3digit"
+    elif counter < 5:
+        return "arabic4digit"
+    else:
+        return "arabic5+digit"
+
+def all_nonalphanumeric(astring):
+    nonalphanum = True
+    for character in astring:
+        if character.isalpha() or character.isdigit():
+            nonalphanum = False
+    return nonalphanum
+
+COMMABREAK = re.compile(',\D')
+# Compiled once rather than on every line.
+
+def tokenize_line(line, tokens):
+    '''Splits one line of text into tokens and appends them to tokens,
+    followed by a newline token. A <pb> marker between pages becomes a
+    <pb> token plus a newline.'''
+
+    if len(line) < 1:
+        return
+    if line == "\n":
+        tokens.append(line)
+        return
+    line = line.rstrip()
+    if line == "<pb>":
+        tokens.append(line)
+        tokens.append('\n')
+        return
+
+    line = line.replace('”', '” ')
+    line = line.replace(':', ': ')
+    line = line.replace(';', '; ')
+    line = COMMABREAK.sub(commasplit, line)
+    # That replaces all commas with comma + space unless they are followed by a digit.
+    # Thus "300,000" isn't broken up but "my friend,Fred" is
+
+    line = line.replace('—', ' — ')
+    line = line.replace('--', ' -- ')
+    ## Instead of zapping final punctuation, we make sure it's followed by a space.
+
+    line = line.replace('_', ' ')
+    # But we do zap underscores, which are rarely meaningful.
+
+    # ## Quotes require special treatment, because their position relative to
+    # ## the space can be significant.
+
+    # if '"' in line:
+    #     nextindex = line.find('"')
+    #     while nextindex >= 0:
+    #         if nextindex >= (len(line) - 1):
+    #             followedbyspace = True
+    #             nextindex = -1
+    #         elif line[nextindex+1] == " ":
+    #             followedbyspace = True
+    #             nextindex = line.find('"', nextindex+1, len(line))
+    #         else:
+    #             if nextindex > 0 and line[nextindex - 1] == " ":
+    #                 line = line[0:nextindex] + '“ ' + line[nextindex+1:]
+    #                 nextindex = line.find('"', nextindex+2, len(line))
+    #                 ## Okay, this is a teensy bit baroque. I know that correct_stream
+    #                 ## doesn't handle prefixed punctuation very well. So I don't want
+    #                 ## quotes to be prefixed to words. But I want to preserve the fact
+    #                 ## that they were opening quotes. So I use the special open-quote
+    #                 ## character if quote was prefixed to a word, and preceded by
+    #                 ## a space.
+    #             elif nextindex == 0:
+    #                 line = '“' + line[nextindex+1:]
+    #                 nextindex = line.find('"', nextindex+2, len(line))
+    #             else:
+    #                 line = line[0:nextindex] + '" ' + line[nextindex+1:]
+    #                 nextindex = line.find('"', nextindex+2, len(line))
+    #                 ## If not preceded by a space, this is ambiguous, and I leave
+    #                 ## the character ambiguous.
+
+    lineparts = line.split()
+    tokens.extend(lineparts)
+    tokens.append('\n')
+
+class Tokenizer(object):
+    '''Tokenizes lines and, in the same pass, counts how many tokens match
+    the lexicon before correction, which as_stream reports as percentfound
+    and percentenglish. A fragment can also match by fusing with the token
+    after it, so the last token seen is held back until the next one arrives
+    (or until finish is called at the end of the volume).
+
+    Most tokens in a volume are repeats, so we remember how each distinct
+    token was classified, in known. Tokens that match (or definitely don't
+    match) by themselves map to a tuple of counts; tokens that might still
+    match by fusion map to their trimmed form, and only those need to look
+    at the next token.'''
+
+    __slots__ = ('lexicon', 'counter', 'englishcounter', 'allcounter', 'pending', 'known', 'trimmed')
+
+    def __init__(self, lexicon):
+        self.lexicon = lexicon
+        self.counter = 0
+        self.englishcounter = 0
+        self.allcounter = 0
+        self.pending = None
+        self.known = dict()
+        self.trimmed = dict()
+
+    def classify(self, token):
+        '''Returns (counter, englishcounter, allcounter) increments for a token
+        that can be classified on its own, or its trimmed lowercase form if it
+        can only match by fusing with the next token.'''
+
+        lexicon = self.lexicon
+        token = token.lower()
+        if token in lexicon:
+            if lexicon[token] > 0:
+                return (1, 1, 1)
+            else:
+                return (1, 0, 1)
+        elif token == '\n' or token.startswith('<') or mostly_numeric(token):
+            return (0, 0, 0)
+
+        token = token.translate(mosteraser)
+        if token in lexicon:
+            if lexicon[token] > 0:
+                return (1, 1, 1)
+            else:
+                return (1, 0, 1)
+
+        return token
+
+    def add_line(self, line, tokens):
+        '''Tokenizes line onto the end of tokens, and counts the new tokens.'''
+
+        self.add_lines([line], tokens)
+
+    def add_lines(self, lines, tokens):
+        '''Tokenizes lines onto the end of tokens, and counts the new tokens.'''
+
+        start = len(tokens)
+        for line in lines:
+            tokenize_line(line, tokens)
+
+        lexicon = self.lexicon
+        known = self.known
+        trimmed = self.trimmed
+        classify = self.classify
+        pending = self.pending
+        counter = 0
+        englishcounter = 0
+        allcounter = 0
+
+        for nexttoken in tokens[start:]:
+            if pending is None:
+                pending = nexttoken
+                continue
+
+            token = pending.lower()
+            if token in lexicon:
+                # The common case, handled without a function call.
+                counter += 1
+                allcounter += 1
+                if lexicon[token] > 0:
+                    englishcounter += 1
+            else:
+                result = known.get(pending)
+                if result is None:
+                    result = classify(pending)
+                    known[pending] = result
+
+                if type(result) is tuple:
+                    counter += result[0]
+                    englishcounter += result[1]
+                    allcounter += result[2]
+                else:
+                    nexttrim = trimmed.get(nexttoken)
+                    if nexttrim is None:
+                        nexttrim = nexttoken.lower().translate(mosteraser)
+                        trimmed[nexttoken] = nexttrim
+                    fused = result + nexttrim
+                    if fused in lexicon:
+                        counter += 1
+                        allcounter += 1
+                        if lexicon[fused] > 0:
+                            englishcounter += 1
+                    else:
+                        allcounter += 1
+            pending = nexttoken
+
+        self.pending = pending
+        self.counter += counter
+        self.englishcounter += englishcounter
+        self.allcounter += allcounter
+
+    def finish(self):
+        '''Counts the token held back at the end of the volume.'''
+
+        token = self.pending
+        self.pending = None
+        if token is None:
+            return
+
+        lexicon = self.lexicon
+        token = token.lower()
+        if token in lexicon:
+            self.counter += 1
+            self.allcounter += 1
+            if lexicon[token] > 0:
+                self.englishcounter += 1
+        elif token == '\n' or token.startswith('<') or mostly_numeric(token):
+            pass
         else:
-            linelist.append('<pb>')
+            self.allcounter += 1
+
+    def percentages(self):
+        if self.allcounter > 0:
+            percentfound = self.counter / self.allcounter
+            percentenglish = self.englishcounter / self.allcounter
+        else:
+            percentfound = 0
+            percentenglish = 0
+
+        return percentfound, percentenglish
+
+class VolumeState(object):
+    '''Everything correct_stream accumulates while it works through one
+    volume: the corrected tokens, the finished page dictionaries, the page
+    currently being counted, and the counts of matched and English words.
+    These used to be module globals, which meant only one volume could be
+    in progress at a time.
+
+    Longs is a LongSEvidence.LongSCounter that counts the words testing for
+    long s as they're logged, so the decision is ready when correction
+    finishes. By default it uses the standard word lists and never decides
+    early.'''
+
+    __slots__ = ('corrected', 'pages', 'pagedict', 'foundcounter', 'englishcounter', 'paratext', 'wordsfused', 'skipflag', 'longs')
+
+    def __init__(self, longs = None):
+        if longs is None:
+            longs = LongSCounter()
+        self.longs = longs
+        self.corrected = list()
+        self.pages = list()
+        self.pagedict = dict()
+        self.foundcounter = 0
+        self.englishcounter = 0
+        self.paratext = 0
+        self.wordsfused = 0
+        self.skipflag = False
+
+    def match_rates(self):
+        '''Returns the fraction of tokens that matched the lexicon, and the
+        fraction that matched English words. Paratext doesn't count.'''
+
+        totaltokens = len(self.corrected) - self.paratext
+        if totaltokens > 0:
+            percentmatched = self.foundcounter / totaltokens
+            percentenglish = self.englishcounter / totaltokens
+        else:
+            percentmatched = 0
+            percentenglish = 0
+
+        return percentmatched, percentenglish
+
+DECISIONCACHESIZE = 50000
+# The number of token decisions each thread's cache remembers. Correcting
+# sixteen synthetic volumes (1.2M tokens) in one session, the hit rate was
+# 57% with 5,000 entries, 67% with 20,000, 74% with 50,000 and 79% with
+# 200,000, at roughly 700 bytes an entry. 50,000 entries (about 35 MB) was
+# also the fastest of those: past it, the extra hits don't pay for the
+# memory.
+
+class DecisionCache(object):
+    '''A bounded, least-recently-used map from tokens to the outcome of
+    NormalizerSession.decide. Keys are (token, nextword), or (token, None)
+    for tokens whose outcome doesn't depend on the next word.
+
+    Hits and misses are counted per token by correct_span (a token can take
+    two lookups), so we can see whether the cache is paying its way. A
+    maxsize of 0 turns caching off.
+
+    A DecisionCache isn't safe to share between threads; a session gives
+    each thread its own (see NormalizerSession.decision_cache).'''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        outcome = self.table.get(key)
+        if outcome is not None:
+            self.table.move_to_end(key)
+        return outcome
+
+    def put(self, key, outcome):
+        if self.maxsize < 1:
+            return
+        self.table[key] = outcome
+        if len(self.table) > self.maxsize:
+            self.table.popitem(last = False)
+
+    def info(self):
+        return self.hits, self.misses, len(self.table), self.maxsize
+
+    def clear(self):
+        self.table.clear()
+        self.hits = 0
+        self.misses = 0
+
+class NormalizerSession(object):
+    '''Owns a set of rule tables and normalizes volumes with them. The
+    rules are never modified after the session is created; all per-volume
+    state lives in a VolumeState created for each call. So a single session
+    (with a single copy of the rules) can serve many volumes at once, from
+    threads or interleaved calls.
+
+    The one thing a session does accumulate is a DecisionCache of outcomes
+    for tokens it has already seen. Outcomes depend only on the rules, so
+    the cache is shared by every volume the session handles in a thread.
+    Each thread gets a cache of its own, so that the cache needs no lock.
+
+    By default a session uses the rules this module loaded on import. Pass
+    a dictionary of tables shaped like the output of parse_rulesets to use
+    different ones.'''
+
+    def __init__(self, tables = None, cachesize = DECISIONCACHESIZE):
+        if tables is None:
+            tables = {'romannumerals': romannumerals, 'lexicon': lexicon, 'personalnames': personalnames, 'placenames': placenames, 'correctionrules': correctionrules, 'hyphenrules': hyphenrules, 'fuserules': fuserules, 'syncoperules': syncoperules, 'variants': variants}
+
+        self.romannumerals = tables['romannumerals']
+        self.lexicon = tables['lexicon']
+        self.personalnames = tables['personalnames']
+        self.placenames = tables['placenames']
+        self.correctionrules = tables['correctionrules']
+        self.hyphenrules = tables['hyphenrules']
+        self.fuserules = tables['fuserules']
+        self.syncoperules = tables['syncoperules']
+        self.variants = tables['variants']
+
+        self.fusefirsts = set([x[0] for x in self.fuserules])
+        # Words that can begin a fused phrase. If a word isn't one of these,
+        # and it's in the lexicon, what happens to it can't depend on the
+        # word after it.
+
+        self.cachesize = cachesize
+        self.local = threading.local()
+
+    def decision_cache(self):
+        '''This thread's DecisionCache, made the first time it's needed.'''
+
+        cache = getattr(self.local, 'decisions', None)
+        if cache is None:
+            cache = DecisionCache(self.cachesize)
+            self.local.decisions = cache
+        return cache
+
+    def as_stream(self, pagelist, verbose = False, timer = NULLTIMER, headermap = None, footermap = None):
+        '''Converts a list of pages to a list of tokens
+        Linebreaks are represented as separate tokens.
+        In the process we also collect data about each page,
+        including the number of lines, the number of lines with
+        text, the number that begin with a capital letter, the
+        max number of repeats for a single letter (not case-sensitive),
+        and the max number of repeats for an alphabetically-adjacent
+        pair of letters (not case-sensitive).
+
+        Timer, if supplied, is a StageTimer; this switches it to the
+        HeaderFinder and as_stream stages. If you pass a HeaderFinder.HeaderMap,
+        the running headers are recorded in it, with their line numbers, and
+        if you pass a footermap, footers are found and recorded in it.'''
+
+        timer.start('HeaderFinder')
+        headerlist = HeaderFinder.find_headers(pagelist, self.romannumerals, headermap = headermap, footermap = footermap)
+        timer.start('as_stream')
+
+        if len(headerlist) != len(pagelist):
+            print("Headerlist: " + str(len(headerlist)))
+            print("Pagelist: " + str(len(pagelist)))
+            headerlist = [[]] * len(pagelist)
+        # These lengths ought to match up; if they don't, skip the whole header
+        # process while flagging the problem.
+
+        linelist = list()
+        firstpage = True
+        pagedata = list()
+
+        for page in pagelist:
+            if firstpage:
+                firstpage = False
+            else:
+                linelist.append('<pb>')
+
+            lines, structural_features = self.page_features(page)
+            linelist.extend(lines)
+            pagedata.append(structural_features)
+
+        tokens = list()
+        tokenizer = Tokenizer(self.lexicon)
+        tokenizer.add_lines(linelist, tokens)
+        tokenizer.finish()
+
+        percentfound, percentenglish = tokenizer.percentages()
+
+        return tokens, percentfound, percentenglish, pagedata, headerlist
+
+    def iter_stream(self, pages, tokenizer, timer = NULLTIMER, headermap = None, footermap = None):
+        '''Streaming counterpart of as_stream. Pages can be any iterable,
+        and are consumed lazily. For each page this yields the page's tokens
+        (beginning with <pb> for every page after the first), its structural
+        features, and the header tokens found on it. Running headers are
+        identified in a sliding window, so only a handful of pages are held in
+        memory at once.
+
+        Lines are tokenized by tokenizer, a Tokenizer, which also accumulates
+        the pre-correction match statistics; they are complete once the
+        generator is exhausted. Timer, if supplied, is switched to the
+        as_stream stage while we tokenize. Headermap, if supplied, is a
+        HeaderFinder.HeaderMap that records each page's headers, and
+        footermap one that records its footers.'''
+
+        firstpage = True
+
+        for page, headertokens in HeaderFinder.iter_headers(pages, self.romannumerals, headermap = headermap, footermap = footermap):
+            timer.start('as_stream')
+            lines, structural_features = self.page_features(page)
+
+            if firstpage:
+                firstpage = False
+            else:
+                lines.insert(0, '<pb>')
 
+            pagetokens = list()
+            tokenizer.add_lines(lines, pagetokens)
+
+            yield pagetokens, structural_features, headertokens
+
+        tokenizer.finish()
+
+    def page_features(self, page):
+        '''Returns the lines of a page that should be tokenized (xml
+        lines are dropped) and a dictionary of structural features for
+        the page. See as_stream for a description of the features.'''
+
+        lexicon = self.lexicon
+        personalnames = self.personalnames
+
+        lines = list()
         linecounter = 0
         textlinecounter = 0
         capcounter = 0
@@ -222,7 +749,7 @@ def as_stream(pagelist, verbose = False):
                 # with some exceptions, these lines represent xml encoding
                 # in the file that we want to ignore
                 # I'm willing to live with the exceptions.
-            linelist.append(line)
+            lines.append(line)
             linecounter += 1
 
             if len(strippedline) > 0:
@@ -296,354 +823,322 @@ def as_stream(pagelist, verbose = False):
 
         stdev = int(standarddev(lengths) * 100)
         structural_features = {"#lines": linecounter, "#textlines": textlinecounter, "#caplines": capcounter, "#maxinitial": maxinitial, "#maxpair": maxpair, "#commas": commas, "#periods": periods, "#exclamationpoints": exclamationpoints, "#questionmarks": questionmarks, "#quotations": quotations, "#endwpunct": endwpunct, "#endwnumeral": endwnumeral, "#startwrubric": startwrubric, "#startwname": startwname, "#sequentialcaps": sequentialcaps, "#stdev": stdev}
-        pagedata.append(structural_features)
-
-    tokens = list()
-    for line in linelist:
-        if len(line) < 1:
-            continue
-        if line == "\n":
-            tokens.append(line)
-            continue
-        line = line.rstrip()
-        if line == "<pb>":
-            tokens.append(line)
-            tokens.append('\n')
-            continue
-
-        line = line.replace('”', '” ')
-        line = line.replace(':', ': ')
-        line = line.replace(';', '; ')
-        line = re.sub(',\D', commasplit, line)
-        # That replaces all commas with comma + space unless they are followed by a digit.
-        # Thus "300,000" isn't broken up but "my friend,Fred" is
-
-        line = line.replace('—', ' — ')
-        line = line.replace('--', ' -- ')
-        ## Instead of zapping final punctuation, we make sure it's followed by a space.
-
-        line = line.replace('_', ' ')
-        # But we do zap underscores, which are rarely meaningful.
-
-        # ## Quotes require special treatment, because their position relative to
-        # ## the space can be significant.
-
-        # if '"' in line:
-        #     nextindex = line.find('"')
-        #     while nextindex >= 0:
-        #         if nextindex >= (len(line) - 1):
-        #             followedbyspace = True
-        #             nextindex = -1
-        #         elif line[nextindex+1] == " ":
-        #             followedbyspace = True
-        #             nextindex = line.find('"', nextindex+1, len(line))
-        #         else:
-        #             if nextindex > 0 and line[nextindex - 1] == " ":
-        #                 line = line[0:nextindex] + '“ ' + line[nextindex+1:]
-        #                 nextindex = line.find('"', nextindex+2, len(line))
-        #                 ## Okay, this is a teensy bit baroque. I know that correct_stream
-        #                 ## doesn't handle prefixed punctuation very well. So I don't want
-        #                 ## quotes to be prefixed to words. But I want to preserve the fact
-        #                 ## that they were opening quotes. So I use the special open-quote
-        #                 ## character if quote was prefixed to a word, and preceded by
-        #                 ## a space.
-        #             elif nextindex == 0:
-        #                 line = '“' + line[nextindex+1:]
-        #                 nextindex = line.find('"', nextindex+2, len(line))
-        #             else:
-        #                 line = line[0:nextindex] + '" ' + line[nextindex+1:]
-        #                 nextindex = line.find('"', nextindex+2, len(line))
-        #                 ## If not preceded by a space, this is ambiguous, and I leave
-        #                 ## the character ambiguous.
-
-
-        lineparts = line.split()
-        tokens.extend(lineparts)
-        tokens.append('\n')
 
-    counter = 0
-    englishcounter = 0
-    allcounter = 0
+        return lines, structural_features
 
-    tokencount = len(tokens)
-
-    for i in range(0, tokencount):
-        token = tokens[i].lower()
-        if token in lexicon:
-            counter += 1
-            allcounter += 1
-            if lexicon[token] > 0:
-                englishcounter += 1
-        elif token == '\n' or token.startswith('<') or mostly_numeric(token):
-            next
-        elif i < (tokencount-1):
-            token = token.translate(mosteraser)
-            if token in lexicon:
-                counter += 1
-                allcounter += 1
-                if lexicon[token] > 0:
-                    englishcounter += 1
-            else:
-                nexttoken = tokens[i+1].lower()
-                fused = token + nexttoken.translate(mosteraser)
-                if fused in lexicon:
-                    counter += 1
-                    allcounter += 1
-                    if lexicon[fused] > 0:
-                        englishcounter += 1
-                else:
-                    allcounter += 1
+    def is_word(self, astring):
+        lexicon = self.lexicon
+        if astring in lexicon:
+            return True
+        elif astring.lower() in lexicon:
+            return True
+        elif (astring.lower() + "'s") in lexicon:
+            return True
         else:
-            allcounter += 1
-
-    if allcounter > 0:
-        percentfound = counter / allcounter
-        percentenglish = englishcounter / allcounter
-    else:
-        percentfound = 0
-        percentenglish = 0
-
-    return tokens, percentfound, percentenglish, pagedata, headerlist
-
-def strip_punctuation(astring):
-    global punctuple
-    keepclipping = True
-    suffix = ""
-    while keepclipping == True and len(astring) > 1:
-        keepclipping = False
-        if astring.endswith(punctuple):
-            suffix = astring[-1:] + suffix
-            astring = astring[:-1]
-            keepclipping = True
-    keepclipping = True
-    prefix = ""
-    while keepclipping == True and len(astring) > 1:
-        keepclipping = False
-        if astring.startswith(punctuple):
-            prefix = prefix + astring[:1]
-            astring = astring[1:]
-            keepclipping = True
-    return(prefix, astring, suffix)
-
-def normalize_case(astring):
-    if astring.islower():
-        case = 'lower'
-    elif astring.replace("'", "").isupper():
-        case = 'upper'
-    elif astring.istitle():
-        case = 'title'
-    elif astring.replace("'", "").istitle():
-        case = "title"
-    # The replace part is important lest all possessive words get interpreted
-    # as heterogenous-case.
-    else:
-        case = 'heterogenous'
-
-    if case != "heterogenous":
-        normalizedstring = astring.lower()
-    else:
-        normalizedstring = astring
-
-    return normalizedstring, case
-
-def mostly_numeric(astring):
-    counter = 0
-    for c in astring:
-        if c.isdigit():
-            counter += 1
-    if len(astring) < 1:
-        return False
-    elif counter/len(astring) > .35:
-        return True
-    else:
-        return False
-
-def arabic_digits(astring):
-    pricecodes = ["$", "£", "¢"]
-    counter = 0
-    for c in astring:
-        if c.isdigit():
-            counter += 1
-
-    priceflag = False
-    for code in pricecodes:
-        if astring.count(code) > 0:
-            priceflag = True
-    if astring.endswith("s") or astring.endswith("d"):
-        priceflag = True
-
-    if len(astring) < 1 or counter/len(astring) < .4:
-        return "none"
-    elif priceflag == True:
-        return "arabicprice"
-    elif counter < 2:
-        return "arabic1digit"
-    elif counter < 3:
-        return "arabic2digit"
-    elif counter < 4:
-        return "arabic3digit"
-    elif counter < 5:
-        return "arabic4digit"
-    else:
-        return "arabic5+digit"
-
-def is_word(astring):
-    global lexicon
-    if astring in lexicon:
-        return True
-    elif astring.lower() in lexicon:
-        return True
-    elif (astring.lower() + "'s") in lexicon:
-        return True
-    else:
-        return False
-
-def all_nonalphanumeric(astring):
-    nonalphanum = True
-    for character in astring:
-        if character.isalpha() or character.isdigit():
-            nonalphanum = False
-    return nonalphanum
-
-def logandreset(astring, caseflag, possessive, prefix, suffix):
-    ''' We normalize case at moments in the checking process, and
-    also remove trailing apostrophe-s and punctuation. This routine ensures that
-    both aspects of the token are restored to their original condition.
-    Note that it does so only after logging the word, which means that
-    possessive inflections are not registered in our wordcount.
-    That's my only gesture toward lemmatization.'''
-
-    global pagedict, lexicon, syncoperules, variants, foundcounter, englishcounter, personalnames, placenames
-
-    # In this version of logandreset, tokens that belong to certain special classes are represented
-    # with class names to make classification easier. These names include romannumeral, arabic1digit,
-    # arabic2digit, arabic3digit, arabic4digit, arabic5+digit (which will have been changed before
-    # this function is invoked). But we also log certain titlecased words as "personalname" or
-    # "propernoun", and that change gets made in this function.
-
-    if astring in syncoperules:
-        astring = syncoperules[astring]
-    if astring in variants:
-        astring = variants[astring]
-
-    inDict = False
-
-    if astring in lexicon:
-        foundcounter += 1
-        inDict = True
-        if lexicon[astring] == 1:
-            englishcounter += 1
-    elif astring in specialfeatures:
-        foundcounter += 1
-
-    logstring = astring.lower()
-    if (caseflag == "upper" or caseflag == "title") and astring in personalnames:
-        logstring = "personalname"
-        if astring not in lexicon:
-            # count personal names as things found but not english.
-            # do this only id not in lexicon to avoid doublecounting with
-            # with if statement above
-            foundcounter += 1
-    elif (caseflag == "upper" or caseflag == "title") and astring in placenames:
-        logstring = "placename"
-        if astring not in lexicon:
-            # count personal names as things found but not english.
-            # do this only id not in lexicon to avoid doublecounting with
-            # with if statement above
-            foundcounter += 1
-    elif caseflag == "title" and len(astring) > 4 and astring not in lexicon:
-        logstring = "propernoun"
-        # This is a long titlecased word not present
-        # in our lexicon. Probably a proper noun.
-
-    if logstring in pagedict:
-        pagedict[logstring] += 1
-    else:
-        pagedict[logstring] = 1
-
-    if caseflag == "lower":
-        astring = astring.lower()
-    elif caseflag == "upper":
-        astring = astring.upper()
-        increment_dict("#allcapswords", pagedict)
-        # This is a special feature that counts the number of words
-        # on each page in ALLCAPS. It has a # in front to distinguish
-        # it from features that represent actual token counts. You
-        # would not include features with a # when counting the total
-        # number of words on a page.
-    elif caseflag == "title":
-        astring = astring.title()
-    else:
-        astring = astring.lower()
-
-    if possessive:
-        astring = astring + "'s"
-
-    if len(suffix) > 0:
-        astring = astring + suffix
-    if len(prefix) > 0:
-        astring = prefix + astring
+            return False
+
+    def logandreset(self, state, astring, caseflag, possessive, prefix, suffix):
+        ''' We normalize case at moments in the checking process, and
+        also remove trailing apostrophe-s and punctuation. This routine ensures that
+        both aspects of the token are restored to their original condition.
+        Note that it does so only after logging the word, which means that
+        possessive inflections are not registered in our wordcount.
+        That's my only gesture toward lemmatization.'''
+
+        astring, entry = self.resolve_log(astring, caseflag, possessive, prefix, suffix)
+        logstring, found, english, allcaps = entry
+
+        state.foundcounter += found
+        state.englishcounter += english
+        pagedict = state.pagedict
+        if logstring in pagedict:
+            pagedict[logstring] += 1
+        else:
+            pagedict[logstring] = 1
+        if allcaps:
+            increment_dict("#allcapswords", pagedict)
+        state.longs.add(logstring)
+
+        return astring
+
+    def resolve_log(self, astring, caseflag, possessive, prefix, suffix):
+        '''Works out what logandreset would do, without doing it. Returns
+        the restored token, plus an entry (logstring, found, english, allcaps)
+        describing what to log: the feature to count in the page dictionary,
+        what to add to the matched and English counters, and whether to count
+        the word as #allcapswords.'''
+
+        lexicon = self.lexicon
+        syncoperules = self.syncoperules
+        variants = self.variants
+        personalnames = self.personalnames
+        placenames = self.placenames
+
+        # In this version of logandreset, tokens that belong to certain special classes are represented
+        # with class names to make classification easier. These names include romannumeral, arabic1digit,
+        # arabic2digit, arabic3digit, arabic4digit, arabic5+digit (which will have been changed before
+        # this function is invoked). But we also log certain titlecased words as "personalname" or
+        # "propernoun", and that change gets made in this function.
+
+        if astring in syncoperules:
+            astring = syncoperules[astring]
+        if astring in variants:
+            astring = variants[astring]
+
+        inDict = False
+        found = 0
+        english = 0
+        allcaps = False
+
+        if astring in lexicon:
+            found += 1
+            inDict = True
+            if lexicon[astring] == 1:
+                english += 1
+        elif astring in specialfeatures:
+            found += 1
+
+        logstring = astring.lower()
+        if (caseflag == "upper" or caseflag == "title") and astring in personalnames:
+            logstring = "personalname"
+            if astring not in lexicon:
+                # count personal names as things found but not english.
+                # do this only id not in lexicon to avoid doublecounting with
+                # with if statement above
+                found += 1
+        elif (caseflag == "upper" or caseflag == "title") and astring in placenames:
+            logstring = "placename"
+            if astring not in lexicon:
+                # count personal names as things found but not english.
+                # do this only id not in lexicon to avoid doublecounting with
+                # with if statement above
+                found += 1
+        elif caseflag == "title" and len(astring) > 4 and astring not in lexicon:
+            logstring = "propernoun"
+            # This is a long titlecased word not present
+            # in our lexicon. Probably a proper noun.
+
+        if caseflag == "lower":
+            astring = astring.lower()
+        elif caseflag == "upper":
+            astring = astring.upper()
+            allcaps = True
+            # This is a special feature that counts the number of words
+            # on each page in ALLCAPS. It has a # in front to distinguish
+            # it from features that represent actual token counts. You
+            # would not include features with a # when counting the total
+            # number of words on a page.
+        elif caseflag == "title":
+            astring = astring.title()
+        else:
+            astring = astring.lower()
+
+        if possessive:
+            astring = astring + "'s"
+
+        if len(suffix) > 0:
+            astring = astring + suffix
+        if len(prefix) > 0:
+            astring = prefix + astring
+
+        return astring, (logstring, found, english, allcaps)
+
+    def correct_stream(self, tokens, verbose = False):
+        state = self.correct_volume(tokens, verbose)
+        percentmatched, percentenglish = state.match_rates()
+        return state.corrected, state.pages, percentmatched, percentenglish
+
+        # The method returns a vector of all tokens, including xml tags and linebreaks,
+        # plus a list of page dictionaries, plus a count of words that matched, and the
+        # number of those words that were english.
+
+    def correct_volume(self, tokens, verbose = False, longs = None):
+        '''Does the work of correct_stream, but returns the VolumeState
+        itself, so that callers can get at the raw counts, and at the long-s
+        evidence in state.longs. Pass a LongSCounter as longs to choose the
+        words it counts.'''
+
+        state = VolumeState(longs)
+        self.correct_span(state, tokens, 0, len(tokens))
+        self.finish_volume(state, verbose)
+
+        return state
+
+    def correct_headers(self, headerlist):
+        '''Normalizes the header tokens for every page of a volume at once,
+        returning one page dictionary per header. Running headers repeat
+        every page or two, so each distinct header is only corrected once.
+        Pages with the same header share the same dictionary; don't modify
+        them.'''
+
+        memo = dict()
+        return [self.correct_header(x, memo) for x in headerlist]
+
+    def correct_header(self, headertokens, memo = None):
+        '''Returns the page dictionary correct_stream would produce for a
+        single header (the first page, if the header somehow contains a
+        <pb>). Memo, if supplied, is a dictionary that remembers headers
+        already corrected.'''
+
+        if len(headertokens) < 1:
+            return dict()
+            # Most pages have no header at all.
+
+        if memo is not None:
+            key = tuple(headertokens)
+            if key in memo:
+                return memo[key]
+
+        state = VolumeState()
+        self.correct_span(state, headertokens, 0, len(headertokens))
+        state.pages.append(state.pagedict)
+        headerdict = state.pages[0]
+
+        if memo is not None:
+            memo[key] = headerdict
+
+        return headerdict
+
+    def finish_volume(self, state, verbose = False):
+        state.pages.append(state.pagedict)
+        # Because the last page also needs to be appended.
+
+        if verbose:
+            print('There were', state.wordsfused, 'fused words.')
+            hits, misses, size, maxsize = self.decision_cache().info()
+            print('Decision cache:', hits, 'hits,', misses, 'misses,', size, 'of', maxsize, 'entries.')
+
+    def correct_span(self, state, tokens, start, stop):
+        '''Corrects tokens[start:stop], adding the results to state. This is
+        the body of correct_stream, separated out so that a volume can also be
+        fed through in pieces. Lookahead reaches up to three tokens past the
+        current one, so unless stop is the end of the volume, tokens needs to
+        extend at least three tokens past stop.'''
+
+        decide = self.decide
+        decisions = self.decision_cache()
+
+        corrected = state.corrected
+        pages = state.pages
+        streamlen = len(tokens)
+        skipflag = state.skipflag
+        longs = state.longs
+        longswords = longs.words
+
+        for i in range(start, stop):
+
+            thisword = tokens[i]
+            if len(thisword) < 1:
+                continue
 
-    return astring
+            if thisword == "<pb>":
+                pages.append(state.pagedict)
+                state.pagedict = dict()
+                # log the old page dictionary and start a new one
+                corrected.append(thisword)
+                state.paratext +=1
+                longs.end_page()
+                longswords = longs.words
+                # which is emptied if the counter makes up its mind early
+                continue
 
+            if (thisword.startswith('<') and thisword.endswith('>')) or thisword == '\n':
+                corrected.append(thisword)
+                state.paratext += 1
+                continue
 
-def correct_stream(tokens, verbose = False):
-    global lexicon, hyphenrules, fuserules, syncoperules, variants, correctionrules, romannumerals, pagedict, foundcounter, englishcounter, personalnames, placenames
+            ## Notice the sequence here. We don't reset skipflag if we're just skipping newlines or
+            ## xml markup.
 
-    corrected = list()
-    streamlen = len(tokens)
-    skipflag = False
-    wordsfused = 0
-    pagecounter = 0
-    pagedict = dict()
-    pages = list()
-    foundcounter = 0
-    englishcounter = 0
-    paratext = 0
+            if skipflag:
+                skipflag = False
+                continue
 
-    for i in range(0, streamlen):
+            if all_nonalphanumeric(thisword):
+                corrected.append(thisword)
+                continue
 
-        thisword = tokens[i]
-        if len(thisword) < 1:
-            continue
+            outcome = decisions.get((thisword, None))
+            if outcome is None:
+                # get the next word, ignoring newlines and xml markup
+                for j in range(1, 4):
+                    if i < (streamlen-j):
+                        nextword = tokens[i+j]
+                        if nextword.startswith('<') or nextword=='\n':
+                            continue
+                        else:
+                            break
+                    else:
+                        nextword = "#EOFile"
+                        break
+
+                outcome = decisions.get((thisword, nextword))
+                if outcome is None:
+                    decisions.misses += 1
+                    outcome, usesnext = decide(thisword, nextword)
+                    if usesnext:
+                        decisions.put((thisword, nextword), outcome)
+                    else:
+                        decisions.put((thisword, None), outcome)
+                else:
+                    decisions.hits += 1
+            else:
+                decisions.hits += 1
+
+            newtokens, logs, fused, skip = outcome
+            pagedict = state.pagedict
+            for logstring, found, english, allcaps in logs:
+                state.foundcounter += found
+                state.englishcounter += english
+                if logstring in pagedict:
+                    pagedict[logstring] += 1
+                else:
+                    pagedict[logstring] = 1
+                if allcaps:
+                    increment_dict("#allcapswords", pagedict)
+                if logstring in longswords:
+                    longs.add(logstring)
+
+            corrected.extend(newtokens)
+            state.wordsfused += fused
+            if skip:
+                skipflag = True
 
+        state.skipflag = skipflag
+
+    def decide(self, thisword, nextword):
+        '''Runs the decision cascade for one token, given the next word
+        (already found by lookahead, or "#EOFile"). Nothing is logged here;
+        instead this returns an outcome that correct_span can replay: the
+        tokens to add to the corrected stream, the entries to log in the page
+        dictionary, the number of words fused, and whether the next token is
+        consumed. It also returns a flag that's False when the outcome could
+        not have been affected by nextword, so the cache can share it.'''
+
+        lexicon = self.lexicon
+        hyphenrules = self.hyphenrules
+        fuserules = self.fuserules
+        fusefirsts = self.fusefirsts
+        syncoperules = self.syncoperules
+        variants = self.variants
+        correctionrules = self.correctionrules
+        romannumerals = self.romannumerals
+        personalnames = self.personalnames
+        placenames = self.placenames
+        is_word = self.is_word
+        resolve_log = self.resolve_log
+
+        newtokens = list()
+        logs = list()
+        fused = 0
+        skip = False
+        usesnext = True
         originalword = thisword
 
-        if thisword == "<pb>":
-            pages.append(pagedict)
-            pagedict = dict()
-            # log the old page dictionary and start a new one
-            corrected.append(thisword)
-            paratext +=1
-            continue
-
-        if (thisword.startswith('<') and thisword.endswith('>')) or thisword == '\n':
-            corrected.append(thisword)
-            paratext += 1
-            continue
-
-        ## Notice the sequence here. We don't reset skipflag if we're just skipping newlines or
-        ## xml markup.
-
-        if skipflag:
-            skipflag = False
-            continue
-
-        if all_nonalphanumeric(thisword):
-            corrected.append(thisword)
-            continue
-
-        # get the next word, ignoring newlines and xml markup
-        for j in range(1, 4):
-            if i < (streamlen-j):
-                nextword = tokens[i+j]
-                if nextword.startswith('<') or nextword=='\n':
-                    continue
-                else:
-                    break
-            else:
-                nextword = "#EOFile"
-                break
+        def log(astring, caseflag, possessive, prefix, suffix):
+            astring, entry = resolve_log(astring, caseflag, possessive, prefix, suffix)
+            logs.append(entry)
+            return astring
 
         thisword, thiscase = normalize_case(thisword)
         nextword, nextcase = normalize_case(nextword)
@@ -672,20 +1167,20 @@ def correct_stream(tokens, verbose = False):
         # Is this a number?
 
         if thislower in romannumerals:
-            numeral = logandreset("romannumeral", thiscase, False, thisprefix, thissuffix)
-            corrected.append(originalword)
-            continue
+            numeral = log("romannumeral", thiscase, False, thisprefix, thissuffix)
+            newtokens.append(originalword)
+            return (newtokens, logs, fused, skip), False
 
         arabic = arabic_digits(thisword)
         if arabic != "none":
-            numeral = logandreset(arabic, thiscase, False, thisprefix, thissuffix)
-            corrected.append(originalword)
-            continue
+            numeral = log(arabic, thiscase, False, thisprefix, thissuffix)
+            newtokens.append(originalword)
+            return (newtokens, logs, fused, skip), False
 
         if (thiscase=="title" or thiscase=="upper") and (thisword in personalnames or thisword in placenames):
-            newtoken = logandreset(thisword, thiscase, thispossessive, thisprefix, thissuffix)
-            corrected.append(newtoken)
-            continue
+            newtoken = log(thisword, thiscase, thispossessive, thisprefix, thissuffix)
+            newtokens.append(newtoken)
+            return (newtokens, logs, fused, skip), False
 
         # Is this part of a phrase that needs fusing?
 
@@ -693,21 +1188,21 @@ def correct_stream(tokens, verbose = False):
             fusetuple = (thislower, nextlower)
             if fusetuple in fuserules:
                 newtoken = fuserules[fusetuple]
-                newtoken = logandreset(newtoken, thiscase, nextpossessive, thisprefix, nextsuffix)
-                corrected.append(newtoken)
-                wordsfused += 1
-                skipflag = True
-                continue
+                newtoken = log(newtoken, thiscase, nextpossessive, thisprefix, nextsuffix)
+                newtokens.append(newtoken)
+                fused += 1
+                skip = True
+                return (newtokens, logs, fused, skip), usesnext
 
             else:
-                thisword = logandreset(thisword, thiscase, thispossessive, thisprefix, thissuffix)
-                corrected.append(thisword)
-                continue
+                thisword = log(thisword, thiscase, thispossessive, thisprefix, thissuffix)
+                newtokens.append(thisword)
+                return (newtokens, logs, fused, skip), thislower in fusefirsts
 
         if is_word(thisword):
-            thisword = logandreset(thisword, thiscase, thispossessive, thisprefix, thissuffix)
-            corrected.append(thisword)
-            continue
+            thisword = log(thisword, thiscase, thispossessive, thisprefix, thissuffix)
+            newtokens.append(thisword)
+            return (newtokens, logs, fused, skip), thislower in fusefirsts
 
         ## At this point we know that thisword doesn't match lexicon.
         ## Maybe it's a word fragment
@@ -722,20 +1217,20 @@ def correct_stream(tokens, verbose = False):
             bothpartsexist = True
 
         if is_word(possiblefusion) and bothpartsexist:
-            newtoken = logandreset(possiblefusion, thiscase, nextpossessive, thisprefix, nextsuffix)
-            corrected.append(newtoken)
-            wordsfused += 1
-            skipflag = True
-            continue
+            newtoken = log(possiblefusion, thiscase, nextpossessive, thisprefix, nextsuffix)
+            newtokens.append(newtoken)
+            fused += 1
+            skip = True
+            return (newtokens, logs, fused, skip), usesnext
 
         #maybe both parts need to be corrected
         if possiblefusion.lower() in correctionrules and bothpartsexist:
             thiscorr = correctionrules[possiblefusion.lower()]
-            newtoken = logandreset(thiscorr, thiscase, nextpossessive, thisprefix, nextsuffix)
-            corrected.append(newtoken)
-            wordsfused += 1
-            skipflag = True
-            continue
+            newtoken = log(thiscorr, thiscase, nextpossessive, thisprefix, nextsuffix)
+            newtokens.append(newtoken)
+            fused += 1
+            skip = True
+            return (newtokens, logs, fused, skip), usesnext
 
         if thisword in correctionrules:
             thiscorr = correctionrules[thisword]
@@ -759,18 +1254,18 @@ def correct_stream(tokens, verbose = False):
         fusetuple = (thiscorr, nextcorr)
         if fusetuple in fuserules:
             newtoken = fuserules[fusetuple]
-            newtoken = logandreset(newtoken, thiscase, nextpossessive, thisprefix, nextsuffix)
-            corrected.append(newtoken)
-            wordsfused += 1
-            skipflag = True
-            continue
+            newtoken = log(newtoken, thiscase, nextpossessive, thisprefix, nextsuffix)
+            newtokens.append(newtoken)
+            fused += 1
+            skip = True
+            return (newtokens, logs, fused, skip), usesnext
 
         ## But otherwise, if the correction worked, move on.
 
         if is_word(thiscorr):
-            thiscorr = logandreset(thiscorr, thiscase, thispossessive, thisprefix, thissuffix)
-            corrected.append(thiscorr)
-            continue
+            thiscorr = log(thiscorr, thiscase, thispossessive, thisprefix, thissuffix)
+            newtokens.append(thiscorr)
+            return (newtokens, logs, fused, skip), usesnext
 
         if thiscorr in hyphenrules:
             thiscorr = hyphenrules[thiscorr]
@@ -787,13 +1282,13 @@ def correct_stream(tokens, verbose = False):
                 else:
                     partcase = "lower"
 
-                newtoken = logandreset(part, partcase, False, "", "")
+                newtoken = log(part, partcase, False, "", "")
                 if j == (len(theseparts) - 1):
                     newtoken = newtoken + thissuffix
                 if j == 0:
                     newtoken = thisprefix + newtoken
-                corrected.append(newtoken)
-            continue
+                newtokens.append(newtoken)
+            return (newtokens, logs, fused, skip), usesnext
 
         ## Ordinary correction rules didn't work. Now we try syncope.
 
@@ -801,9 +1296,9 @@ def correct_stream(tokens, verbose = False):
             thiscorr = syncoperules[thiscorr]
 
         if is_word(thiscorr):
-            thiscorr = logandreset(thiscorr, thiscase, thispossessive, thisprefix, thissuffix)
-            corrected.append(thiscorr)
-            continue
+            thiscorr = log(thiscorr, thiscase, thispossessive, thisprefix, thissuffix)
+            newtokens.append(thiscorr)
+            return (newtokens, logs, fused, skip), usesnext
 
         ## If we still have a hyphen, try splitting there.
 
@@ -818,64 +1313,51 @@ def correct_stream(tokens, verbose = False):
                 else:
                     partcase = "lower"
 
-                newtoken = logandreset(part, partcase, False, "", "")
+                newtoken = log(part, partcase, False, "", "")
 
                 if j == (len(theseparts) - 1):
                     newtoken = newtoken + thissuffix
                 if j == 0:
                     newtoken = thisprefix + newtoken
-                corrected.append(newtoken)
-            continue
+                newtokens.append(newtoken)
+            return (newtokens, logs, fused, skip), usesnext
 
         #last-ditch move. zap all nonalphabetic characters
 
         thispurged = thiscorr.translate(alleraser)
 
         if is_word(thispurged):
-            thiscorr = logandreset(thispurged, thiscase, thispossessive, thisprefix, thissuffix)
-            corrected.append(thiscorr)
-            continue
+            thiscorr = log(thispurged, thiscase, thispossessive, thisprefix, thissuffix)
+            newtokens.append(thiscorr)
+            return (newtokens, logs, fused, skip), usesnext
         else:
             if thiscorr in syncoperules:
                 thiscorr = syncoperules[thiscorr]
-                thiscorr = logandreset(thiscorr, thiscase, thispossessive, thisprefix, thissuffix)
-                corrected.append(thiscorr)
+                thiscorr = log(thiscorr, thiscase, thispossessive, thisprefix, thissuffix)
+                newtokens.append(thiscorr)
             elif thiscorr in variants:
                 thiscorr = variants[thiscorr]
-                thiscorr = logandreset(thiscorr, thiscase, thispossessive, thisprefix, thissuffix)
-                corrected.append(thiscorr)
+                thiscorr = log(thiscorr, thiscase, thispossessive, thisprefix, thissuffix)
+                newtokens.append(thiscorr)
             else:
-                dummy = logandreset(thiscorr, thiscase, thispossessive, thisprefix, thissuffix)
-                corrected.append(originalword)
+                dummy = log(thiscorr, thiscase, thispossessive, thisprefix, thissuffix)
+                newtokens.append(originalword)
             ## The word will in fact only be logged in the page dictionary if it
             ## matches the dictionary. Variant spellings will be normalized in the
             ## logandreset function.
-            continue
-
-    pages.append(pagedict)
-    # Because the last page also needs to be appended.
-
-    if verbose:
-        print('There were', wordsfused, 'fused words.')
-
-    totaltokens = len(corrected) - paratext
-    if totaltokens > 0:
-        percentmatched = foundcounter / totaltokens
-        percentenglish = englishcounter / totaltokens
-    else:
-        percentmatched = 0
-        percentenglish = 0
-    return corrected, pages, percentmatched, percentenglish
-
-    # The method returns a vector of all tokens, including xml tags and linebreaks,
-    # plus a list of page dictionaries, plus a count of words that matched, and the
-    # number of those words that were english.
-
-
-
-
+            return (newtokens, logs, fused, skip), usesnext
 
+## The module-level functions below are thin wrappers around a default
+## session, so that existing scripts can keep calling
+## NormalizeVolume.as_stream and NormalizeVolume.correct_stream.
 
+default_session = NormalizerSession()
 
+def as_stream(pagelist, verbose = False, timer = NULLTIMER, headermap = None, footermap = None):
+    return default_session.as_stream(pagelist, verbose, timer, headermap, footermap)
 
+def correct_stream(tokens, verbose = False):
+    return default_session.correct_stream(tokens, verbose)
 
+def is_word(astring):
+    return default_session.is_word(astring)
@@ -0,0 +1,364 @@
+# PairtreeManifest.py
+#
+# A list of every volume in a pairtree, so that drivers can find a volume's
+# zipfile, and learn whether it exists and how big it is, without asking the
+# shared filesystem. FileCabinet.pairtreepath builds a path from an HTID by
+# string manipulation, but whether anything is there only comes out when we
+# try to read it, and the scheduler has to stat every zipfile for its size.
+#
+# The manifest is a text file, manifest.tsv at the root of the pairtree, with
+# one line per volume:
+#
+# htid <tab> path of the zipfile, relative to the root <tab> size <tab> mtime
+#
+# sorted by HTID (as UTF-8 bytes). Since it's sorted, a Manifest can look an
+# HTID up by binary search in the file mapped into memory, without reading
+# the whole thing into a dictionary; all the workers on a node share one copy
+# in the page cache.
+#
+# It's built by scanning the pairtree with os.scandir. Each namespace's
+# pairtree_root is split at its first level of directories, and those
+# subtrees are walked by a pool of threads, since the time goes into waiting
+# for the filesystem. Later scans can be limited to some namespaces, and then
+# merge with the existing manifest, replacing only the entries for those
+# namespaces.
+#
+# A scan also records the modification time of every directory it walks, in
+# manifestdirs.tsv beside the manifest:
+#
+# path of the directory, relative to the root <tab> mtime in nanoseconds
+#
+# A directory's mtime only changes when entries are added to it, removed or
+# renamed, not when something changes further down. So an update still
+# descends into every directory, but for one whose mtime is what we recorded
+# it stats the directory instead of listing it, takes its subdirectories from
+# the record, and keeps its volume's manifest entry without statting the
+# zipfile. Only directories where something arrived or left are listed. (A
+# zipfile rewritten in place, without a rename, isn't noticed; build again to
+# be sure of everything.) A directory modified in the last few seconds before
+# the scan is recorded with an mtime of 0, so that the next update lists it
+# again even if it changes again within the same tick of the clock.
+#
+# USAGE:
+# python3 PairtreeManifest.py build /projects/ichass/usesofscale/nonserials/ [threads]
+# python3 PairtreeManifest.py update /projects/ichass/usesofscale/nonserials/ [mdp uc1 ...]
+#
+# manifest = open_manifest(datapath)
+# path = manifest.path('mdp.39015000000006')
+
+import mmap
+import os
+import sys
+from multiprocessing.pool import ThreadPool
+
+MANIFESTNAME = 'manifest.tsv'
+DIRSNAME = 'manifestdirs.tsv'
+SCANTHREADS = 16
+SETTLETIME = 5
+# Seconds. A directory modified this recently when the scan starts may still
+# be changing, so we don't trust its mtime next time.
+
+def htid_for(prefix, postfix):
+    '''The HTID for a pairtree object directory, reversing the substitutions
+    in FileCabinet.pairtreepath.'''
+
+    if '+' in postfix or '=' in postfix:
+        postfix = postfix.replace('+', ':')
+        postfix = postfix.replace('=', '/')
+    postfix = postfix.replace(',', '.')
+    return prefix + '.' + postfix
+
+def walk_subtree(task):
+    '''Finds every postfix/postfix.zip below directory, and returns a list of
+    (htid, relative path, size, mtime) and a list of (relative path of a
+    directory, its mtime). known is a Known from an earlier scan, or None
+    to list every directory.'''
+
+    root, prefix, directory, known, settled = task
+    entries = list()
+    dirs = list()
+    stack = [directory]
+    while len(stack) > 0:
+        current = stack.pop()
+        reldir = os.path.relpath(current, root)
+        try:
+            mtime = os.stat(current).st_mtime_ns
+        except (IOError, OSError):
+            continue
+
+        if mtime >= settled:
+            dirs.append((reldir, 0))
+        else:
+            dirs.append((reldir, mtime))
+
+        if known is not None and known.unchanged(reldir, mtime):
+            for child in known.children.get(reldir, []):
+                stack.append(os.path.join(root, child))
+            if reldir in known.entries:
+                entries.append(known.entries[reldir])
+            continue
+
+        try:
+            iterator = os.scandir(current)
+        except (IOError, OSError):
+            continue
+        with iterator:
+            for entry in iterator:
+                if entry.is_dir(follow_symlinks = False):
+                    stack.append(entry.path)
+                elif entry.name.endswith('.zip') and entry.name[0:-4] == os.path.basename(current):
+                    try:
+                        stats = entry.stat()
+                    except (IOError, OSError):
+                        continue
+                    relpath = os.path.relpath(entry.path, root)
+                    entries.append((htid_for(prefix, entry.name[0:-4]), relpath, stats.st_size, int(stats.st_mtime)))
+
+    return entries, dirs
+
+class Known(object):
+    '''What an earlier scan found: each directory's mtime and
+    subdirectories, and the manifest entry for the volume in each object
+    directory.'''
+
+    def __init__(self, dirs, entries):
+        self.mtimes = dict()
+        self.children = dict()
+        for reldir, mtime in dirs:
+            self.mtimes[reldir] = mtime
+            parent = os.path.dirname(reldir)
+            if parent not in self.children:
+                self.children[parent] = list()
+            self.children[parent].append(reldir)
+
+        self.entries = dict()
+        for entry in entries:
+            self.entries[os.path.dirname(entry[1])] = entry
+
+    def unchanged(self, reldir, mtime):
+        recorded = self.mtimes.get(reldir, 0)
+        return recorded > 0 and recorded == mtime
+
+def scan_tasks(root, prefixes, known, settled):
+    '''The first-level directories under each namespace's pairtree_root,
+    which are the units of work for the scanning threads.'''
+
+    tasks = list()
+    for prefix in prefixes:
+        pairtreeroot = os.path.join(root, prefix, 'pairtree_root')
+        try:
+            with os.scandir(pairtreeroot) as iterator:
+                for entry in iterator:
+                    if entry.is_dir(follow_symlinks = False):
+                        tasks.append((root, prefix, entry.path, known, settled))
+        except (IOError, OSError):
+            print("No pairtree_root for " + prefix + " in " + root)
+
+    return tasks
+
+def namespaces(root):
+    names = list()
+    with os.scandir(root) as iterator:
+        for entry in iterator:
+            if entry.is_dir() and os.path.isdir(os.path.join(entry.path, 'pairtree_root')):
+                names.append(entry.name)
+    return sorted(names)
+
+def fs_now_ns(root):
+    '''The current time by the filesystem's clock, in nanoseconds, since
+    that's the clock directory mtimes come from.'''
+
+    clockpath = os.path.join(root, '.clock.' + str(os.getpid()))
+    with open(clockpath, mode = 'w') as f:
+        pass
+    now = os.stat(clockpath).st_mtime_ns
+    os.remove(clockpath)
+    return now
+
+def scan(root, prefixes = None, threads = SCANTHREADS, known = None):
+    '''Scans the pairtree at root (or just the given namespaces) and returns
+    a list of entries and a list of directory mtimes. With known (a Known),
+    directories that haven't changed since the earlier scan aren't listed.'''
+
+    if prefixes is None:
+        prefixes = namespaces(root)
+
+    settled = fs_now_ns(root) - SETTLETIME * 1000000000
+    tasks = scan_tasks(root, prefixes, known, settled)
+    pool = ThreadPool(max(1, threads))
+    try:
+        results = pool.map(walk_subtree, tasks, chunksize = 1)
+    finally:
+        pool.close()
+        pool.join()
+
+    entries = list()
+    dirs = list()
+    for result in results:
+        entries.extend(result[0])
+        dirs.extend(result[1])
+    return entries, dirs
+
+def write_manifest(path, entries):
+    '''Writes entries sorted by HTID. If an HTID turns up twice, the last
+    one wins. Writes to a temporary file and renames it into place, so
+    readers never see half a manifest.'''
+
+    byhtid = dict()
+    for entry in entries:
+        byhtid[entry[0]] = entry
+
+    lines = list()
+    for htid, relpath, size, mtime in byhtid.values():
+        lines.append((htid + '\t' + relpath + '\t' + str(size) + '\t' + str(mtime) + '\n').encode('utf-8'))
+    lines.sort()
+    # A line's HTID is followed by a tab, which sorts before every character
+    # an HTID can contain, so sorting lines sorts HTIDs.
+
+    temppath = path + '.' + str(os.getpid()) + '.tmp'
+    with open(temppath, mode = 'wb') as f:
+        f.write(b''.join(lines))
+    os.replace(temppath, path)
+
+    return len(lines)
+
+def read_entries(path):
+    entries = list()
+    with open(path, encoding = 'utf-8') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 4:
+                entries.append((fields[0], fields[1], int(fields[2]), int(fields[3])))
+    return entries
+
+def write_dirs(path, dirs):
+    '''Writes directory mtimes, the same way as write_manifest.'''
+
+    temppath = path + '.' + str(os.getpid()) + '.tmp'
+    with open(temppath, mode = 'w', encoding = 'utf-8') as f:
+        for reldir, mtime in sorted(dirs):
+            f.write(reldir + '\t' + str(mtime) + '\n')
+    os.replace(temppath, path)
+
+def read_dirs(path):
+    dirs = list()
+    try:
+        with open(path, encoding = 'utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == 2:
+                    dirs.append((fields[0], int(fields[1])))
+    except IOError:
+        pass
+    return dirs
+
+def namespace_of(relpath):
+    return relpath.split(os.sep, 1)[0]
+
+def build_manifest(root, threads = SCANTHREADS):
+    entries, dirs = scan(root, None, threads)
+    count = write_manifest(os.path.join(root, MANIFESTNAME), entries)
+    write_dirs(os.path.join(root, DIRSNAME), dirs)
+    return count
+
+def update_manifest(root, prefixes = None, threads = SCANTHREADS):
+    '''Rescans the given namespaces (or all of them), listing only the
+    directories that have changed since the last scan, and replaces their
+    entries in the manifest, keeping the rest.'''
+
+    if prefixes is None or len(prefixes) < 1:
+        prefixes = namespaces(root)
+
+    path = os.path.join(root, MANIFESTNAME)
+    dirspath = os.path.join(root, DIRSNAME)
+    oldentries = list()
+    if os.path.exists(path):
+        oldentries = read_entries(path)
+    olddirs = read_dirs(dirspath)
+
+    known = Known([x for x in olddirs if namespace_of(x[0]) in prefixes], [x for x in oldentries if namespace_of(x[1]) in prefixes])
+    entries, dirs = scan(root, prefixes, threads, known)
+
+    keptdirs = [x for x in olddirs if namespace_of(x[0]) not in prefixes]
+    kept = [x for x in oldentries if namespace_of(x[1]) not in prefixes]
+    count = write_manifest(path, kept + entries)
+    write_dirs(dirspath, keptdirs + dirs)
+    # The manifest goes first. If we die in between, the old mtimes just
+    # make the next update list the changed directories again.
+    return count
+
+class Manifest(object):
+    '''Lookups in a manifest file, by binary search.'''
+
+    def __init__(self, root, data):
+        self.root = root
+        self.data = data
+
+    def find(self, htid):
+        '''Returns the fields of the line for htid, or None.'''
+
+        data = self.data
+        key = htid.encode('utf-8')
+        lo = 0
+        hi = len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind(b'\n', 0, mid) + 1
+            end = data.find(b'\n', start)
+            if end < 0:
+                end = len(data)
+            tab = data.find(b'\t', start, end)
+            linekey = data[start: tab]
+            if linekey < key:
+                lo = end + 1
+            elif linekey > key:
+                hi = start
+            else:
+                return data[start: end].decode('utf-8').split('\t')
+
+        return None
+
+    def __contains__(self, htid):
+        return self.find(htid) is not None
+
+    def path(self, htid):
+        '''The full path of htid's zipfile, or None if it's not in the
+        manifest.'''
+
+        fields = self.find(htid)
+        if fields is None:
+            return None
+        return os.path.join(self.root, fields[1])
+
+    def size(self, htid, default = None):
+        fields = self.find(htid)
+        if fields is None:
+            return default
+        return int(fields[2])
+
+def open_manifest(root):
+    '''Returns a Manifest for the pairtree at root, or None if it doesn't
+    have one.'''
+
+    try:
+        with open(os.path.join(root, MANIFESTNAME), mode = 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+        # ValueError is what mmap raises for an empty file.
+
+    return Manifest(root, data)
+
+if __name__ == "__main__":
+    command = sys.argv[1]
+    root = sys.argv[2]
+
+    if command == "build":
+        threads = SCANTHREADS
+        if len(sys.argv) > 3:
+            threads = int(sys.argv[3])
+        print("Found", build_manifest(root, threads), "volumes.")
+
+    elif command == "update":
+        print("The manifest now lists", update_manifest(root, sys.argv[3:]), "volumes.")
+        # With no namespaces named, all of them are updated.
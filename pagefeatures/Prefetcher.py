@@ -0,0 +1,222 @@
+# Prefetcher.py
+#
+# Reads volumes into memory before a worker needs them. On the cluster every
+# volume lives in a pairtree on a shared filesystem, and finding and reading
+# a zipfile there can take a noticeable fraction of the time it takes to
+# normalize it. A worker that reads synchronously sits idle for all of that.
+#
+# A Prefetcher is given the paths of the volumes a worker is about to
+# process, in order, and reads them on a background thread, staying up to
+# depth volumes ahead. Reading a file releases the GIL, so this overlaps I/O
+# with normalization in the same process. The bytes that have been read but
+# not yet used never add up to more than budget; a volume bigger than the
+# whole budget isn't prefetched at all.
+#
+# A worker only knows the volumes in its own batch, and the scheduler puts
+# each of the largest volumes in a batch of its own, which leaves nothing to
+# read ahead. So a Prefetcher can also be given the path of the first volume
+# of the next batch to go out (warm). Once it has read the batch's own
+# volumes, it reads that file too, just to pull it into the node's page
+# cache, and drops the bytes as it goes. Whichever worker on the node gets
+# that batch then finds its first zipfile already cached. With no paths of
+# its own the thread starts on warm straight away.
+#
+# The worker calls take(path) when it gets to each volume, and gets back the
+# bytes of the zipfile, or None if it should read the file itself (because
+# the volume was too big, reading it failed, or it was asked for out of
+# order). Failures aren't reported here: the worker's own read will fail the
+# same way and report the problem as usual.
+#
+# Each take is counted as a hit (the bytes were ready), a stall (we had to
+# wait for the thread to finish reading), or a miss. stats() returns those
+# counts, the seconds spent stalled, and the bytes read to warm the cache,
+# and add_stats sums them across workers.
+#
+# USAGE:
+# prefetcher = Prefetcher(paths, 4, 256 * 1024 * 1024, nextbatchpath)
+# for path in paths:
+#     data = prefetcher.take(path)
+#     ...
+# prefetcher.close()
+
+import os
+import threading
+import time
+
+WARMCHUNK = 1024 * 1024
+# Bytes read at a time when warming the cache, so that close() never waits
+# long for the thread.
+
+class Prefetcher(object):
+
+    def __init__(self, paths, depth = 4, budget = 256 * 1024 * 1024, warm = None):
+        self.paths = list(paths)
+        self.depth = depth
+        self.budget = budget
+        self.warm = warm
+
+        self.buffers = dict()
+        # position -> bytes, or None for a volume the worker will have to
+        # read itself. Entries are removed as they're taken.
+        self.used = 0
+        # Bytes in buffers, plus the size of the file being read.
+        self.next = 0
+        # The next position the thread will read.
+        self.taken = 0
+        # The next position the worker will ask for.
+        self.closed = False
+        self.finished = False
+        # Set when the thread exits, for whatever reason, so take() never
+        # waits for a read that isn't coming.
+        self.condition = threading.Condition()
+
+        self.hits = 0
+        self.stalls = 0
+        self.misses = 0
+        self.stalltime = 0.0
+        self.bytesread = 0
+        self.warmed = 0
+
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.read_ahead()
+            self.warm_cache()
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def read_ahead(self):
+        while True:
+            with self.condition:
+                while not self.closed and self.next < len(self.paths) and self.next - self.taken >= self.depth:
+                    self.condition.wait()
+                if self.closed or self.next >= len(self.paths):
+                    return
+                position = self.next
+                self.next += 1
+
+            path = self.paths[position]
+            try:
+                size = os.path.getsize(path)
+            except (IOError, OSError):
+                size = None
+
+            if size is None or size > self.budget:
+                self.store(position, None)
+                continue
+
+            with self.condition:
+                while not self.closed and self.used > 0 and self.used + size > self.budget:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                self.used += size
+                # Reserve the space before reading, so take() can't let the
+                # thread start another volume that doesn't fit.
+
+            try:
+                with open(path, mode = 'rb') as f:
+                    data = f.read()
+            except (IOError, OSError, MemoryError):
+                data = None
+
+            self.store(position, data, size)
+
+    def warm_cache(self):
+        '''Reads the file at self.warm and throws the bytes away, stopping if
+        the Prefetcher is closed.'''
+
+        if self.warm is None or self.closed:
+            return
+        try:
+            with open(self.warm, mode = 'rb') as f:
+                while not self.closed:
+                    data = f.read(WARMCHUNK)
+                    if len(data) < 1:
+                        break
+                    self.warmed += len(data)
+        except (IOError, OSError):
+            pass
+
+    def store(self, position, data, reserved = 0):
+        with self.condition:
+            if self.closed:
+                return
+            self.used -= reserved
+            self.buffers[position] = data
+            if data is not None:
+                self.used += len(data)
+                self.bytesread += len(data)
+            self.condition.notify_all()
+
+    def take(self, path):
+        '''Returns the bytes of the file at path, or None if the caller should
+        read it itself. Paths have to be taken in the order they were given.'''
+
+        with self.condition:
+            if self.closed or self.taken >= len(self.paths) or self.paths[self.taken] != path:
+                self.misses += 1
+                return None
+
+            position = self.taken
+            self.taken += 1
+            self.condition.notify_all()
+            # Make room for the thread to read further ahead.
+
+            if position in self.buffers:
+                stalled = False
+            else:
+                stalled = True
+                start = time.perf_counter()
+                while position not in self.buffers and not self.finished:
+                    self.condition.wait()
+                self.stalltime += time.perf_counter() - start
+
+            data = self.buffers.pop(position, None)
+            if data is None:
+                self.misses += 1
+            else:
+                self.used -= len(data)
+                if stalled:
+                    self.stalls += 1
+                else:
+                    self.hits += 1
+            self.condition.notify_all()
+
+        return data
+
+    def close(self):
+        '''Stops the thread and drops anything it read that wasn't taken.'''
+
+        with self.condition:
+            self.closed = True
+            self.buffers = dict()
+            self.used = 0
+            self.condition.notify_all()
+        self.thread.join()
+
+    def stats(self):
+        return {'hits': self.hits, 'stalls': self.stalls, 'misses': self.misses, 'stalltime': self.stalltime, 'bytes': self.bytesread, 'warmed': self.warmed}
+
+def add_stats(totals, stats):
+    '''Adds one Prefetcher's stats to a running total (which can start as an
+    empty dictionary).'''
+
+    for key, value in stats.items():
+        totals[key] = totals.get(key, 0) + value
+    return totals
+
+def describe(stats):
+    '''A line summarizing prefetch stats, for the end of a run.'''
+
+    wanted = stats.get('hits', 0) + stats.get('stalls', 0) + stats.get('misses', 0)
+    warmed = " " + str(stats.get('warmed', 0) // 1024) + " KB read ahead of the next batch."
+    if wanted < 1:
+        return "Prefetch: no volumes." + warmed
+
+    hitrate = round(100 * stats['hits'] / wanted, 1)
+    return "Prefetch: " + str(stats['hits']) + " of " + str(wanted) + " volumes were in memory when wanted (" + str(hitrate) + "%); " + str(stats['stalls']) + " waited " + str(round(stats['stalltime'], 4)) + " s in all for the read to finish; " + str(stats['misses']) + " were read directly. " + str(stats['bytes'] // 1024) + " KB prefetched." + warmed
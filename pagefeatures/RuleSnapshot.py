@@ -0,0 +1,166 @@
+# RuleSnapshot.py
+#
+# Parsing the plain-text rulesets is surprisingly expensive. NormalizeVolume
+# reads something like 100k lines of rules every time it is imported, and
+# Context reads the whole bigram file, so every worker in a Pool (and every
+# short job on the cluster) pays that cost again before it does any work.
+#
+# This module lets those modules compile their tables once into a binary
+# snapshot that lives next to the rules. The snapshot records a hash of each
+# source file, so if anyone edits a ruleset the snapshot is recognized as stale
+# and quietly rebuilt the next time the rules are loaded.
+#
+# The same concern applies to memory. A Pool worker that loads its own copy of
+# the rules multiplies resident memory by the number of workers. The function
+# shared_pool at the bottom of this module creates a Pool whose workers are
+# forked from a parent that has already loaded the rules, so they inherit one
+# frozen copy instead of building twelve.
+#
+# USAGE:
+# from a directory containing PathDictionary.txt:
+# python3 RuleSnapshot.py
+# which (re)compiles snapshots for both NormalizeVolume and Context, along
+# with the BigramStore that Context uses.
+
+import gc
+import hashlib
+import multiprocessing
+import os
+import pickle
+import sys
+
+SNAPSHOTFORMAT = 1
+# Increment this if the layout of the snapshot file itself changes.
+
+rebuild = False
+# Set this to True to ignore existing snapshots and recompile them.
+
+def hash_sources(rulepath, filenames):
+    '''Returns a dictionary mapping each source filename to the sha1
+    hash of its contents.'''
+
+    hashes = dict()
+    for filename in filenames:
+        sha = hashlib.sha1()
+        with open(rulepath + filename, mode = 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        hashes[filename] = sha.hexdigest()
+
+    return hashes
+
+def snapshot_path(rulepath, name):
+    return rulepath + name + '.snapshot'
+
+def make_header(name, version, hashes):
+    '''The header is what we compare to decide whether a snapshot is current.
+    It is pickled separately from the tables, so that a stale snapshot can be
+    rejected without unpickling the (large) tables.'''
+
+    return (SNAPSHOTFORMAT, name, version, sys.version_info[0:2], hashes)
+
+def read_snapshot(path, header):
+    '''Returns the tables stored in path, or None if the snapshot is
+    missing, unreadable, or was compiled from different sources.'''
+
+    try:
+        with open(path, mode = 'rb') as f:
+            storedheader = pickle.load(f)
+            if storedheader != header:
+                return None
+            tables = pickle.load(f)
+    except Exception:
+        return None
+        # A truncated or stale pickle can fail in many ways (ValueError,
+        # AttributeError, ImportError, IndexError...), and any of them just
+        # means we rebuild from the rule files.
+
+    return tables
+
+def write_snapshot(path, header, tables):
+    '''Writes the snapshot to a temporary file and renames it into place,
+    so that a worker never sees a half-written snapshot. Failure to write
+    is not fatal; we just keep using the parsed tables.'''
+
+    temppath = path + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(temppath, mode = 'wb') as f:
+            pickle.dump(header, f, protocol = pickle.HIGHEST_PROTOCOL)
+            pickle.dump(tables, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(temppath, path)
+    except (IOError, OSError) as e:
+        print("Could not write rule snapshot " + path + ": " + str(e))
+        if os.path.exists(temppath):
+            os.remove(temppath)
+        return False
+
+    return True
+
+def load_rules(name, rulepath, filenames, parser, version = 1):
+    '''Returns the tables that parser(rulepath) would produce, loading
+    them from a snapshot if there is a current one, and otherwise parsing
+    the rulesets and writing a new snapshot.
+
+    Name identifies the snapshot (usually the name of the module that owns
+    the tables); filenames are the source rulesets it depends on. Modules
+    should increment version whenever their parser changes the shape of
+    the tables, since that makes old snapshots invalid even if the rules
+    themselves are unchanged.'''
+
+    global rebuild
+
+    hashes = hash_sources(rulepath, filenames)
+    header = make_header(name, version, hashes)
+    path = snapshot_path(rulepath, name)
+
+    if not rebuild:
+        tables = read_snapshot(path, header)
+        if tables is not None:
+            return tables
+
+    tables = parser(rulepath)
+    write_snapshot(path, header, tables)
+
+    return tables
+
+def share_with_workers():
+    '''Prepares tables already loaded in this process to be inherited by
+    forked workers. After fork, pages are shared copy-on-write, but the
+    cyclic garbage collector writes to every container it scans, which
+    gradually copies the rules into each worker. Freezing moves everything
+    that exists now into a permanent generation the collector ignores.'''
+
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    # gc.freeze only exists in Python 3.7+. On older interpreters we still
+    # get the benefit of forking from a parent that has loaded the rules.
+
+def shared_pool(processes):
+    '''Returns a Pool of processes that share the rules loaded in this
+    process instead of loading their own copies. Modules that own rules
+    (NormalizeVolume, Context) must be imported before calling this.
+
+    We insist on the fork start method, because under spawn or forkserver
+    each worker re-imports the modules and builds private tables. Where fork
+    isn't available we fall back to an ordinary Pool.'''
+
+    share_with_workers()
+
+    try:
+        context = multiprocessing.get_context('fork')
+    except ValueError:
+        print("Fork is not available; workers will load their own rules.")
+        context = multiprocessing.get_context()
+
+    return context.Pool(processes = processes)
+
+if __name__ == "__main__":
+    # Importing the modules is enough to compile their snapshots; we just make
+    # sure they're recompiled even if they look current. Note that we have to
+    # set the flag on the imported module, not on __main__.
+    import RuleSnapshot
+    RuleSnapshot.rebuild = True
+    import NormalizeVolume
+    import Context
+    print("Compiled rule snapshots for NormalizeVolume and Context, and Context's bigram store.")
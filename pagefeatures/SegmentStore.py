@@ -0,0 +1,264 @@
+# SegmentStore.py
+#
+# Packs the files MultiNormalizeOCR writes for each volume (.norm.txt, .pg.tsv,
+# and .hdr.tsv and .ftr.tsv if we're writing headers) into a few large
+# segment files, instead of leaving four little files in every volume's
+# pairtree directory. A slice of 100,000 volumes used to mean 400,000 file
+# creations and renames on the shared filesystem, and as many opens again for
+# whoever read the results.
+#
+# Each process appends to a segment of its own, named host.pid.seg, so there
+# is never more than one writer per file and no locking. A record in a
+# segment is a sixteen-byte header,
+#
+# 'SEG1', codec (1 byte), length of kind (1), length of htid (2),
+# length of payload (4), crc32 of payload (4)
+#
+# followed by the kind (e.g. 'norm.txt'), the HTID, and the payload, which is
+# the file's bytes, compressed with gzip or lzma or not at all. Each file is
+# compressed on its own, so any one of them can be read without the others.
+#
+# add() returns an entry saying where the record went, and the driver writes
+# those to an index for the slice, one line per file:
+#
+# htid <tab> kind <tab> segment <tab> offset <tab> length <tab> codec
+#
+# A SegmentReader loads every index in a directory and reads files by HTID
+# from segments mapped into memory. If a volume turns up in more than one
+# index line (because a slice was resumed, say), the last one wins. Records
+# that no index points to (from a run that was killed) are never read, and
+# scan_segment can recover an index from a segment's headers if an index is
+# lost.
+#
+# USAGE:
+# writer = SegmentWriter(segmentdir, 'gzip')
+# entry = writer.add(htid, 'norm.txt', data)
+# writer.sync()
+#
+# reader = SegmentReader(segmentdir)
+# text = reader.text('mdp.39015000000006', 'pg.tsv')
+#
+# python3 SegmentStore.py get segmentdir htid [kind]
+# python3 SegmentStore.py htids segmentdir
+# python3 SegmentStore.py scan segmentdir/host.pid.seg > recovered.idx
+
+import gzip
+import lzma
+import mmap
+import os
+import socket
+import struct
+import sys
+import zlib
+
+MAGIC = b'SEG1'
+HEADER = struct.Struct('<4sBBHII')
+CODECS = [None, 'gzip', 'lzma']
+
+def compress(data, codec):
+    if codec is None:
+        return data
+    elif codec == 'gzip':
+        return gzip.compress(data, compresslevel = 6)
+    elif codec == 'lzma':
+        return lzma.compress(data)
+    else:
+        raise ValueError("Unknown compression " + str(codec))
+
+def decompress(data, codec):
+    if codec is None:
+        return bytes(data)
+    elif codec == 'gzip':
+        return gzip.decompress(data)
+    else:
+        return lzma.decompress(data)
+
+def codec_name(codec):
+    if codec is None:
+        return 'none'
+    return codec
+
+class SegmentWriter(object):
+    '''Appends records to this process's segment in directory.'''
+
+    def __init__(self, directory, codec = None):
+        if codec not in CODECS:
+            raise ValueError("Unknown compression " + str(codec))
+        os.makedirs(directory, exist_ok = True)
+        self.codec = codec
+        self.pid = os.getpid()
+        # A forked child must make its own writer; see the driver.
+        self.name = socket.gethostname().split('.')[0] + '.' + str(self.pid) + '.seg'
+        self.file = open(os.path.join(directory, self.name), mode = 'ab')
+        self.file.seek(0, os.SEEK_END)
+        # If a process with the same pid on this host wrote a segment in an
+        # earlier run, we just carry on after its records.
+
+    def add(self, htid, kind, data):
+        '''Appends one file's bytes and returns its index entry: (kind,
+        segment, offset, length, codec).'''
+
+        payload = compress(data, self.codec)
+        htidbytes = htid.encode('utf-8')
+        kindbytes = kind.encode('utf-8')
+        header = HEADER.pack(MAGIC, CODECS.index(self.codec), len(kindbytes), len(htidbytes), len(payload), zlib.crc32(payload))
+
+        offset = self.file.tell()
+        self.file.write(header + kindbytes + htidbytes + payload)
+        self.file.flush()
+        # Flushed at once, so that the record survives this process being
+        # killed once the parent has indexed it.
+
+        length = HEADER.size + len(kindbytes) + len(htidbytes) + len(payload)
+        return (kind, self.name, offset, length, codec_name(self.codec))
+
+    def sync(self):
+        '''Forces the segment to disk. Call it before the records are indexed
+        if they need to survive the node crashing.'''
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+def index_line(htid, entry):
+    kind, segment, offset, length, codec = entry
+    return htid + '\t' + kind + '\t' + segment + '\t' + str(offset) + '\t' + str(length) + '\t' + codec + '\n'
+
+def parse_record(data, offset):
+    '''Returns (htid, kind, codec, start and end of the payload) for the
+    record at offset in data, checking its header.'''
+
+    if offset + HEADER.size > len(data):
+        raise ValueError("Record at " + str(offset) + " runs past the end of the segment")
+    magic, codec, kindlength, htidlength, payloadlength, crc = HEADER.unpack_from(data, offset)
+    if magic != MAGIC or codec >= len(CODECS):
+        raise ValueError("No record at " + str(offset))
+
+    start = offset + HEADER.size
+    kind = bytes(data[start: start + kindlength]).decode('utf-8')
+    start += kindlength
+    htid = bytes(data[start: start + htidlength]).decode('utf-8')
+    start += htidlength
+    end = start + payloadlength
+    if end > len(data):
+        raise ValueError("Record at " + str(offset) + " runs past the end of the segment")
+
+    return htid, kind, CODECS[codec], start, end, crc
+
+def scan_segment(path):
+    '''Yields an index entry (htid, kind, segment, offset, length, codec) for
+    every complete record in the segment at path. Stops at a record that was
+    cut off.'''
+
+    name = os.path.basename(path)
+    with open(path, mode = 'rb') as f:
+        data = f.read()
+
+    offset = 0
+    while offset < len(data):
+        try:
+            htid, kind, codec, start, end, crc = parse_record(data, offset)
+        except ValueError:
+            break
+        if zlib.crc32(data[start: end]) != crc:
+            break
+        yield (htid, kind, name, offset, end - offset, codec_name(codec))
+        offset = end
+
+class SegmentReader(object):
+    '''Random access by HTID to the files in a directory of segments, through
+    the indexes (*.idx) kept beside them.'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries = dict()
+        self.segments = dict()
+
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.idx'):
+                self.read_index(os.path.join(directory, name))
+
+    def read_index(self, path):
+        with open(path, encoding = 'utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    continue
+                    # Cut off while it was being written.
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 6:
+                    continue
+                htid, kind, segment, offset, length, codec = fields
+                if htid not in self.entries:
+                    self.entries[htid] = dict()
+                self.entries[htid][kind] = (segment, int(offset), int(length))
+
+    def htids(self):
+        return sorted(self.entries.keys())
+
+    def __contains__(self, htid):
+        return htid in self.entries
+
+    def kinds(self, htid):
+        return sorted(self.entries.get(htid, dict()).keys())
+
+    def segment(self, name):
+        if name not in self.segments:
+            with open(os.path.join(self.directory, name), mode = 'rb') as f:
+                self.segments[name] = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        return self.segments[name]
+
+    def get(self, htid, kind = 'norm.txt'):
+        '''The bytes of one of htid's files, or None if there's no such file
+        in the index. Raises ValueError if the record is damaged.'''
+
+        if htid not in self.entries or kind not in self.entries[htid]:
+            return None
+
+        segment, offset, length = self.entries[htid][kind]
+        data = self.segment(segment)
+        if offset + length > len(data):
+            raise ValueError(htid + " " + kind + " runs past the end of " + segment)
+
+        recordhtid, recordkind, codec, start, end, crc = parse_record(data, offset)
+        if recordhtid != htid or recordkind != kind or end != offset + length:
+            raise ValueError("The index entry for " + htid + " " + kind + " doesn't match its record in " + segment)
+        payload = data[start: end]
+        if zlib.crc32(payload) != crc:
+            raise ValueError(htid + " " + kind + " is damaged in " + segment)
+
+        return decompress(payload, codec)
+
+    def text(self, htid, kind = 'norm.txt'):
+        data = self.get(htid, kind)
+        if data is None:
+            return None
+        return data.decode('utf-8')
+
+    def close(self):
+        for data in self.segments.values():
+            data.close()
+        self.segments = dict()
+
+if __name__ == "__main__":
+    command = sys.argv[1]
+
+    if command == "get":
+        kind = 'norm.txt'
+        if len(sys.argv) > 4:
+            kind = sys.argv[4]
+        data = SegmentReader(sys.argv[2]).get(sys.argv[3], kind)
+        if data is None:
+            print("No " + kind + " for " + sys.argv[3])
+        else:
+            sys.stdout.buffer.write(data)
+
+    elif command == "htids":
+        for htid in SegmentReader(sys.argv[2]).htids():
+            print(htid)
+
+    elif command == "scan":
+        for entry in scan_segment(sys.argv[2]):
+            sys.stdout.write(index_line(entry[0], entry[1:]))
@@ -0,0 +1,198 @@
+# SliceJournal.py
+#
+# Records the results of a slice as volumes finish, so a job that's killed
+# partway through leaves everything it finished behind, and can pick up
+# where it left off.
+#
+# MultiNormalizeOCR used to keep every volume's result in memory until the
+# whole slice was done, and only then write NormalizingMetadata.txt and the
+# errorlog. A SliceWriter appends each volume's metadata row and errors as
+# soon as its result comes back, and then adds its HTID to a journal of
+# finished volumes. When a slice is restarted, read_journal tells the driver
+# which volumes it can skip.
+#
+# Each slice writes metadata rows to a file of its own, because jobs on
+# different nodes appending to one NormalizingMetadata.txt on a shared
+# filesystem can interleave their rows. merge_metadata combines the slices'
+# files into NormalizingMetadata.txt once the jobs are done.
+#
+# Metadata rows and errors are flushed to the operating system right away,
+# which is enough to survive the job being killed. Surviving a crash of the
+# node needs an fsync, which is slow on a shared filesystem, so we only do
+# that every syncevery seconds (and when the writer is closed). HTIDs wait in
+# memory until then, and are written to the journal only after the metadata
+# and errorlog have been fsynced, so the journal never lists a volume whose
+# results were lost, even if the node goes down. The cost is that a job that
+# is killed redoes the volumes it finished since the last sync; their
+# metadata rows then appear twice, and merge_metadata keeps the later one.
+#
+# If the volumes' files go into segments (SegmentStore.py), record() is also
+# given each volume's index entries, and writes them to the slice's index,
+# which is fsynced before the journal for the same reason.
+#
+# USAGE:
+# done = read_journal(journalpath)
+# writer = SliceWriter(metaoutpath, errorpath, journalpath, resuming = len(done) > 0)
+# writer.record(htid, metatuple, errors)
+# or, with an index: SliceWriter(..., indexpath = indexpath)
+#                    writer.record(htid, metatuple, errors, segments)
+# writer.close()
+#
+# python3 SliceJournal.py merge NormalizingMetadata.txt slices/*metadata.txt
+
+import os
+import sys
+import time
+import SegmentStore
+
+def read_journal(path):
+    '''Returns the set of HTIDs in the journal at path (empty if there isn't
+    one). A last line without a newline was cut off while it was being
+    written, so we don't trust it.'''
+
+    done = set()
+    try:
+        with open(path, encoding = 'utf-8') as f:
+            for line in f:
+                if line.endswith('\n') and len(line) > 1:
+                    done.add(line.rstrip('\n'))
+    except IOError:
+        pass
+
+    return done
+
+class SliceWriter(object):
+
+    def __init__(self, metaoutpath, errorpath, journalpath, resuming = False, syncevery = 60, delim = '\t', indexpath = None):
+        self.errorpath = errorpath
+        self.delim = delim
+        self.syncevery = syncevery
+        self.lastsync = time.time()
+        self.records = 0
+        self.pending = list()
+        # HTIDs recorded since the last sync, waiting to be journaled.
+
+        if resuming:
+            mode = 'a'
+        else:
+            mode = 'w'
+            # A fresh start, so earlier errors and journal entries don't
+            # belong to this run. (The metadata file is appended to; the
+            # driver starts it afresh with its header.)
+
+        self.metafile = open(metaoutpath, mode = 'a', encoding = 'utf-8')
+        self.journal = open(journalpath, mode = mode, encoding = 'utf-8')
+        self.index = None
+        if indexpath is not None:
+            self.index = open(indexpath, mode = mode, encoding = 'utf-8')
+            # Rewritten on a fresh start like the journal. The records it
+            # pointed to stay in their segments, but nothing reads them.
+        self.errormode = mode
+        self.errorfile = None
+        # Opened when the first error arrives, so a clean slice doesn't
+        # leave an empty errorlog behind.
+
+        if resuming and not self.journal_ends_cleanly(journalpath):
+            self.journal.write('\n')
+            # Finish a line that was cut off, so that the next HTID starts
+            # on a line of its own.
+
+        if resuming and self.index is not None and not self.journal_ends_cleanly(indexpath):
+            self.index.write('\n')
+
+    def journal_ends_cleanly(self, journalpath):
+        with open(journalpath, mode = 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < 1:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def record(self, htid, metatuple, errors, segments = None):
+        '''Writes one volume's metadata row, errors and index entries. The
+        volume is journaled at the next sync.'''
+
+        self.metafile.write(self.delim.join(metatuple) + '\n')
+        self.metafile.flush()
+
+        if len(errors) > 0:
+            if self.errorfile is None:
+                self.errorfile = open(self.errorpath, mode = self.errormode, encoding = 'utf-8')
+            for line in errors:
+                self.errorfile.write(line + '\n')
+            self.errorfile.flush()
+
+        if self.index is not None and segments is not None and len(segments) > 0:
+            for entry in segments:
+                self.index.write(SegmentStore.index_line(htid, entry))
+            self.index.flush()
+
+        self.pending.append(htid)
+        self.records += 1
+
+        if time.time() - self.lastsync >= self.syncevery:
+            self.sync()
+
+    def sync(self):
+        '''Fsyncs the metadata, errorlog and index, and then journals the
+        volumes recorded since the last sync.'''
+
+        for f in [self.metafile, self.errorfile, self.index]:
+            if f is not None:
+                f.flush()
+                os.fsync(f.fileno())
+
+        for htid in self.pending:
+            self.journal.write(htid + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.pending = list()
+        self.lastsync = time.time()
+
+    def close(self):
+        self.sync()
+        for f in [self.metafile, self.errorfile, self.index, self.journal]:
+            if f is not None:
+                f.close()
+
+def merge_metadata(outpath, paths, delim = '\t'):
+    '''Merges the slices' metadata files at paths into the one at outpath,
+    keeping the rows already there. A volume with more than one row (because
+    it was redone) keeps the last. The merged file is written beside outpath
+    and renamed over it, so nobody reads it half-written. Returns the number
+    of volumes in it.'''
+
+    header = None
+    rows = dict()
+    for path in [outpath] + list(paths):
+        if not os.path.isfile(path):
+            continue
+        with open(path, encoding = 'utf-8') as f:
+            for line in f:
+                if not line.endswith('\n') or len(line) < 2:
+                    continue
+                    # Cut off while it was being written.
+                volID = line.split(delim, 1)[0]
+                if volID == 'volID':
+                    header = line
+                else:
+                    rows[volID] = line
+
+    temppath = outpath + '.' + str(os.getpid()) + '.tmp'
+    with open(temppath, mode = 'w', encoding = 'utf-8') as f:
+        if header is not None:
+            f.write(header)
+        for line in rows.values():
+            f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temppath, outpath)
+
+    return len(rows)
+
+if __name__ == "__main__":
+    command = sys.argv[1]
+
+    if command == "merge":
+        count = merge_metadata(sys.argv[2], sys.argv[3:])
+        print(str(count) + " volumes in " + sys.argv[2])
@@ -0,0 +1,235 @@
+# StageTimer.py
+#
+# Records where a worker spends its time. A StageTimer keeps running totals
+# of wall time and CPU time for named stages (zip read, HeaderFinder,
+# as_stream, and so on), plus memory, and counts of the pages and tokens it
+# processed.
+#
+# The operating system only tells us the peak resident memory of the whole
+# process so far, which never goes down. So for each volume we report that
+# peak, and also how far the volume raised it. Most volumes raise it not at
+# all; the ones that do are the ones that cost a worker memory.
+#
+# Stages are switched rather than nested: calling start('correct_stream')
+# closes whatever stage was running and starts a new one. That makes it easy
+# to instrument a loop where several stages alternate, since time simply
+# accumulates under each name.
+#
+# When instrumentation is turned off, callers get NULLTIMER, whose methods do
+# nothing, so the instrumented code doesn't need any if-statements.
+#
+# StageTimer.stats packages the totals for one volume; write_stats writes
+# the stats for a whole slice to a tab-separated file.
+
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+    # The resource module doesn't exist on Windows; we just won't report
+    # peak memory there.
+
+STAGES = ['zip read', 'HeaderFinder', 'as_stream', 'correct_stream', 'Context', 'header boost', '.norm.txt write', '.pg.tsv write']
+# The usual stages, in the order we like to see them. Other stage names are
+# allowed; they're written after these.
+
+def peak_rss():
+    '''Peak resident memory of this process so far, in kilobytes, or 0 if
+    we can't tell.'''
+
+    if resource is None:
+        return 0
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak = peak // 1024
+        # Mac OS reports ru_maxrss in bytes; Linux reports kilobytes.
+    return peak
+
+class StageTimer(object):
+
+    def __init__(self):
+        self.wall = dict()
+        self.cpu = dict()
+        self.order = list()
+        self.current = None
+        self.wallstart = 0
+        self.cpustart = 0
+        self.pages = 0
+        self.tokens = 0
+        self.startrss = peak_rss()
+        self.growth = 0
+        # How far the volume has raised the peak memory of processes it was
+        # in before this one (see __getstate__).
+
+    def __getstate__(self):
+        '''A timer can be sent to another process with a volume that's
+        been deferred. We bank the growth in peak memory so far, and start
+        measuring again from the new process's peak when we arrive.'''
+
+        state = self.__dict__.copy()
+        state['growth'] = self.peak_growth()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.startrss = peak_rss()
+
+    def peak_growth(self):
+        return self.growth + max(0, peak_rss() - self.startrss)
+
+    def start(self, stage):
+        '''Starts timing stage, stopping whatever stage was running.'''
+
+        wallnow = time.perf_counter()
+        cpunow = time.process_time()
+
+        if self.current is not None:
+            self.wall[self.current] += wallnow - self.wallstart
+            self.cpu[self.current] += cpunow - self.cpustart
+
+        if stage not in self.wall:
+            self.wall[stage] = 0.0
+            self.cpu[stage] = 0.0
+            self.order.append(stage)
+
+        self.current = stage
+        self.wallstart = wallnow
+        self.cpustart = cpunow
+
+    def stop(self):
+        '''Stops the stage that's running, if any.'''
+
+        if self.current is None:
+            return
+
+        self.wall[self.current] += time.perf_counter() - self.wallstart
+        self.cpu[self.current] += time.process_time() - self.cpustart
+        self.current = None
+
+    def count(self, pages, tokens):
+        self.pages += pages
+        self.tokens += tokens
+
+    def stats(self):
+        '''Returns a plain dictionary (so it pickles cheaply on its way back
+        from a Pool worker) with the totals for each stage, the pages and
+        tokens counted, the peak memory of the process, how far this timer's
+        volume raised it, and the pid.'''
+
+        self.stop()
+        stages = dict()
+        for stage in self.order:
+            stages[stage] = (self.wall[stage], self.cpu[stage])
+
+        return {'stages': stages, 'pages': self.pages, 'tokens': self.tokens, 'peakrss': peak_rss(), 'peakgrowth': self.peak_growth(), 'pid': os.getpid()}
+
+class NullTimer(object):
+    '''Does nothing, as cheaply as possible.'''
+
+    def start(self, stage):
+        pass
+
+    def stop(self):
+        pass
+
+    def count(self, pages, tokens):
+        pass
+
+    def stats(self):
+        return None
+
+NULLTIMER = NullTimer()
+
+def new_timer(instrument):
+    if instrument:
+        return StageTimer()
+    else:
+        return NULLTIMER
+
+def stage_names(statslist):
+    '''All stage names that appear in a list of stats, usual ones first.'''
+
+    names = list()
+    for stats in statslist:
+        for stage in stats['stages']:
+            if stage not in names and stage not in STAGES:
+                names.append(stage)
+
+    return STAGES + sorted(names)
+
+def write_stats(path, rows):
+    '''Writes a tab-separated file with one row per volume. Rows is a list of
+    (htid, path, stats) where path says how the volume was processed, and
+    stats came from StageTimer.stats. After the volumes come a row for each
+    worker process and a TOTAL row, which sum every column except the
+    process's peak memory, where they report the largest peak.
+
+    processpeakKB is the peak resident memory of the worker when it
+    finished the volume, over its whole life so far, not just this volume.
+    peakgrowthKB is how much the volume raised that peak.'''
+
+    rows = [x for x in rows if x[2] is not None]
+    if len(rows) < 1:
+        return
+
+    names = stage_names([x[2] for x in rows])
+
+    header = ['htid', 'path', 'pid', 'pages', 'tokens', 'processpeakKB', 'peakgrowthKB']
+    for stage in names:
+        header.append(stage + ' wall')
+        header.append(stage + ' cpu')
+    header.append('total wall')
+    header.append('total cpu')
+
+    workers = dict()
+    workerorder = list()
+    total = [0, 0, 0, 0] + [0.0] * (len(names) * 2 + 2)
+    # pages, tokens, peakrss, peakgrowth, then a wall and cpu for each
+    # stage, then the wall and cpu for all stages.
+
+    with open(path, mode = 'w', encoding = 'utf-8') as f:
+        f.write('\t'.join(header) + '\n')
+
+        for htid, volpath, stats in rows:
+            numbers = [stats['pages'], stats['tokens'], stats['peakrss'], stats['peakgrowth']]
+            volwall = 0.0
+            volcpu = 0.0
+            for stage in names:
+                wall, cpu = stats['stages'].get(stage, (0.0, 0.0))
+                numbers.append(wall)
+                numbers.append(cpu)
+                volwall += wall
+                volcpu += cpu
+            numbers.append(volwall)
+            numbers.append(volcpu)
+
+            f.write('\t'.join([htid, volpath, str(stats['pid'])] + format_numbers(numbers)) + '\n')
+
+            pid = stats['pid']
+            if pid not in workers:
+                workers[pid] = [0, 0, 0, 0] + [0.0] * (len(names) * 2 + 2)
+                workerorder.append(pid)
+            add_numbers(workers[pid], numbers)
+            add_numbers(total, numbers)
+
+        for pid in workerorder:
+            f.write('\t'.join(['worker', '', str(pid)] + format_numbers(workers[pid])) + '\n')
+
+        f.write('\t'.join(['TOTAL', '', ''] + format_numbers(total)) + '\n')
+
+def add_numbers(totals, numbers):
+    for i in range(len(numbers)):
+        if i == 2:
+            totals[i] = max(totals[i], numbers[i])
+            # peak memory
+        else:
+            totals[i] += numbers[i]
+
+def format_numbers(numbers):
+    formatted = [str(x) for x in numbers[0:4]]
+    formatted.extend([str(round(x, 4)) for x in numbers[4:]])
+    return formatted
@@ -0,0 +1,336 @@
+# StreamingNormalizer.py
+#
+# Normalizes a volume a page at a time. The batch path in MultiNormalizeOCR
+# reads every page of a volume into memory, turns the whole volume into one
+# list of tokens, corrects that list into a second list, and only then writes
+# anything. For a big volume that's several copies of the text (plus page
+# dictionaries) alive at once, which limits how many workers we can run on a
+# node.
+#
+# Here pages are read lazily from the zipfile (by VolumeReader), tokenized, corrected, and
+# written to .norm.txt and .pg.tsv as soon as the pages after them have been
+# seen. (Headers are identified in a sliding window of three pages, and
+# correction looks up to three tokens ahead, so a page can't be finished until
+# a little of the next page is in hand.) The output is the same as the batch
+# path produces.
+#
+# A few volumes can't be finished this way, and for those normalize_zip
+# reports a successflag that tells the caller to fall back on the batch path:
+#
+# "long s"      -- the volume needs contextual correction for long s, which
+#                  has to see the whole volume. Normally we only find this
+#                  out at the end, so those volumes get read twice; there
+#                  are a small number of them. If decideafter is more than
+#                  zero, we may find out after that many pages instead (see
+#                  LongSEvidence).
+# "misaligned"  -- some page contains a <pb> token inside its text, so page
+#                  dictionaries won't line up with pages. The batch path
+#                  has its own way of logging that problem.
+#
+# Output is written to temporary files that are only renamed into place on
+# success, so a fallback (or a crash) never leaves half a volume behind.
+#
+# The functions that write features for a page are shared with the batch path,
+# so the two can't drift apart.
+
+import os
+from collections import deque
+
+import NormalizeVolume
+from HeaderFinder import HeaderMap
+from StageTimer import NULLTIMER
+from NormalizeVolume import Tokenizer, VolumeState
+from LongSEvidence import LongSCounter
+from VolumeReader import VolumeReader
+
+def iter_pages(volume, timer = NULLTIMER):
+    '''Yields the lines of each page in a VolumeReader, reading one page at
+    a time. Pages are consumed by HeaderFinder.iter_headers, so that's the
+    stage we hand the timer back to.'''
+
+    for position in range(len(volume)):
+        timer.start('zip read')
+        linelist = volume.page(position)
+        timer.start('HeaderFinder')
+        yield linelist
+
+def write_tokens(file, tokens):
+    for token in tokens:
+        if token != '\n' and token != "“" and not (token.startswith('<') and token.endswith('>')):
+            token = token + " "
+        file.write(token)
+
+def write_metadata_features(file, metadata_evidence):
+
+    if metadata_evidence["biography"]:
+        file.write("-1\t#metaBiography\t0\n")
+
+    if metadata_evidence["drama"]:
+        file.write("-1\t#metaDrama\t0\n")
+
+    if metadata_evidence["fiction"]:
+        file.write("-1\t#metaFiction\t0\n")
+
+    if metadata_evidence["poetry"]:
+        file.write("-1\t#metaPoetry\t0\n")
+
+def write_page(file, index, page, structural_features, pagevocabset):
+    '''Writes the features for one page to a .pg.tsv file, and returns the
+    number of words on the page.'''
+
+    totalwords = 0
+    otherfeatures = 0
+
+    for feature, count in page.items():
+        if feature in pagevocabset or feature.startswith("#"):
+            outline = str(index) + '\t' + feature + '\t' + str(count) + '\n'
+            # pagenumber, featurename, featurecount
+            file.write(outline)
+        else:
+            otherfeatures += count
+
+        if not feature.startswith("#"):
+            totalwords += count
+        # This is because there are structural features like #allcapswords
+        # that should not be counted toward total token count.
+
+    for feature, count in structural_features.items():
+        if count > 0 or feature == "#textlines":
+            outline = str(index) + '\t' + feature + '\t' + str(count) + '\n'
+            file.write(outline)
+
+    if otherfeatures > 0:
+        outline = str(index) + '\t' + "wordNotInVocab" + '\t' + str(otherfeatures) + '\n'
+        file.write(outline)
+
+    return totalwords
+
+def boost_headers(page, headerdict, meaningfulheaders, htid, index):
+    '''Gives extra weight in a page dictionary to meaningful words found in
+    the running header of the page. Headerdict is the header's own page
+    dictionary, from NormalizerSession.correct_headers or correct_header.'''
+
+    for key, value in headerdict.items():
+        if key in meaningfulheaders:
+            if key in page:
+                page[key] += 2
+                # a fixed increment no matter how many times the word occurs in the
+                # header
+            else:
+                page[key] = 2
+                print("Word " + key + " in headerdict for " + htid + " at " + str(index) + " but not main page.")
+
+def discard(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+def normalize_zip(filename, normpath, pgpath, htid, metadata_evidence, pagevocabset, meaningfulheaders, felecterrors, selecttruths, session = None, verbose = False, timer = NULLTIMER, decideafter = 0, hdrpath = None, ftrpath = None, data = None):
+    '''Normalizes the volume in zipfile filename (or in data, the bytes of
+    that zipfile, if we've already read them), writing corrected text
+    to normpath and page features to pgpath, and, if hdrpath and ftrpath are
+    given, HeaderMaps of its running headers and footers to them. Returns a successflag and a
+    dictionary of statistics about the volume: the raw tokencount, pre- and
+    post-correction match rates, and the total number of words.
+
+    See the top of this module for the flags that mean the caller should
+    use the batch path instead. Timer, if supplied, is a StageTimer that
+    accumulates time for the same stages as the batch path. Decideafter is
+    passed to the LongSCounter that tests for long s.'''
+
+    if session is None:
+        session = NormalizeVolume.default_session
+
+    stats = dict()
+
+    try:
+        timer.start('zip read')
+        with VolumeReader(filename, data) as volume:
+            if len(volume) < 1:
+                return "missing file", stats
+
+            successflag = stream_volume(session, iter_pages(volume, timer), normpath, pgpath, htid, metadata_evidence, pagevocabset, meaningfulheaders, felecterrors, selecttruths, stats, verbose, timer, decideafter, hdrpath, ftrpath)
+
+    except IOError as e:
+        discard(temp_paths([normpath, pgpath, hdrpath, ftrpath]))
+        return "missing file", stats
+    except UnicodeError as e:
+        discard(temp_paths([normpath, pgpath, hdrpath, ftrpath]))
+        return "unicode error", stats
+
+    return successflag, stats
+
+def temp_paths(paths):
+    return [x + '.tmp' for x in paths if x is not None]
+
+def stream_volume(session, pages, normpath, pgpath, htid, metadata_evidence, pagevocabset, meaningfulheaders, felecterrors, selecttruths, stats, verbose = False, timer = NULLTIMER, decideafter = 0, hdrpath = None, ftrpath = None):
+    '''Does the work of normalize_zip for any iterable of pages.'''
+
+    normtemp = normpath + '.tmp'
+    pgtemp = pgpath + '.tmp'
+
+    tokenizer = Tokenizer(session.lexicon)
+    longs = LongSCounter(felecterrors, selecttruths, decideafter)
+    state = VolumeState(longs)
+
+    buffer = list()
+    # Tokens not yet corrected, plus however many we've kept for lookahead.
+    pagedata = deque()
+    headers = deque()
+    # Structural features and header tokens for pages that haven't been
+    # written yet.
+    headermemo = dict()
+    # Running headers repeat, so we only correct each distinct one once.
+    headermap = None
+    footermap = None
+    if hdrpath is not None:
+        headermap = HeaderMap()
+    if ftrpath is not None:
+        footermap = HeaderMap()
+
+    tokencount = 0
+    correctedcount = 0
+    pagesyielded = 0
+    pageswritten = 0
+    totalwordsinvol = 0
+
+    normfile = open(normtemp, mode = 'w', encoding = 'utf-8')
+    pgfile = open(pgtemp, mode = 'w', encoding = 'utf-8')
+
+    try:
+        write_metadata_features(pgfile, metadata_evidence)
+
+        timer.start('HeaderFinder')
+        for pagetokens, structural_features, headertokens in session.iter_stream(pages, tokenizer, timer, headermap, footermap):
+
+            # A <pb> anywhere but at the start of a page would start an extra
+            # page dictionary.
+            if pagesyielded > 0:
+                extrabreaks = pagetokens.count('<pb>') - 1
+            else:
+                extrabreaks = pagetokens.count('<pb>')
+            if extrabreaks > 0:
+                normfile.close()
+                pgfile.close()
+                discard([normtemp, pgtemp])
+                return "misaligned"
+
+            pagesyielded += 1
+            tokencount += len(pagetokens)
+            pagedata.append(structural_features)
+            headers.append(headertokens)
+            buffer.extend(pagetokens)
+
+            timer.start('correct_stream')
+            stop = len(buffer) - 3
+            if stop > 0:
+                session.correct_span(state, buffer, 0, stop)
+                del buffer[0:stop]
+
+            if longs.decided() and longs.long_s_problem():
+                normfile.close()
+                pgfile.close()
+                discard([normtemp, pgtemp])
+                timer.stop()
+                return "long s"
+                # No point in finishing a volume we'll have to redo.
+
+            timer.start('.norm.txt write')
+            correctedcount += flush_tokens(normfile, state)
+            written, words = flush_pages(pgfile, state, pagedata, headers, headermemo, pageswritten, pagevocabset, meaningfulheaders, htid, session, timer)
+            pageswritten += written
+            totalwordsinvol += words
+
+            timer.start('HeaderFinder')
+            # Pulling the next page begins in HeaderFinder.iter_headers.
+
+        timer.start('correct_stream')
+        session.correct_span(state, buffer, 0, len(buffer))
+        session.finish_volume(state, verbose)
+        timer.start('.norm.txt write')
+        correctedcount += flush_tokens(normfile, state)
+
+        if pagesyielded < 5 and pagesyielded > 0:
+            print(htid + " fails a routine check of alignment between pages and headers.")
+            # The batch path reports this for short documents, because
+            # find_headers returns no headers at all for them. Here each page
+            # just gets an empty header, which boosts nothing.
+
+        written, words = flush_pages(pgfile, state, pagedata, headers, headermemo, pageswritten, pagevocabset, meaningfulheaders, htid, session, timer)
+        pageswritten += written
+        totalwordsinvol += words
+
+    except:
+        normfile.close()
+        pgfile.close()
+        discard([normtemp, pgtemp])
+        raise
+
+    normfile.close()
+    pgfile.close()
+    timer.stop()
+
+    if longs.long_s_problem():
+        discard([normtemp, pgtemp])
+        return "long s"
+
+    timer.count(pagesyielded, tokencount)
+    # Only on success; otherwise the batch path will count the volume.
+
+    maps = [(headermap, hdrpath), (footermap, ftrpath)]
+    for amap, path in maps:
+        if amap is not None:
+            amap.write(path + '.tmp')
+
+    os.replace(normtemp, normpath)
+    os.replace(pgtemp, pgpath)
+    for amap, path in maps:
+        if amap is not None:
+            os.replace(path + '.tmp', path)
+
+    stats["tokencount"] = tokencount
+    stats["pre_matched"], stats["pre_english"] = tokenizer.percentages()
+
+    totaltokens = correctedcount - state.paratext
+    if totaltokens > 0:
+        stats["post_matched"] = state.foundcounter / totaltokens
+        stats["post_english"] = state.englishcounter / totaltokens
+    else:
+        stats["post_matched"] = 0
+        stats["post_english"] = 0
+
+    stats["totalwordsinvol"] = totalwordsinvol
+
+    return "success"
+
+def flush_tokens(file, state):
+    '''Writes the tokens corrected so far and forgets them.'''
+
+    corrected = state.corrected
+    write_tokens(file, corrected)
+    count = len(corrected)
+    del corrected[:]
+
+    return count
+
+def flush_pages(file, state, pagedata, headers, headermemo, firstindex, pagevocabset, meaningfulheaders, htid, session, timer = NULLTIMER):
+    '''Writes the page dictionaries that correction has finished, and
+    forgets them. Returns the number of pages written and the words on
+    them.'''
+
+    written = 0
+    words = 0
+
+    for page in state.pages:
+        index = firstindex + written
+
+        timer.start('header boost')
+        headerdict = session.correct_header(headers.popleft(), headermemo)
+        boost_headers(page, headerdict, meaningfulheaders, htid, index)
+        timer.start('.pg.tsv write')
+        words += write_page(file, index, page, pagedata.popleft(), pagevocabset)
+        written += 1
+
+    del state.pages[:]
+
+    return written, words
@@ -0,0 +1,206 @@
+# VolumeReader.py
+#
+# Reads the pages of a HathiTrust volume from its zipfile. There used to be a
+# read_zip in each copy of MultiNormalizeOCR and in NormalizeOCR, plus
+# page_index in StreamingNormalizer, all applying the same rules in slightly
+# different ways (they didn't even agree about unicode errors). This is the
+# one place those rules live now.
+#
+# A VolumeReader builds a sorted index of the numeric pages from the zipfile's
+# central directory when it's opened, and then reads pages only when they're
+# asked for, so the streaming normalizer never holds more than a page or two
+# of a volume in memory. read_zip is the old interface, for the batch path: it
+# reads every page into a list and reports problems with the same flags as
+# before ("missing file", "unicode error").
+#
+# Either can read a volume whose bytes are already in memory (see
+# Prefetcher), in which case the zipfile is never opened from disk.
+#
+# USAGE:
+# with VolumeReader(zippath) as volume:
+#     for linelist in volume:
+#         ...
+#
+# pagelist, successflag = read_zip(zippath)
+
+import io
+import mmap
+import struct
+from zipfile import ZipFile, ZIP_STORED
+
+LOCALHEADER = struct.Struct('<4s22xHH')
+# The fixed part of a local file header: signature, 22 bytes we don't need,
+# then the lengths of the filename and the extra field that follow it.
+
+def page_code(filename):
+    '''Returns the page code for a member of a HathiTrust zipfile (the
+    digits between the last underscore, if any, and ".txt"), or None if the
+    member isn't a numeric page. We skip the "notes" and "pagedata" files
+    Michigan includes, and complain about anything else that isn't a number.'''
+
+    pathparts = filename.split("/")
+    suffix = pathparts[1]
+    if "_" in suffix:
+        segments = suffix.split("_")
+        page = segments[-1][0:-4]
+    else:
+        page = suffix[0:-4]
+
+    if len(page) > 0 and page[0].isdigit():
+        numericpage = True
+    else:
+        if len(page) > 0 and page!="notes" and page!="pagedata":
+            print("Non-numeric pagecode: " + page)
+        numericpage = False
+
+    if not filename.endswith('/') and not filename.endswith("_Store") and not filename.startswith("_") and numericpage:
+        return page
+    else:
+        return None
+
+def page_index(zf):
+    '''Returns a sorted list of (pagecode, member) for the numeric pages in
+    an open zipfile, without reading any of them.'''
+
+    index = list()
+    for member in zf.infolist():
+        page = page_code(member.filename)
+        if page is not None:
+            index.append((page, member.filename, member))
+
+    index.sort(key = lambda x: (x[0], x[1]))
+    # The old read_zip sorted (page, lines) tuples, which breaks ties on page
+    # code by comparing the text of the pages. Two members with the same page
+    # code shouldn't happen; if it does we break the tie by filename instead.
+
+    return [(x[0], x[2]) for x in index]
+
+def decode_page(data):
+    '''Turns the bytes of a page into a list of lines, each ending with its
+    newline (except perhaps the last). This is what decoding each line of
+    readlines() used to produce: we only split at \\n, not at the other
+    characters str.splitlines treats as line breaks, and since \\n can't occur
+    inside a multibyte UTF-8 character, decoding the page in one piece fails
+    exactly when decoding it line by line would have.'''
+
+    text = str(data, encoding = "UTF-8")
+    if len(text) < 1:
+        return []
+
+    lines = [x + '\n' for x in text.split('\n')]
+    if text.endswith('\n'):
+        lines.pop()
+    else:
+        lines[-1] = lines[-1][0:-1]
+
+    return lines
+
+class VolumeReader(object):
+    '''The numeric pages of one zipped volume, in page order. Opening it
+    reads only the zipfile's directory. If data is given, it's the bytes
+    of the zipfile, and filepath is only used to name it.'''
+
+    def __init__(self, filepath, data = None):
+        self.filepath = filepath
+        self.data = data
+        if data is None:
+            self.zf = ZipFile(file = filepath, mode = 'r')
+        else:
+            self.zf = ZipFile(io.BytesIO(data), mode = 'r')
+        self.index = page_index(self.zf)
+        self.mapped = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+        self.zf.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def pagecodes(self):
+        return [x[0] for x in self.index]
+
+    def raw(self, position):
+        '''The bytes of the page at position. If the page is stored without
+        compression, this is a memoryview of the zipfile (mapped into memory,
+        or the bytes we were given), so nothing is copied (and the CRC isn't checked); release it before
+        closing the reader. Otherwise the page has to be inflated, and we
+        return bytes.'''
+
+        page, member = self.index[position]
+        if member.compress_type == ZIP_STORED and member.file_size > 0:
+            view = self.stored_view(member)
+            if view is not None:
+                return view
+
+        return self.zf.read(member)
+
+    def stored_view(self, member):
+        if self.data is not None:
+            source = memoryview(self.data)
+        else:
+            source = self.file_view()
+            if source is None:
+                return None
+
+        signature, namelength, extralength = LOCALHEADER.unpack_from(source, member.header_offset)
+        if signature != b'PK\x03\x04':
+            return None
+
+        start = member.header_offset + LOCALHEADER.size + namelength + extralength
+        return source[start: start + member.file_size]
+
+    def file_view(self):
+        if self.mapped is None:
+            try:
+                self.mapped = mmap.mmap(self.zf.fp.fileno(), 0, access = mmap.ACCESS_READ)
+            except (AttributeError, IOError, OSError, ValueError):
+                return None
+                # Not a real file (or an empty one); the caller will just
+                # read the member.
+
+        return memoryview(self.mapped)
+
+    def page(self, position):
+        '''The lines of the page at position, decoded. Raises UnicodeError
+        if the page isn't UTF-8.'''
+
+        page, member = self.index[position]
+        return decode_page(self.zf.read(member))
+
+    def __iter__(self):
+        for position in range(len(self.index)):
+            yield self.page(position)
+
+def read_zip(filepath, data = None):
+    '''Reads every page of a zipped volume (from data, if we already have
+    its bytes). Returns a list of pages (each a list of lines) and a
+    successflag, which is "success", "missing file" if the zipfile can't be
+    read or has no numeric pages, or "unicode error".'''
+
+    pagelist = list()
+    try:
+        with VolumeReader(filepath, data) as volume:
+            pagelist = list(volume)
+
+        if len(pagelist) > 0:
+            successflag = "success"
+        else:
+            successflag = "missing file"
+
+    except IOError as e:
+        successflag = "missing file"
+    except UnicodeError as e:
+        pagelist = list()
+        successflag = "unicode error"
+
+    return pagelist, successflag
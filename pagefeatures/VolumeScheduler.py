@@ -0,0 +1,187 @@
+# VolumeScheduler.py
+#
+# Decides the order in which a slice's volumes go to the pool. HTIDs come
+# out of a set, so they used to reach the workers in hash order, in chunks
+# of whatever size map_async chose. A 2,000-page volume near the end of a
+# chunk, or of the slice, could keep one worker busy long after the others
+# had run out of work.
+#
+# Here we schedule the largest volumes first (longest processing time
+# first), using the size of each zipfile as an estimate of how long it will
+# take. Big volumes go out one to a batch; smaller ones are grouped into
+# batches of similar size, so the batches at the end of the slice are small
+# and the workers finish close together. Sizes come from the filesystem the
+# first time, and are cached in a file next to the slice, since stat'ing
+# every zipfile on a shared filesystem isn't free.
+#
+# After a run, describe() reports how long the workers sat idle and how long
+# the slice's tail was (from the moment the first worker ran out of work to
+# the moment the last one finished). To say how much idle time the ordering
+# saved, it replays the same per-volume timings in the old order and chunking
+# and reports what that would have cost.
+#
+# USAGE:
+# sizes = volume_sizes(htids, volume_filename, sizepath)
+# batches = largest_first(file_tuples, sizes, workers, batchsize)
+# ... and for each batch, collect a timing from batch_timing ...
+# print(describe(timings, workers, old_batches(file_tuples, workers)))
+
+import os
+import time
+
+def read_sizes(path):
+    sizes = dict()
+    try:
+        with open(path, encoding = 'utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == 2 and fields[1].isdigit():
+                    sizes[fields[0]] = int(fields[1])
+    except IOError:
+        pass
+    return sizes
+
+def write_sizes(path, sizes):
+    temppath = path + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(temppath, mode = 'w', encoding = 'utf-8') as f:
+            for htid, size in sizes.items():
+                f.write(htid + '\t' + str(size) + '\n')
+        os.replace(temppath, path)
+    except (IOError, OSError) as e:
+        print("Could not write volume sizes to " + path + ": " + str(e))
+
+def volume_sizes(htids, filename_for, cachepath = None):
+    '''Returns a dictionary mapping each HTID to the size of its file in
+    bytes (0 if it's missing). Sizes cached at cachepath are used if they're
+    there; anything we have to stat is added to the cache.'''
+
+    cached = dict()
+    if cachepath is not None:
+        cached = read_sizes(cachepath)
+
+    sizes = dict()
+    found = 0
+    for htid in htids:
+        if htid in cached:
+            sizes[htid] = cached[htid]
+            continue
+
+        try:
+            sizes[htid] = os.path.getsize(filename_for(htid))
+            found += 1
+        except (IOError, OSError):
+            sizes[htid] = 0
+            # Not cached, since it may turn up later. The worker will
+            # report it as missing.
+
+    if cachepath is not None and found > 0:
+        for htid, size in sizes.items():
+            if size > 0:
+                cached[htid] = size
+        write_sizes(cachepath, cached)
+
+    return sizes
+
+def largest_first(file_tuples, sizes, workers, batchsize):
+    '''Sorts file_tuples from the largest volume to the smallest, and groups
+    them into batches for the pool. A batch holds at most batchsize volumes
+    and at most 1/(4 * workers) of the slice's bytes (the granularity
+    map_async aims for), so a volume bigger than that goes out on its own.'''
+
+    ordered = sorted(file_tuples, key = lambda x: sizes.get(x[0], 0), reverse = True)
+    total = sum([sizes.get(x[0], 0) for x in ordered])
+    cap = total / max(1, workers * 4)
+
+    batches = list()
+    batch = list()
+    batchbytes = 0
+    for file_tuple in ordered:
+        size = sizes.get(file_tuple[0], 0)
+        if len(batch) > 0 and (len(batch) >= batchsize or batchbytes + size > cap):
+            batches.append(batch)
+            batch = list()
+            batchbytes = 0
+        batch.append(file_tuple)
+        batchbytes += size
+
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches
+
+def old_batches(file_tuples, workers):
+    '''file_tuples chunked the way map_async chunked them before we had a
+    scheduler.'''
+
+    chunksize, extra = divmod(len(file_tuples), workers * 4)
+    if extra:
+        chunksize += 1
+    chunksize = max(1, chunksize)
+    return [file_tuples[i: i + chunksize] for i in range(0, len(file_tuples), chunksize)]
+
+def batch_timing(start, seconds):
+    '''What a worker reports about one batch: its pid, when the batch
+    started and ended (by the clock, so the parent can compare workers), and
+    a dictionary of the seconds spent on each volume.'''
+
+    return {'pid': os.getpid(), 'start': start, 'end': time.time(), 'seconds': seconds}
+
+def measured(timings, workers):
+    '''Returns the wall time, idle worker-seconds, and tail of a run, from
+    the batch_timings its workers reported.'''
+
+    if len(timings) < 1:
+        return 0.0, 0.0, 0.0
+
+    start = min([x['start'] for x in timings])
+    end = max([x['end'] for x in timings])
+    busy = sum([x['end'] - x['start'] for x in timings])
+
+    lastends = dict()
+    for timing in timings:
+        lastends[timing['pid']] = max(lastends.get(timing['pid'], 0), timing['end'])
+    firstidle = min(lastends.values())
+    if len(lastends) < workers:
+        firstidle = start
+        # Some worker never got a batch at all.
+
+    return end - start, workers * (end - start) - busy, end - firstidle
+
+def simulate(batches, seconds, workers):
+    '''Replays batches in order on workers, each batch going to the first
+    worker that's free, with each volume taking the seconds it took this
+    time. Returns the wall time, idle worker-seconds, and tail.'''
+
+    free = [0.0] * max(1, workers)
+    busy = 0.0
+    for batch in batches:
+        duration = sum([seconds.get(x[0], 0.0) for x in batch])
+        worker = free.index(min(free))
+        free[worker] += duration
+        busy += duration
+
+    end = max(free)
+    return end, len(free) * end - busy, end - min(free)
+
+def describe(timings, workers, oldbatches):
+    '''Lines summarizing how well the run was scheduled, for the end of a
+    run.'''
+
+    if len(timings) < 1:
+        return "Scheduling: no volumes."
+
+    seconds = dict()
+    for timing in timings:
+        seconds.update(timing['seconds'])
+
+    wall, idle, tail = measured(timings, workers)
+    ordered = sorted(timings, key = lambda x: x['start'])
+    batches = [[(htid, None) for htid in timing['seconds']] for timing in ordered]
+    simwall, simidle, simtail = simulate(batches, seconds, workers)
+    oldwall, oldidle, oldtail = simulate(oldbatches, seconds, workers)
+
+    lines = list()
+    lines.append("Scheduling: " + str(round(wall, 2)) + " s for the pool, " + str(round(idle, 2)) + " worker-seconds idle, a tail of " + str(round(tail, 2)) + " s.")
+    lines.append("Replaying these timings, largest first takes " + str(round(simwall, 2)) + " s with " + str(round(simidle, 2)) + " s idle and a tail of " + str(round(simtail, 2)) + " s; the old order would take " + str(round(oldwall, 2)) + " s with " + str(round(oldidle, 2)) + " s idle and a tail of " + str(round(oldtail, 2)) + " s, so we saved " + str(round(oldidle - simidle, 2)) + " worker-seconds of idle time.")
+    return '\n'.join(lines)
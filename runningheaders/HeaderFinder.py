@@ -9,73 +9,430 @@
 # page numbers that may be roman numerals).
 #
 # Once headers are identified, they can be treated in a range of different
-# ways. The first of these functions is not concerned to *separate* the header
-# from the original text but only to identify it so that it can be given extra
-# weight in page classification. The second function actually removes them.
+# ways. analyze_headers does the identifying, once, and returns a HeaderMap
+# that records where the headers are. find_headers is not concerned to
+# *separate* the header from the original text but only to identify it so
+# that it can be given extra weight in page classification. remove_headers
+# actually removes them. Since we find headers when we normalize a volume and
+# remove them when we aggregate it, a HeaderMap can be written to a .hdr.tsv
+# file and read back later, so the second step doesn't repeat the first.
+
+# The same pass can also look for footers, which matter more in 18c books:
+# lines near the bottom of a page that repeat in the same window, plus
+# signature marks and catchwords, which don't repeat but are easy to spot.
+# They go in a HeaderMap of their own.
+
+import re
+from difflib import SequenceMatcher
+from collections import Counter
+
+# SIMILARITY.
+
+# A line counts as a repeat of another if difflib rates them more than .8
+# similar. Building a SequenceMatcher for every pair of lines in the window
+# is the slowest part of finding headers, and most pairs aren't close. So a
+# LineMatcher tries cheap upper bounds on the ratio first, and only builds
+# a matcher for pairs that survive them. It reaches exactly the decisions
+# SequenceMatcher(None, lineA, lineB).ratio() > .8 would.
+
+MATCHERCACHESIZE = 5000
+# Lines (and pairs of lines) a LineMatcher remembers before it starts over.
+# Headers repeat within a window of three pages, so little is lost.
+
+class RatioMatcher(object):
+	'''The plain way: a new SequenceMatcher for every pair. Kept so that
+	the two can be compared.'''
+
+	def __init__(self, threshold = .8):
+		self.threshold = threshold
+
+	def similar(self, lineA, lineB):
+		return SequenceMatcher(None, lineA, lineB).ratio() > self.threshold
+
+class LineMatcher(object):
+	'''Decides whether SequenceMatcher(None, lineA, lineB).ratio() is more
+	than threshold, in tiers:
+
+	1. the lengths of the lines (SequenceMatcher.real_quick_ratio)
+	2. the characters they share, ignoring order (quick_ratio), counted
+	   once for each line
+	3. the ratio itself, using one SequenceMatcher per lineB, which keeps
+	   its index of lineB between comparisons.
+
+	Each tier is an upper bound on the next, so a pair rejected early
+	would have been rejected anyway. Decisions are remembered for each
+	pair, since running headers make the same comparisons over and over.'''
+
+	def __init__(self, threshold = .8):
+		self.threshold = threshold
+		self.charcounts = dict()
+		self.matchers = dict()
+		self.decisions = dict()
+
+	def char_counts(self, line):
+		counts = self.charcounts.get(line)
+		if counts is None:
+			counts = Counter(line)
+			self.charcounts[line] = counts
+		return counts
+
+	def similar(self, lineA, lineB):
+		key = (lineA, lineB)
+		decision = self.decisions.get(key)
+		if decision is not None:
+			return decision
+
+		if len(self.decisions) > MATCHERCACHESIZE:
+			self.charcounts.clear()
+			self.matchers.clear()
+			self.decisions.clear()
+
+		decision = self.compare(lineA, lineB)
+		self.decisions[key] = decision
+		return decision
+
+	def compare(self, lineA, lineB):
+		threshold = self.threshold
+		total = len(lineA) + len(lineB)
+		# The ratio is 2.0 * matches / total; we compute the bounds the same
+		# way so that rounding can't separate them from it.
+
+		if 2.0 * min(len(lineA), len(lineB)) / total <= threshold:
+			return False
+
+		countsA = self.char_counts(lineA)
+		countsB = self.char_counts(lineB)
+		shared = 0
+		for char, count in countsA.items():
+			other = countsB.get(char)
+			if other is not None:
+				shared += min(count, other)
+		if 2.0 * shared / total <= threshold:
+			return False
+
+		matcher = self.matchers.get(lineB)
+		if matcher is None:
+			matcher = SequenceMatcher(None, '', lineB)
+			self.matchers[lineB] = matcher
+		matcher.set_seq1(lineA)
+		return matcher.ratio() > threshold
+
+def comparable_line(line, romannumerals):
+	'''Transforms a line for comparison as described in analyze_headers, or
+	returns None if it isn't substantial enough to compare.'''
+
+	line = line.strip()
+	if line.startswith('<') and line.endswith('>'):
+		return None
+
+	line = "".join([x for x in line if not x.isdigit()])
+	# We strip all numeric chars before the length check.
+
+	if line in romannumerals:
+		return None
+
+	# That may not get all roman numerals, because of OCR junk, so let's
+	# attempt to get them by shrinking them below the length limit. This
+	# will also have the collateral benefit of reducing the edit distance
+	# for headers that contain roman numerals.
+	line = line.replace("iii", "")
+	line = line.replace("ii", "")
+	line = line.replace("xx", "")
+
+	if len(line) < 5:
+		return None
+
+	return line
+
+def candidate_lines(page, romannumerals):
+	'''Returns the first two substantial lines on a page, transformed for
+	comparison as described in analyze_headers, as (line, lineindex) pairs
+	so we know where each line came from.'''
+
+	thesetwo = list()
+
+	for idx, line in enumerate(page):
+		if idx > 4:
+			break
+
+		line = comparable_line(line, romannumerals)
+		if line is None:
+			continue
+
+		thesetwo.append((line, idx))
+
+		if len(thesetwo) >= 2:
+			break
+
+	return thesetwo
+
+def footer_candidates(page, romannumerals, headerlines):
+	'''The last substantial line among the last five on a page, as a list
+	holding one (line, lineindex) pair, or none. Signature marks are too
+	short to count, so this is the line above them, where running footers
+	are. One line rather than two, because footer candidates are mostly
+	body text, which doesn't repeat and so costs us a full comparison each
+	time. We stop at the header candidates (headerlines), so that on a short
+	page a line is never both, and footers always come after headers.'''
+
+	top = max(len(page) - 5, bottom_limit(headerlines))
+
+	for idx in range(len(page) - 1, top - 1, -1):
+		line = comparable_line(page[idx], romannumerals)
+		if line is not None:
+			return [(line, idx)]
+
+	return []
+
+signaturemark = re.compile(r'^([A-Z])([A-Za-z]?)(\s?[0-9]{1,2}|\s[ivxlIVXL]{1,4})?$')
+# A printer's signature mark, like "B2", "Aa 3" or "C iv": a letter, or the
+# same letter twice, usually followed by a number.
+
+edgepunctuation = '.,;:!?"\'()[]-'
+
+def first_word(line):
+	words = line.split()
+	if len(words) < 1:
+		return ''
+	return words[0].strip(edgepunctuation).lower()
+
+def is_signature(text, setapart):
+	'''Whether text is a signature mark. Without a number, a letter on its
+	own only counts if it's set apart from the text above it by a blank
+	line; otherwise it's as likely to be "I" or "A" ending a sentence.'''
+
+	match = signaturemark.match(text)
+	if match is None:
+		return False
+
+	letter, second, number = match.groups()
+	if len(second) > 0 and second.lower() != letter.lower():
+		return False
+		# "It" or "On", not "Aa".
+
+	return number is not None or setapart
+
+def catchword_in(words, setapart):
+	'''The catchword on a line split into words, or None. A catchword stands
+	alone on its line, or beside a signature mark.'''
+
+	if len(words) == 1:
+		candidate = words[0]
+	elif is_signature(' '.join(words[0:-1]), setapart):
+		candidate = words[-1]
+	elif is_signature(' '.join(words[1:]), setapart):
+		candidate = words[0]
+	else:
+		return None
+
+	candidate = candidate.strip(edgepunctuation).lower()
+	if len(candidate) < 2 or not candidate.replace("'", "").isalpha():
+		return None
+	return candidate
+
+def first_text_line(page):
+	for line in page:
+		line = line.strip()
+		if len(line) > 0 and not line.startswith('<'):
+			return line
+	return ''
+
+def marginal_line(page, nextpage, top):
+	'''Signature marks and catchwords (the first word of the next page,
+	printed at the foot of this one) don't repeat from page to page, so the
+	window can't find them. Returns (line, lineindex) if the last line of
+	page is one of them, or None. Nextpage is None at the end of a volume.
+	Lines before top are left alone.
+
+	These lines get removed from the text, so we only take ones we can be
+	sure of: a signature mark with a number, or set apart by a blank line,
+	and a catchword alone on its line (or beside a signature mark) that
+	is the first word of the first line on the next page.'''
+
+	for idx in range(len(page) - 1, top - 1, -1):
+		line = page[idx].strip()
+		if len(line) > 0:
+			break
+	else:
+		return None
+
+	if line.startswith('<') and line.endswith('>'):
+		return None
+
+	words = line.split()
+	if len(words) > 4:
+		return None
+
+	setapart = idx > top and len(page[idx - 1].strip()) < 1
+
+	if is_signature(line, setapart):
+		return (line, idx)
+
+	if nextpage is not None:
+		catchword = catchword_in(words, setapart)
+		if catchword is not None and first_word(first_text_line(nextpage)) == catchword:
+			return (line, idx)
+
+	return None
+
+def add_marginal(footers, bottomlines, marginal):
+	'''Adds a marginal line to a page's footers, returning the page's
+	candidate lines with the marginal line among them.'''
+
+	line, lineindex = marginal
+	for candidate, candidateindex in bottomlines:
+		if candidateindex == lineindex:
+			footers.add(candidate)
+			return bottomlines
+
+	footers.add(line)
+	return bottomlines + [marginal]
+
+def bottom_limit(headerlines):
+	'''The first line index below a page's header candidates.'''
+	top = 0
+	for line, lineindex in headerlines:
+		top = max(top, lineindex + 1)
+	return top
+
+def compare_lines(linesA, linesB, foundA, foundB, matcher):
+	'''Adds to foundA and foundB any lines in linesA and linesB (lists of
+	(line, lineindex) pairs) that are similar to a line in the other.'''
+
+	for lineA, indexA in linesA:
+		for lineB, indexB in linesB:
+			if matcher.similar(lineA, lineB):
+				foundA.add(lineA)
+				foundB.add(lineB)
+
+# HEADER MAPS.
+
+class HeaderMap(object):
+	'''The running headers (or footers) found in a volume. For each page, in
+	order, a list of (lineindex, text) pairs: lineindex is the position of a
+	header line on the page as it was passed in, and text is the line as it
+	was compared (digits stripped, and so on). Most pages have none.
+
+	A HeaderMap can be written to a .hdr.tsv file next to the .norm.txt and
+	read back with read_headermap, so that headers found when a volume is
+	normalized can be removed when it's aggregated, without finding them
+	all over again.'''
+
+	def __init__(self):
+		self.pages = list()
+
+	def __len__(self):
+		return len(self.pages)
+
+	def add_page(self, headers, candidates):
+		'''Adds the next page, given the set of header lines found on it and
+		its candidate lines, as (line, lineindex) pairs.'''
+
+		entries = list()
+		for header in headers:
+			for line, lineindex in candidates:
+				if line == header:
+					entries.append((lineindex, header))
+		self.pages.append(entries)
+
+	def page_tokens(self, index):
+		'''The tokens in the headers of one page. A line repeated on the
+		same page only counts once.'''
 
-# In principle, this could all be done for footers as well. I haven't cared, because
-# it wasn't a big problem in the 19c volumes I've worked with so far. That
-# could change!
+		thisstream = []
+		seen = set()
+		for lineindex, header in self.pages[index]:
+			if header not in seen:
+				seen.add(header)
+				thisstream.extend(header.split())
+		return thisstream
+
+	def tokens(self, first = 0):
+		'''A list of header tokens for each page, starting at first.'''
+		return [self.page_tokens(x) for x in range(first, len(self.pages))]
+
+	def remove(self, pagelist):
+		'''Removes the header lines from pagelist, which has to be the list
+		of pages the map was made from. Returns the edited pagelist and a
+		list of the lines removed. To remove both footers and headers,
+		remove the footers first; they always come after the headers on a
+		page, so that leaves the headers' line indexes alone.'''
+
+		assert len(pagelist) == len(self.pages)
+		removed = list()
+		for page, entries in zip(pagelist, self.pages):
+			lineindexes = sorted(set([x[0] for x in entries]), reverse = True)
+			# Popping from the bottom of the page up, so that each pop
+			# leaves the indexes of the lines above it alone.
+			for lineindex in lineindexes:
+				removed.append(page.pop(lineindex))
+
+		return pagelist, removed
+
+	def write(self, path):
+		'''Writes the map as tab-separated rows of page index, line index and
+		header text, after a row giving the number of pages.'''
+
+		with open(path, mode = 'w', encoding = 'utf-8') as file:
+			file.write('#pages\t' + str(len(self.pages)) + '\n')
+			for index, entries in enumerate(self.pages):
+				for lineindex, header in entries:
+					file.write(str(index) + '\t' + str(lineindex) + '\t' + header + '\n')
+
+def read_headermap(path):
+	'''Reads a HeaderMap written by HeaderMap.write.'''
+
+	headermap = HeaderMap()
+	pages = headermap.pages
+
+	with open(path, encoding = 'utf-8') as file:
+		for line in file:
+			fields = line.rstrip('\n').split('\t', 2)
+			if fields[0] == '#pages':
+				while len(pages) < int(fields[1]):
+					pages.append(list())
+				continue
 
-from difflib import SequenceMatcher
+			index = int(fields[0])
+			while len(pages) <= index:
+				pages.append(list())
+			pages[index].append((int(fields[1]), fields[2]))
 
-def find_headers(pagelist, romannumerals):
-	'''Identifies repeated page headers and returns them as a list keyed to
-	original page locations.'''
+	return headermap
 
-	# For very short documents, this is not a meaningful task.
+def analyze_headers(pagelist, romannumerals, matcher = None, headermap = None, footermap = None):
+	'''Identifies repeated page headers and adds the pages of pagelist to
+	headermap (a new HeaderMap, if you don't pass one), which it returns.
+	Matcher decides which lines are similar; by default, a new LineMatcher.
+	Documents shorter than five pages get no headers.
 
-	if len(pagelist) < 5:
-		return []
+	If you pass a footermap too, the same pass finds footers: lines near
+	the bottom of a page that repeat within the same window, plus signature
+	marks and catchwords (see marginal_line). Their lines are added to
+	footermap.'''
+
+	if matcher is None:
+		matcher = LineMatcher()
+	if headermap is None:
+		headermap = HeaderMap()
 
 	firsttwos = list()
 	# We construct a list of the first two substantial lines on
-	# each page. We ignore short lines and lines that are just numbers,
-	# and don't go deeper than five lines in any event.
+	# each page, with their positions. We ignore short lines and lines that
+	# are just numbers, and don't go deeper than five lines in any event.
 
-	# We transform lines in this process -- e.g, by removing digits.
-	# If we were attempting to *remove* lines from the original text,
-	# we would probably need to construct objects that package the transformed
-	# line with information about its original location, so we could also
-	# remove the original.
+	# We transform lines in this process -- e.g, by removing digits. The
+	# positions let us (or whoever reads the HeaderMap) remove the original.
 
 	for page in pagelist:
-		thesetwo = list()
-		linesaccepted = 0
-
-		for idx, line in enumerate(page):
-			if idx > 4:
-				break
-
-			line = line.strip()
-			if line.startswith('<') and line.endswith('>'):
-				continue
-
-			line = "".join([x for x in line if not x.isdigit()])
-			# We strip all numeric chars before the length check.
-
-			if line in romannumerals:
-				continue
-
-			# That may not get all roman numerals, because of OCR junk, so let's
-			# attempt to get them by shrinking them below the length limit. This
-			# will also have the collateral benefit of reducing the edit distance
-			# for headers that contain roman numerals.
-			line = line.replace("iii", "")
-			line = line.replace("ii", "")
-			line = line.replace("xx", "")
-
-			if len(line) < 5:
-				continue
-
-			linesaccepted += 1
-			thesetwo.append(line)
-
-			if linesaccepted >= 2:
-				break
-
+		thesetwo = candidate_lines(page, romannumerals)
 		firsttwos.append(thesetwo)
 
+	lasttwos = list()
+	if footermap is not None:
+		for page, thesetwo in zip(pagelist, firsttwos):
+			lasttwos.append(footer_candidates(page, romannumerals, thesetwo))
+
 	# Now our task is to iterate through the firsttwos, identifying lines that
 	# repeat within a window, which we define as "this page and the two previous
 	# pages."
@@ -85,149 +442,79 @@ def find_headers(pagelist, romannumerals):
 	# pages, we're always going to be checking whether they were already added.
 
 	repeated = list()
+	footers = list()
 	for i in range(len(firsttwos)):
-		newset = set()
-		repeated.append(newset)
-
-	for index in range(2, len(firsttwos)):
-		# We can be sure the 2 index is legal because we have previously filtered
-		# short documents.
-
-		indexedlines = firsttwos[index]
-
-		for j in range (index - 2, index):
+		repeated.append(set())
+		footers.append(set())
 
-			previouslines = firsttwos[j]
+	# For very short documents, this is not a meaningful task.
 
-			for lineA in indexedlines:
-				for lineB in previouslines:
-					s = SequenceMatcher(None, lineA, lineB)
-					similarity = s.ratio()
-					if similarity > .8:
-						repeated[index].add(lineA)
-						repeated[j].add(lineB)
+	if len(pagelist) >= 5:
+		for index in range(2, len(firsttwos)):
+			for j in range (index - 2, index):
+				compare_lines(firsttwos[index], firsttwos[j], repeated[index], repeated[j], matcher)
+				if footermap is not None:
+					compare_lines(lasttwos[index], lasttwos[j], footers[index], footers[j], matcher)
 
 	# Now we have a list of sets that contain digit-stripped strings
 	# representing headers, in original page order, with empty sets where no headers
-	# were found. We want to convert this to a list of lists of individual tokens.
+	# were found.
+
+	for thispageheaders, thesetwo in zip(repeated, firsttwos):
+		headermap.add_page(thispageheaders, thesetwo)
+
+	if footermap is not None:
+		for index, page in enumerate(pagelist):
+			bottomlines = lasttwos[index]
+			if len(pagelist) >= 5:
+				if index + 1 < len(pagelist):
+					nextpage = pagelist[index + 1]
+				else:
+					nextpage = None
+				marginal = marginal_line(page, nextpage, bottom_limit(firsttwos[index]))
+				if marginal is not None:
+					bottomlines = add_marginal(footers[index], bottomlines, marginal)
+			footermap.add_page(footers[index], bottomlines)
+
+	return headermap
+
+def find_headers(pagelist, romannumerals, matcher = None, headermap = None, footermap = None):
+	'''Identifies repeated page headers and returns them as a list keyed to
+	original page locations: for each page, a list of the tokens in its
+	headers. If you pass a HeaderMap, the headers are added to it too, and
+	if you pass a footermap, footers are found and added to it.'''
 
-	listoftokenstreams = list()
+	if headermap is None:
+		headermap = HeaderMap()
+	first = len(headermap)
 
-	for thispageheaders in repeated:
-		thisstream = []
-		for header in thispageheaders:
-			thisstream.extend(header.split())
-		listoftokenstreams.append(thisstream)
+	analyze_headers(pagelist, romannumerals, matcher, headermap, footermap)
 
-	return listoftokenstreams
+	if len(pagelist) < 5:
+		return []
 
-def remove_headers(pagelist, romannumerals):
+	return headermap.tokens(first)
+
+def remove_headers(pagelist, romannumerals, matcher = None, footers = False):
 	'''Identifies repeated page headers and removes them from
-	the pages; then returns the edited pagelist.'''
+	the pages; then returns the edited pagelist, and a list of the
+	lines removed. If footers is True, footers (see analyze_headers) are
+	found in the same pass and removed too. If you already have a HeaderMap
+	for the volume, use its remove method instead.'''
 
 	# For very short documents, this is not a meaningful task.
 
 	if len(pagelist) < 5:
 		return pagelist
 
-	firsttwos = list()
-	# We construct a list of the first two substantial lines on
-	# each page. We ignore short lines and lines that are just numbers,
-	# and don't go deeper than five lines in any event.
-
-	# We transform lines in this process -- e.g, by removing digits.
-	# We also package them as tuples in order to preserve information
-	# that will allow us to delete the lines identified as repeats.
-
-	for page in pagelist:
-		thesetwo = list()
-		linesaccepted = 0
-
-		for idx, line in enumerate(page):
-			if idx > 4:
-				break
-
-			line = line.strip()
-			if line.startswith('<') and line.endswith('>'):
-				continue
-
-			line = "".join([x for x in line if not x.isdigit()])
-			# We strip all numeric chars before the length check.
-
-			if line in romannumerals:
-				continue
-
-			# That may not get all roman numerals, because of OCR junk, so let's
-			# attempt to get them by shrinking them below the length limit. This
-			# will also have the collateral benefit of reducing the edit distance
-			# for headers that contain roman numerals.
-			line = line.replace("iii", "")
-			line = line.replace("ii", "")
-			line = line.replace("xx", "")
-
-			if len(line) < 5:
-				continue
-
-			linesaccepted += 1
-			thesetwo.append((line, idx))
-
-			if linesaccepted >= 2:
-				break
-
-		firsttwos.append(thesetwo)
-
-	# Now our task is to iterate through the firsttwos, identifying lines that
-	# repeat within a window, which we define as "this page and the two previous
-	# pages."
-
-	# We're going to do this with a list of sets. That way we can add things
-	# without risk of duplication. Otherwise, when we add headers to previous
-	# pages, we're always going to be checking whether they were already added.
-
-	repeated = list()
-	for i in range(len(firsttwos)):
-		newset = set()
-		repeated.append(newset)
-
-	for index in range(2, len(firsttwos)):
-		# We can be sure the 2 index is legal because we have previously filtered
-		# short documents.
-
-		indexedlines = firsttwos[index]
-
-		for j in range (index - 2, index):
-
-			previouslines = firsttwos[j]
-
-			for lineA in indexedlines:
-				for lineB in previouslines:
-					s = SequenceMatcher(None, lineA[0], lineB[0])
-					# The zero indexes above are just selecting the string part
-					# of a string, index tuple.
-
-					similarity = s.ratio()
-					if similarity > .8:
-						repeated[index].add(lineA)
-						repeated[j].add(lineB)
-
-	# Now we have a list of sets that contain tuples
-	# representing headers, in original page order, with empty sets where no headers
-	# were found. We can now use the line indexes in the tuples to pop out the
-	# relevant lines.
-
-	assert len(pagelist) == len(repeated)
-	removed = list()
-	for page, headerset in zip(pagelist, repeated):
-		for header in headerset:
-			lineindex = header[1]
-			removed.append(page.pop(lineindex))
-
-	return pagelist, removed
-
-
-
-
-
-
-
-
+	if footers:
+		footermap = HeaderMap()
+		headermap = analyze_headers(pagelist, romannumerals, matcher, footermap = footermap)
+		pagelist, removedfooters = footermap.remove(pagelist)
+		# Footers first: they're always below the headers, so removing them
+		# doesn't move any header lines.
+		pagelist, removed = headermap.remove(pagelist)
+		return pagelist, removed + removedfooters
+
+	headermap = analyze_headers(pagelist, romannumerals, matcher)
+	return headermap.remove(pagelist)
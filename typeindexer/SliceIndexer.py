@@ -4,63 +4,93 @@ import TokenGen
 import Dictionary
 import TypeIndex
 import FileCabinet
+import WorkQueue
+
+debug = False
 
 slicename = sys.argv[1]
-## We assume the slice name has been passed in as an argument.
+## We assume the slice name has been passed in as an argument. Or, if the
+## arguments are "queue" and a directory, we pull chunks of HTIDs from the
+## WorkQueue in that directory until it's empty, and index each chunk as a
+## slice named after it.
 
 datapath = "/projects/ichass/usesofscale/nonserials/"
 metadatapath = "/projects/ichass/usesofscale/hathimeta/slices/" + slicename + ".txt"
 dictionarypath = "/projects/ichass/usesofscale/dictionaries/"
 outputpath = "/projects/ichass/usesofscale/ocr/slices/"
-       
-HTIDfile = metadatapath
-with open(HTIDfile, encoding="utf-8") as file:
-    HTIDlist = file.readlines()
 
 Lexicon = Dictionary.BuildLexicon(dictionarypath, debug)
 
-writename = slicename + "IND.txt"
-
 delim = '\t'
 
-BigIndex = dict()
+def index_slice(slicename, HTIDlist, lease = None):
+    '''Indexes the volumes in HTIDlist. If they're a chunk from a WorkQueue,
+    lease is our Lease on it; if another job reclaims the chunk, we stop
+    without writing an index and return False.'''
+
+    writename = slicename + "IND.txt"
+
+    BigIndex = dict()
+
+    SortedIndex = list()
+
+    for IDtoprocess in HTIDlist:
+        if lease is not None and lease.lost:
+            print("Lost the lease on " + lease.name + "; leaving it to the job that reclaimed it.")
+            return False
+
+        IDtoprocess = IDtoprocess.strip()
+        filepath, postfix = FileCabinet.pairtreepath(IDtoprocess, datapath)
+        filename = filepath + postfix + '/' + postfix + ".txt"
+
+        try:
+            with open(filename, encoding='utf-8') as file:
+                lines = file.readlines()
+                successflag = True
+        except IOError as e:
+            successflag = False
 
-SortedIndex = list()
+        if not successflag:
+            print(IDtoprocess + " is missing.")
+            continue
 
-for IDtoprocess in HTIDlist:
-    IDtoprocess = IDtoprocess.strip()
-    filepath, postfix = FileCabinet.pairtreepath(IDtoprocess, datapath)
-    filename = filepath + postfix + '/' + postfix + ".txt"
+        tokens = TokenGen.keep_hyphens(lines,Lexicon,verbose=debug)
 
-    try:
-        with open(filename, encoding='utf-8') as file:
-            lines = file.readlines()
-            successflag = True
-    except IOError as e:
-        successflag = False
+        if len(tokens) < 10:
+            print(IDtoprocess, "has only tokencount", len(tokens))
 
-    if not successflag:
-        print(IDtoprocess + " is missing.")
-        continue
-        
-    tokens = TokenGen.keep_hyphens(lines,Lexicon,verbose=debug)
+        volacc = TypeIndex.GetAcc(tokens,Lexicon,debug)
 
-    if len(tokens) < 10:
-        print(IDtoprocess, "has only tokencount", len(tokens))
+        types = TypeIndex.GetTypes(tokens,verbose=debug)
 
-    volacc = TypeIndex.GetAcc(tokens,Lexicon,debug)
+        TypeIndex.UpdateIndex(BigIndex, types, volacc, debug)
 
-    types = TypeIndex.GetTypes(tokens,verbose=debug)
+    ### Deletes BigIndex after copying to list in order to save memory
 
-    TypeIndex.UpdateIndex(BigIndex, types, volacc, debug)
+    SortedIndex = TypeIndex.SortIndex(BigIndex, debug)
 
-### Deletes BigIndex after copying to list in order to save memory
+    del BigIndex
 
-SortedIndex = TypeIndex.SortIndex(BigIndex, debug)
+    TypeIndex.WriteIndex(SortedIndex, outputpath + writename, delim, debug)
 
-del BigIndex
+    print("Volumes processed this session: ", len(HTIDlist))
+    return True
 
-TypeIndex.WriteIndex(SortedIndex, outputpath + writename, delim, debug)
+if slicename == "queue":
+    queuedir = sys.argv[2]
+    queue = WorkQueue.WorkQueue(queuedir)
+    queuename = os.path.basename(os.path.normpath(queuedir))
+    lease = queue.claim()
+    while lease is not None:
+        if index_slice(queuename + lease.name, lease.htids, lease):
+            lease.finish()
+        else:
+            lease.stop()
+        lease = queue.claim()
 
-print("Volumes processed this session: ", len(HTIDlist))
+else:
+    HTIDfile = metadatapath
+    with open(HTIDfile, encoding="utf-8") as file:
+        HTIDlist = file.readlines()
 
+    index_slice(slicename, HTIDlist)
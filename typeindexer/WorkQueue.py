@@ -0,0 +1,298 @@
+# WorkQueue.py
+#
+# A queue of HTIDs on a shared filesystem that any number of jobs can pull
+# work from, instead of each job being handed a fixed slice. Slices of uneven
+# difficulty meant some jobs finished in two hours while others ran into the
+# walltime; with a queue, a node that finishes early just takes more work.
+#
+# Everything happens through a directory, so there's no server to run:
+#
+# queuedir/todo/    -- chunks waiting to be claimed. Each chunk is a file
+#                      with one HTID per line, named like chunk00042.
+# queuedir/leased/  -- chunks someone is working on, renamed to
+#                      chunk00042@host.pid so we can see who has them.
+# queuedir/done/    -- finished chunks.
+#
+# A job claims a chunk by renaming it from todo/ to leased/. A rename is
+# atomic, so if two jobs try to claim the same chunk, one of them gets it and
+# the other gets an error and tries another. While it works, the job keeps
+# touching its lease file (a Lease does this on a background thread). If a
+# job crashes or is killed, its lease stops being touched, and once it's
+# older than leasetime any job (or "python3 WorkQueue.py reclaim") renames it
+# back into todo/ for someone else. Finishing a chunk renames it into done/.
+#
+# We compare lease times with the filesystem's clock rather than ours, by
+# touching a file in the queue and reading back its modification time, since
+# the nodes' clocks may not agree with the file server's.
+#
+# Reclaiming is check-then-act: the owner could renew a lease just after we
+# found it stale. So a reclaimer first renames the lease to a private staging
+# name in leased/ (.chunk00042@host.pid.reclaim.otherhost.pid), where neither
+# its owner nor another reclaimer can touch it, looks at its modification
+# time again there, and puts it back if it was renewed after all. An owner
+# whose renewal or finish falls in that moment tries again a second later.
+#
+# A job that's stalled for longer than leasetime can still lose its chunk while
+# it's working on it. Lease.renew() returns False once that has happened, and
+# drivers should check it between pieces of work and stop, leaving the chunk
+# to whoever has it now. Keep leasetime well above renewevery. Drivers that
+# journal their results (like MultiNormalizeOCR) name their journal after the
+# chunk, so whoever takes over a reclaimed chunk skips the volumes that were
+# already finished.
+#
+# USAGE, to set up a queue:
+# python3 WorkQueue.py create queuedir htids.txt [chunksize]
+# python3 WorkQueue.py status queuedir
+# python3 WorkQueue.py reclaim queuedir [leasetime]
+#
+# and in a job:
+# queue = WorkQueue(queuedir)
+# lease = queue.claim()
+# while lease is not None:
+#     ... process lease.htids, stopping if lease.lost ...
+#     lease.finish()
+#     lease = queue.claim()
+
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+LEASETIME = 3600
+RENEWEVERY = 300
+# Seconds. A lease that hasn't been renewed for LEASETIME is presumed dead.
+RETRYAFTER = 1
+# Seconds to wait before trying a lease file again, in case a reclaimer had
+# it under its staging name for a moment.
+
+def owner_name():
+    return socket.gethostname().split('.')[0] + '.' + str(os.getpid())
+
+def chunk_name(leasename):
+    return leasename.split('@', 1)[0]
+
+def retry(action, *args):
+    '''Calls action(*args), trying once more after RETRYAFTER seconds if it
+    fails. Returns True if either call succeeded.'''
+
+    for attempt in range(2):
+        try:
+            action(*args)
+            return True
+        except (IOError, OSError):
+            if attempt < 1:
+                time.sleep(RETRYAFTER)
+    return False
+
+class Lease(object):
+    '''A chunk this process has claimed. Renews itself on a background thread
+    until it's finished or released.'''
+
+    def __init__(self, queue, name, path, htids, renewevery = RENEWEVERY):
+        self.queue = queue
+        self.name = name
+        self.path = path
+        self.htids = htids
+        self.renewevery = renewevery
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self.keep_alive, daemon = True)
+        self.thread.start()
+
+    def keep_alive(self):
+        while not self.stopped.wait(self.renewevery):
+            self.renew()
+
+    def renew(self):
+        '''Touches the lease file. Returns False if the lease has been
+        reclaimed by someone else.'''
+
+        if self.lost:
+            return False
+        if not retry(os.utime, self.path, None):
+            self.lost = True
+        return not self.lost
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def finish(self):
+        '''Moves the chunk to done/. Returns False if we had lost the lease,
+        in which case someone else may be doing it again.'''
+
+        self.stop()
+        if retry(os.replace, self.path, os.path.join(self.queue.donedir, self.name)):
+            return True
+        self.lost = True
+        print("Lost the lease on " + self.name + " before finishing it.")
+        return False
+
+    def release(self):
+        '''Puts the chunk back in todo/ without finishing it.'''
+
+        self.stop()
+        if not retry(os.replace, self.path, os.path.join(self.queue.tododir, self.name)):
+            self.lost = True
+
+class WorkQueue(object):
+
+    def __init__(self, queuedir, leasetime = LEASETIME, renewevery = RENEWEVERY):
+        self.queuedir = queuedir
+        self.tododir = os.path.join(queuedir, 'todo')
+        self.leaseddir = os.path.join(queuedir, 'leased')
+        self.donedir = os.path.join(queuedir, 'done')
+        self.leasetime = leasetime
+        self.renewevery = renewevery
+        self.owner = owner_name()
+
+    def make_dirs(self):
+        for directory in [self.tododir, self.leaseddir, self.donedir]:
+            os.makedirs(directory, exist_ok = True)
+
+    def fs_now(self):
+        '''The current time by the filesystem's clock.'''
+
+        clockpath = os.path.join(self.queuedir, '.clock.' + self.owner)
+        with open(clockpath, mode = 'w') as f:
+            pass
+        now = os.stat(clockpath).st_mtime
+        os.remove(clockpath)
+        return now
+
+    def reclaim(self):
+        '''Moves leases that haven't been renewed for leasetime back to todo/.
+        Returns the names of the chunks reclaimed.'''
+
+        now = self.fs_now()
+        reclaimed = list()
+        for leasename in os.listdir(self.leaseddir):
+            path = os.path.join(self.leaseddir, leasename)
+            if leasename.startswith('.'):
+                self.recover_staged(path, now)
+                continue
+
+            stagingpath = os.path.join(self.leaseddir, '.' + leasename + '.reclaim.' + self.owner)
+            try:
+                if now - os.stat(path).st_mtime < self.leasetime:
+                    continue
+                os.rename(path, stagingpath)
+            except (IOError, OSError):
+                continue
+                # Renewed, finished, or reclaimed by someone else while we
+                # were looking.
+
+            try:
+                if now - os.stat(stagingpath).st_mtime < self.leasetime:
+                    os.rename(stagingpath, path)
+                    continue
+                    # The owner renewed it between our two looks.
+                os.rename(stagingpath, os.path.join(self.tododir, chunk_name(leasename)))
+                reclaimed.append(chunk_name(leasename))
+            except (IOError, OSError):
+                continue
+
+        return reclaimed
+
+    def recover_staged(self, path, now):
+        '''Puts a lease back in todo/ if it was left under a staging name by
+        a reclaimer that died between its two renames. Renaming a file sets
+        its ctime, so that says how long it has been staged.'''
+
+        name = os.path.basename(path)
+        if '.reclaim.' not in name:
+            return
+        leasename = name[1:].split('.reclaim.', 1)[0]
+        try:
+            if now - os.stat(path).st_ctime < self.leasetime:
+                return
+            os.rename(path, os.path.join(self.tododir, chunk_name(leasename)))
+        except (IOError, OSError):
+            pass
+
+    def claim(self):
+        '''Claims a chunk and returns a Lease on it, or None if there's
+        nothing left to do (apart from chunks other jobs are still working
+        on).'''
+
+        reclaimed = self.reclaim()
+        for name in reclaimed:
+            print("Reclaimed " + name + ", whose lease had expired.")
+
+        while True:
+            names = [x for x in os.listdir(self.tododir) if not x.startswith('.')]
+            if len(names) < 1:
+                return None
+
+            random.shuffle(names)
+            # So that jobs starting at the same moment don't all race for
+            # the same chunk.
+
+            for name in names:
+                todopath = os.path.join(self.tododir, name)
+                path = os.path.join(self.leaseddir, name + '@' + self.owner)
+                try:
+                    os.utime(todopath, None)
+                    os.rename(todopath, path)
+                except (IOError, OSError):
+                    continue
+                    # Someone else got it first.
+                # The lease starts now. We touch the chunk before renaming it,
+                # since renaming doesn't change its modification time, and a
+                # stale time in leased/ would let it be reclaimed at once.
+
+                with open(path, encoding = 'utf-8') as f:
+                    htids = [x.strip() for x in f if len(x.strip()) > 0]
+                return Lease(self, name, path, htids, self.renewevery)
+
+    def status(self):
+        '''Returns the number of chunks to do, leased and done.'''
+
+        counts = list()
+        for directory in [self.tododir, self.leaseddir, self.donedir]:
+            counts.append(len([x for x in os.listdir(directory) if not x.startswith('.')]))
+        return tuple(counts)
+
+def create_queue(queuedir, htids, chunksize = 500):
+    '''Writes htids into todo/ in chunks of chunksize. Each chunk is written
+    under a temporary name and renamed, so no job can claim half a chunk.'''
+
+    queue = WorkQueue(queuedir)
+    queue.make_dirs()
+
+    counter = 0
+    for start in range(0, len(htids), chunksize):
+        name = 'chunk' + str(counter).zfill(5)
+        temppath = os.path.join(queue.tododir, '.' + name)
+        with open(temppath, mode = 'w', encoding = 'utf-8') as f:
+            for htid in htids[start: start + chunksize]:
+                f.write(htid + '\n')
+        os.rename(temppath, os.path.join(queue.tododir, name))
+        counter += 1
+
+    return counter
+
+if __name__ == "__main__":
+    command = sys.argv[1]
+    queuedir = sys.argv[2]
+
+    if command == "create":
+        with open(sys.argv[3], encoding = 'utf-8') as f:
+            htids = [x.strip() for x in f if len(x.strip()) > 0]
+        chunksize = 500
+        if len(sys.argv) > 4:
+            chunksize = int(sys.argv[4])
+        print("Created", create_queue(queuedir, htids, chunksize), "chunks of the dataset.")
+
+    elif command == "status":
+        todo, leased, done = WorkQueue(queuedir).status()
+        print(str(todo) + " chunks to do, " + str(leased) + " leased, " + str(done) + " done.")
+
+    elif command == "reclaim":
+        leasetime = LEASETIME
+        if len(sys.argv) > 3:
+            leasetime = int(sys.argv[3])
+        reclaimed = WorkQueue(queuedir, leasetime).reclaim()
+        print("Reclaimed", len(reclaimed), "chunks.")